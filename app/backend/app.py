@@ -1,11 +1,19 @@
-import io
+import asyncio
+import json
 import logging
 import mimetypes
 import os
+import tempfile
 import time
+from datetime import datetime
+from typing import AsyncGenerator, Optional, Union
 
 import aiohttp
 import openai
+from azure.core import MatchConditions
+from azure.core.credentials import AccessToken
+from azure.core.exceptions import ResourceNotFoundError
+from azure.core.pipeline.transport import AioHttpTransport
 from azure.identity.aio import DefaultAzureCredential
 from azure.monitor.opentelemetry import configure_azure_monitor
 from azure.search.documents.aio import SearchClient
@@ -17,24 +25,69 @@ from quart import (
     Quart,
     abort,
     current_app,
+    g,
     jsonify,
+    make_response,
     request,
-    send_file,
     send_from_directory,
+    url_for,
 )
+from werkzeug.datastructures import ContentRange
+from werkzeug.http import unquote_etag
 
 from indexer import add_file
 
+from approaches.approach import AskApproach, ChatApproach
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.readdecomposeask import ReadDecomposeAsk
 from approaches.readretrieveread import ReadRetrieveReadApproach
 from approaches.retrievethenread import RetrieveThenReadApproach
+from core.admission import CHAT, EMBEDDINGS, SEARCH, AdmissionController, AdmissionRejected
+from core.answercache import AnswerCache, MemoryAnswerCacheBackend, SqliteAnswerCacheBackend, answer_cache_key
+from core.contentcache import ContentCache
+from core.embeddingcache import EmbeddingCache, SqliteEmbeddingStore
+from core.ingestion import IngestionJob, IngestionQueue, SqliteIngestionStore
+from core.federatedsearch import FederatedSearchClient
+from core.indexregistry import IndexRegistry
+from core.lazycache import LazyCache
+from core.localsearch import LocalSearchClient
+from core.metrics import (
+    REQUEST_SECONDS,
+    REQUESTS,
+    REQUESTS_IN_FLIGHT,
+    monitor_event_loop_lag,
+    observe_cache,
+    observe_timings,
+    observe_upstream_error,
+    render_metrics,
+)
+from core.semanticcache import DEFAULT_THRESHOLD, SemanticCache
+from core.tokenmanager import COGNITIVE_SERVICES_SCOPE, TokenManager
 
-CONFIG_OPENAI_TOKEN = "openai_token"
+CONFIG_TOKEN_MANAGER = "token_manager"
 CONFIG_CREDENTIAL = "azure_credential"
 CONFIG_ASK_APPROACHES = "ask_approaches"
 CONFIG_CHAT_APPROACHES = "chat_approaches"
 CONFIG_BLOB_CONTAINER_CLIENT = "blob_container_client"
+CONFIG_OPENAI_SESSION = "openai_session"
+CONFIG_AZURE_SESSION = "azure_session"
+CONFIG_CONTENT_CACHE = "content_cache"
+CONFIG_SEARCH_CLIENTS = "search_clients"
+CONFIG_INDEX_REGISTRY = "index_registry"
+CONFIG_INDEX_REGISTRY_WATCHER = "index_registry_watcher"
+CONFIG_INGESTION_QUEUE = "ingestion_queue"
+CONFIG_INGESTION_WATCHER = "ingestion_watcher"
+CONFIG_ADMISSION = "admission"
+CONFIG_EVENT_LOOP_MONITOR = "event_loop_monitor"
+CONFIG_ASK_BATCH_CONCURRENCY = "ask_batch_concurrency"
+CONFIG_ASK_BATCH_MAX_ITEMS = "ask_batch_max_items"
+CONFIG_ANSWER_CACHE = "answer_cache"
+CONFIG_SEMANTIC_CACHE = "semantic_cache"
+CONFIG_EMBEDDING_CACHE = "embedding_cache"
+CONTENT_CHUNK_SIZE = 1024 * 1024
+
+# Approaches are cached per (index, approach), where a federated search over several indices uses a tuple of names
+IndexKey = Union[str, tuple[str, ...]]
 glob_blob_container_clients: dict = {}
 glob_search_clients: dict = {}
 
@@ -54,42 +107,92 @@ async def assets(path):
 
 # Serve content files from blob storage from within the app to keep the example self-contained.
 # *** NOTE *** this assumes that the content files are public, or at least that all users of the app
-# can access all the files. This is also slow and memory hungry.
+# can access all the files. Blobs are streamed in chunks, so memory per request stays small regardless of file size.
 @bp.route("/content/<index_name>/<path>")
 async def content_file(index_name, path):
-    print("Index name", index_name)
-    print("Path", path)
     blob_container_clients = current_app.config[CONFIG_BLOB_CONTAINER_CLIENT]
     blob_container_client = blob_container_clients.get(index_name)
     
     if not blob_container_client:
         return jsonify({"error": "unknown index_name for blob container"}), 400
 
-    blob = await blob_container_client.get_blob_client(path).download_blob()
-    
-    if not blob.properties or not hasattr(blob.properties, "content_settings"):
+    blob_client = blob_container_client.get_blob_client(path)
+    try:
+        properties = await blob_client.get_blob_properties()
+    except ResourceNotFoundError:
         abort(404)
-    
-    mime_type = blob.properties["content_settings"]["content_type"]
-    if mime_type == "application/octet-stream":
-        mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    
-    blob_file = io.BytesIO()
-    await blob.readinto(blob_file)
-    blob_file.seek(0)
-    return await send_file(blob_file, mimetype=mime_type, as_attachment=False, attachment_filename=path)
 
+    mime_type = properties.content_settings.content_type
+    if not mime_type or mime_type == "application/octet-stream":
+        mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    etag, _ = unquote_etag(properties.etag)
+
+    response = current_app.response_class(b"", mimetype=mime_type)
+    response.set_etag(etag)
+    response.last_modified = properties.last_modified
+    response.accept_ranges = "bytes"
+
+    if is_not_modified(etag, properties.last_modified):
+        response.status_code = 304
+        return response
+
+    offset, length = 0, properties.size
+    if request.range and is_range_current(etag, properties.last_modified):
+        byte_range = request.range.range_for_length(properties.size)
+        if byte_range:
+            offset, length = byte_range[0], byte_range[1] - byte_range[0]
+            response.status_code = 206
+            response.content_range = ContentRange("bytes", byte_range[0], byte_range[1], properties.size)
+        elif len(request.range.ranges) == 1:
+            response.status_code = 416
+            response.content_range = ContentRange("bytes", None, None, properties.size)
+            return response
+
+    content_cache: Optional[ContentCache] = current_app.config[CONFIG_CONTENT_CACHE]
+    cached_chunks = None
+    if content_cache and length > 0:
+        # An entry evicted by another request before it's opened is a miss, served from storage below
+        cached_chunks = await content_cache.read(index_name, path, etag, offset, length, CONTENT_CHUNK_SIZE)
+        observe_cache("content", cached_chunks is not None)
+    if cached_chunks is not None:
+        response.response = current_app.response_class.iterable_body_class(cached_chunks)
+    elif length > 0:
+        # Pin the download to the ETag we just read, so a concurrent overwrite can't mix two versions in one response
+        downloader = await blob_client.download_blob(offset=offset, length=length, etag=properties.etag, match_condition=MatchConditions.IfNotModified)
+        chunks = downloader.chunks()
+        # Only complete downloads populate the cache; partial ranges are served straight from storage
+        if content_cache and response.status_code == 200 and content_cache.accepts(properties.size):
+            chunks = content_cache.store(index_name, path, etag, chunks)
+        response.response = current_app.response_class.iterable_body_class(chunks)
+    response.content_length = length
+    response.timeout = None  # type: ignore
+    return response
+
+
+def is_not_modified(etag: str, last_modified: Optional[datetime]) -> bool:
+    # If-None-Match takes precedence over If-Modified-Since (RFC 9110 section 13.2.2)
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def is_range_current(etag: str, last_modified: Optional[datetime]) -> bool:
+    # A Range is only honoured if If-Range, when sent, still matches the current blob
+    if_range = request.if_range
+    if if_range.etag:
+        return if_range.etag == etag
+    if if_range.date and last_modified:
+        return last_modified.replace(microsecond=0) <= if_range.date
+    return True
 
 
 @bp.route("/upload", methods=["POST"])
 async def upload_file():
     # Check if a file part is present in the request
-    try:
-        uploaded_file = request.files.get("file")
-    except Exception as error:
-        print(error)
-        return jsonify({"error": error}), 500
-    
+    files = await request.files
+    uploaded_file = files.get("file")
     if not uploaded_file:
         return jsonify({"error": "No file provided."}), 400
 
@@ -97,25 +200,26 @@ async def upload_file():
     if uploaded_file.filename == "":
         return jsonify({"error": "No selected file."}), 400
 
-    index_name: str = request.args.get('index_name', 'natural-capital')
-    
-    upload_successful: bool = await add_file(uploaded_file=uploaded_file, index=index_name)
-   
-    if upload_successful:
-        return jsonify({"success": "File uploaded successfully!"}), 200
-    else:
-        return jsonify({"error": "Failed to upload file"}), 501
+    registry: IndexRegistry = current_app.config[CONFIG_INDEX_REGISTRY]
+    index_config = registry.get(request.args.get('index_name') or registry.default_index)
+    if not index_config:
+        return jsonify({"error": "unknown index_name"}), 400
+
+    # The document is uploaded, parsed, embedded and indexed in the background; poll /upload/<job_id> for progress
+    try:
+        job = await current_app.config[CONFIG_INGESTION_QUEUE].submit(uploaded_file.filename, index_config.name, index_config.container, uploaded_file.read())
+    except asyncio.QueueFull:
+        return jsonify({"error": "Too many uploads in progress, please try again later."}), 503
+
+    return jsonify({"success": "File queued for indexing.", **job.to_dict()}), 202, {"Location": url_for("routes.upload_status", job_id=job.id)}
 
-    # Save the file to Azure Blob Storage
-    # blob_client = blob_container_client.get_blob_client(uploaded_file.filename)
-    # await blob_client.upload_blob(uploaded_file.read(), overwrite=True)
 
-    # Provide the desired blob container (assuming natural-capital as default)
-    # index_name: str = request.args.get('index_name', 'natural-capital')
-    # blob_container_clients = current_app.config[CONFIG_BLOB_CONTAINER_CLIENT]
-    # blob_container_client = blob_container_clients.get(index_name)
-    # if not blob_container_client:
-    #     return jsonify({"error": "unknown index_name for blob container"}), 400
+@bp.route("/upload/<job_id>")
+async def upload_status(job_id):
+    job = await current_app.config[CONFIG_INGESTION_QUEUE].get(job_id)
+    if not job:
+        return jsonify({"error": "unknown job_id"}), 404
+    return jsonify(job)
 
 
 @bp.route("/ask", methods=["POST"])
@@ -125,34 +229,86 @@ async def ask():
     request_json = await request.get_json()
     approach = request_json["approach"]
     
-    # Obtain the overridden index_name, if provided.
-    overrides = request_json.get("overrides") or {}
-    index_name = overrides.get("index_name") or 'natural-capital'
+    # Obtain the overridden index_name, if provided, and apply that index's defaults.
+    index_key, overrides = resolve_index(request_json.get("overrides") or {})
+    label_request(approach, index_key)
 
     try:
-        impl = None
-        # Check if an index_name override is provided and get the specific implementation for that.
-        print("This is the index name: ", index_name)
-        if index_name:
-            impl = current_app.config[CONFIG_ASK_APPROACHES].get(index_name, {}).get(approach)
-        else:
-            for index_impls in current_app.config[CONFIG_ASK_APPROACHES].values():
-                if approach in index_impls:
-                    impl = index_impls[approach]
-                    break
-
-        print("This is the implementation: ", impl)
+        impl = current_app.config[CONFIG_ASK_APPROACHES].get((index_key, approach)) if index_key else None
         if not impl:
             return jsonify({"error": "unknown approach or index_name"}), 400
         
-        # Workaround for: https://github.com/openai/openai-python/issues/371
-        async with aiohttp.ClientSession() as s:
-            openai.aiosession.set(s)
-            r = await impl.run(request_json["question"], overrides)
-        return jsonify(r)
+        r = await run_with_answer_cache(impl, "ask", approach, index_key, request_json["question"], overrides, current_app.config[CONFIG_ANSWER_CACHE])
+        return jsonify(report_timings(r, approach, index_key, overrides))
     except Exception as e:
-        logging.exception("Exception in /ask")
-        return jsonify({"error": str(e)}), 500
+        return error_response(e, "/ask")
+
+
+@bp.route("/ask/batch", methods=["POST"])
+async def ask_batch():
+    if not request.is_json:
+        return jsonify({"error": "request must be json"}), 415
+    request_json = await request.get_json()
+    items = request_json.get("items") if isinstance(request_json, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "items must be a non-empty list"}), 400
+    if not all(isinstance(item, dict) and isinstance(item.get("question"), str) and isinstance(item.get("overrides") or {}, dict) for item in items):
+        return jsonify({"error": "items must be objects with a string question and an object for overrides"}), 400
+    if len(items) > current_app.config[CONFIG_ASK_BATCH_MAX_ITEMS]:
+        return jsonify({"error": f"at most {current_app.config[CONFIG_ASK_BATCH_MAX_ITEMS]} items per batch"}), 413
+
+    # Approaches are looked up once for the whole batch, before any results are streamed
+    ask_approaches = current_app.config[CONFIG_ASK_APPROACHES]
+    jobs = []
+    for item in items:
+        index_key, overrides = resolve_index(item.get("overrides") or {})
+        impl = ask_approaches.get((index_key, item.get("approach"))) if index_key else None
+        jobs.append((impl, item.get("approach"), index_key, item.get("question"), overrides))
+
+    events = run_ask_batch(
+        jobs, current_app.config[CONFIG_ASK_BATCH_CONCURRENCY], current_app.config[CONFIG_ADMISSION].retry_after, current_app.config[CONFIG_ANSWER_CACHE]
+    )
+    response = await make_response(format_as_ndjson(events))
+    response.mimetype = "application/x-ndjson"
+    response.timeout = None  # type: ignore
+    return response
+
+
+async def run_ask_batch(
+    jobs: list[tuple[Optional[AskApproach], str, Optional[IndexKey], str, dict]],
+    concurrency: int,
+    default_retry_after: int,
+    answer_cache: Optional[AnswerCache] = None,
+) -> AsyncGenerator[dict, None]:
+    """
+    Run a batch of questions, at most concurrency at a time, yielding one event per item as soon as it finishes:
+    {"index", "status": 200, "result"} on success, or {"index", "status", "error"} plus "retry_after" on a 429.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_item(index: int, impl: Optional[AskApproach], approach: str, index_key: IndexKey, question: str, overrides: dict) -> dict:
+        if impl is None:
+            return {"index": index, "status": 400, "error": "unknown approach or index_name"}
+        async with semaphore:
+            try:
+                result = await run_with_answer_cache(impl, "ask", approach, index_key, question, overrides, answer_cache)
+                return {"index": index, "status": 200, "result": report_timings(result, approach, index_key, overrides)}
+            except Exception as e:
+                observe_upstream_error(e)
+                status, retry_after = classify_error(e)
+                if status != 429:
+                    logging.exception("Exception in /ask/batch item %d", index)
+                    return {"index": index, "status": status, "error": str(e)}
+                return {"index": index, "status": status, "error": str(e), "retry_after": str(retry_after or default_retry_after)}
+
+    tasks = [asyncio.ensure_future(run_item(index, *job)) for index, job in enumerate(jobs)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # The client went away: don't keep spending upstream capacity on answers nobody will read
+        for task in tasks:
+            task.cancel()
 
 
 @bp.route("/chat", methods=["POST"])
@@ -162,46 +318,251 @@ async def chat():
     request_json = await request.get_json()
     approach = request_json["approach"]
 
-    # Obtain the overridden index_name, if provided.
-    overrides = request_json.get("overrides") or {}
-    index_name = overrides.get("index_name") or 'natural-capital'
+    # Obtain the overridden index_name, if provided, and apply that index's defaults.
+    index_key, overrides = resolve_index(request_json.get("overrides") or {})
+    label_request(approach, index_key)
 
     try:
-        impl = None
-        # For the chat approach, only one primary index has been setup. We can expand this in a similar manner as the ask route if needed.
-        if index_name:
-            impl = current_app.config[CONFIG_CHAT_APPROACHES].get(index_name, {}).get(approach)
-        else:
-            impl = current_app.config[CONFIG_CHAT_APPROACHES].get(approach)
+        impl = current_app.config[CONFIG_CHAT_APPROACHES].get((index_key, approach)) if index_key else None
 
         if not impl:
             return jsonify({"error": "unknown approach or index_name"}), 400
         
-        # Workaround for: https://github.com/openai/openai-python/issues/371
-        async with aiohttp.ClientSession() as s:
-            openai.aiosession.set(s)
-            r = await impl.run(request_json["history"], overrides)
-        return jsonify(r)
+        r = await run_with_answer_cache(impl, "chat", approach, index_key, request_json["history"], overrides, current_app.config[CONFIG_ANSWER_CACHE])
+        return jsonify(report_timings(r, approach, index_key, overrides))
+    except Exception as e:
+        return error_response(e, "/chat")
+
+
+@bp.route("/ask_stream", methods=["POST"])
+async def ask_stream():
+    if not request.is_json:
+        return jsonify({"error": "request must be json"}), 415
+    request_json = await request.get_json()
+    approach = request_json["approach"]
+
+    index_key, overrides = resolve_index(request_json.get("overrides") or {})
+    label_request(approach, index_key)
+    impl = current_app.config[CONFIG_ASK_APPROACHES].get((index_key, approach)) if index_key else None
+    if not impl:
+        return jsonify({"error": "unknown approach or index_name"}), 400
+
+    events = await stream_with_answer_cache(impl, "ask", approach, index_key, request_json["question"], overrides, current_app.config[CONFIG_ANSWER_CACHE])
+    events = report_stream_timings(events, approach, index_key, overrides)
+    return await stream_as_ndjson(events, "/ask_stream")
+
+
+@bp.route("/chat_stream", methods=["POST"])
+async def chat_stream():
+    if not request.is_json:
+        return jsonify({"error": "request must be json"}), 415
+    request_json = await request.get_json()
+    approach = request_json["approach"]
+
+    index_key, overrides = resolve_index(request_json.get("overrides") or {})
+    label_request(approach, index_key)
+    impl = current_app.config[CONFIG_CHAT_APPROACHES].get((index_key, approach)) if index_key else None
+    if not impl:
+        return jsonify({"error": "unknown approach or index_name"}), 400
+
+    events = await stream_with_answer_cache(impl, "chat", approach, index_key, request_json["history"], overrides, current_app.config[CONFIG_ANSWER_CACHE])
+    events = report_stream_timings(events, approach, index_key, overrides)
+    return await stream_as_ndjson(events, "/chat_stream")
+
+
+def resolve_index(overrides: dict) -> tuple[Optional[IndexKey], dict]:
+    """
+    Look up the requested index, or the default one, and layer the request's overrides over its defaults.
+    With "index_names" several indices are searched together; the key is then the tuple of their names, and
+    the first index provides the defaults.
+    """
+    registry: IndexRegistry = current_app.config[CONFIG_INDEX_REGISTRY]
+    names = overrides.get("index_names") or [overrides.get("index_name") or registry.default_index]
+    index_configs = [registry.get(name) for name in dict.fromkeys(names)]
+    if not index_configs or None in index_configs:
+        return None, overrides
+    index_key = index_configs[0].name if len(index_configs) == 1 else tuple(index_config.name for index_config in index_configs)
+    return index_key, {**index_configs[0].defaults, **{key: value for key, value in overrides.items() if value is not None}}
+
+
+def index_names(index_key: IndexKey) -> tuple[str, ...]:
+    return index_key if isinstance(index_key, tuple) else (index_key,)
+
+
+def label_request(approach: str, index_key: Optional[IndexKey]):
+    # Lets the request latency metrics be broken down by approach and index
+    g.metric_labels = (str(approach), "+".join(index_names(index_key)) if index_key else "")
+
+
+def report_timings(result: dict, approach: str, index_key: IndexKey, overrides: dict) -> dict:
+    """
+    Record the per-stage timings and token counts of an answer as metrics, and leave them in the response only
+    when the request asked for them with the "include_timings" override.
+    """
+    timings = result.pop("timings", None)
+    if timings:
+        observe_timings(approach, "+".join(index_names(index_key)), timings)
+        if overrides.get("include_timings"):
+            result["timings"] = timings
+    return result
+
+
+async def report_stream_timings(events: AsyncGenerator[dict, None], approach: str, index_key: IndexKey, overrides: dict) -> AsyncGenerator[dict, None]:
+    # Streaming approaches send their timings in a last event of their own, which is dropped unless requested
+    async for event in events:
+        if "timings" in event and not report_timings(event, approach, index_key, overrides):
+            continue
+        yield event
+
+
+def cache_key_for(answer_cache: Optional[AnswerCache], kind: str, approach: str, index_key: IndexKey, question, overrides: dict) -> Optional[str]:
+    # Only the first turn of a chat is cached: later turns depend on the whole conversation and rarely repeat
+    if answer_cache is None or (kind == "chat" and len(question) != 1):
+        return None
+    return answer_cache_key(kind, approach, index_names(index_key), question, overrides)
+
+
+async def run_with_answer_cache(impl, kind: str, approach: str, index_key: IndexKey, question, overrides: dict, answer_cache: Optional[AnswerCache]) -> dict:
+    """Answer from the cache when the same question was asked with the same approach, index and overrides."""
+    key = cache_key_for(answer_cache, kind, approach, index_key, question, overrides)
+    if key is None:
+        return await impl.run(question, overrides)
+    cached = await answer_cache.get(key)
+    observe_cache("answer", cached is not None)
+    if cached is not None:
+        return cached
+    result = await impl.run(question, overrides)
+    await answer_cache.set(key, index_names(index_key), result)
+    return result
+
+
+async def stream_with_answer_cache(impl, kind: str, approach: str, index_key: IndexKey, question, overrides: dict, answer_cache: Optional[AnswerCache]) -> AsyncGenerator[dict, None]:
+    """
+    The events of a streamed answer: replayed from the cache as one "data_points" event and one "answer" event,
+    or streamed by the approach and cached once the stream completes.
+    """
+    key = cache_key_for(answer_cache, kind, approach, index_key, question, overrides)
+    if key is None:
+        return impl.run_stream(question, overrides)
+    cached = await answer_cache.get(key)
+    observe_cache("answer", cached is not None)
+    if cached is not None:
+        return replay_cached_answer(cached)
+    return cache_streamed_answer(impl.run_stream(question, overrides), answer_cache, key, index_names(index_key))
+
+
+async def replay_cached_answer(cached: dict) -> AsyncGenerator[dict, None]:
+    yield {"data_points": cached["data_points"], "thoughts": cached["thoughts"]}
+    yield {"answer": cached["answer"]}
+
+
+async def cache_streamed_answer(events: AsyncGenerator[dict, None], answer_cache: AnswerCache, key: str, names: tuple[str, ...]) -> AsyncGenerator[dict, None]:
+    answer: dict = {"answer": ""}
+    async for event in events:
+        if "data_points" in event:
+            answer.update(data_points=event["data_points"], thoughts=event.get("thoughts"))
+        elif "answer" in event:
+            answer["answer"] += event["answer"]
+        yield event
+    # A stream that failed or was abandoned part way never gets here, so only complete answers are cached
+    if "data_points" in answer:
+        await answer_cache.set(key, names, answer)
+
+
+def classify_error(error: Exception) -> tuple[int, Optional[str]]:
+    """The status code for a failed request, and the seconds to wait before retrying it, when that is known."""
+    if isinstance(error, AdmissionRejected):
+        return 429, str(error.retry_after)
+    if isinstance(error, openai.error.RateLimitError):
+        return 429, (error.headers or {}).get("retry-after")
+    return 500, None
+
+
+def error_response(error: Exception, route: str):
+    """Shed load with a 429 when an upstream is saturated, and report any other failure as a 500."""
+    observe_upstream_error(error)
+    status, retry_after = classify_error(error)
+    if status == 429:
+        message = str(error) if isinstance(error, AdmissionRejected) else "The model is receiving too many requests, please retry later"
+        return jsonify({"error": message}), 429, {"Retry-After": str(retry_after or current_app.config[CONFIG_ADMISSION].retry_after)}
+    logging.exception("Exception in %s", route)
+    return jsonify({"error": str(error)}), 500
+
+
+async def stream_as_ndjson(events: AsyncGenerator[dict, None], route: str):
+    # Everything up to the first event (search, embeddings and the start of the completion) runs before the
+    # headers are sent, so admission rejections and upstream rate limits still get a proper status code
+    try:
+        first_event = await events.__anext__()
+    except StopAsyncIteration:
+        first_event = None
     except Exception as e:
-        logging.exception("Exception in /chat")
-        return jsonify({"error": str(e)}), 500
+        return error_response(e, route)
+
+    response = await make_response(format_as_ndjson(events, first_event))
+    response.mimetype = "application/x-ndjson"
+    response.timeout = None  # type: ignore
+    return response
+
+
+async def format_as_ndjson(events: AsyncGenerator[dict, None], first_event: Optional[dict] = None) -> AsyncGenerator[str, None]:
+    """
+    Serialize the events of a streaming approach as newline delimited JSON. The first event carries
+    "data_points" and "thoughts", the following ones carry "answer" deltas to be concatenated by the client.
+    """
+    try:
+        if first_event is not None:
+            yield json.dumps(first_event, ensure_ascii=False) + "\n"
+        async for event in events:
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+    except Exception as e:
+        # Headers are already sent at this point, so the error has to travel in the stream itself
+        observe_upstream_error(e)
+        logging.exception("Exception while streaming response")
+        yield json.dumps({"error": str(e)}) + "\n"
+
+
+@bp.route("/metrics")
+async def metrics():
+    body, content_type = render_metrics()
+    return body, 200, {"Content-Type": content_type}
+
+
+@bp.before_request
+async def start_request_metrics():
+    g.metric_route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.metric_start = time.perf_counter()
+    REQUESTS_IN_FLIGHT.labels(g.metric_route).inc()
+
+
+@bp.after_request
+async def record_request_metrics(response):
+    route = g.metric_route
+    approach, index = g.get("metric_labels", ("", ""))
+    REQUESTS_IN_FLIGHT.labels(route).dec()
+    REQUESTS.labels(route, request.method, str(response.status_code)).inc()
+    REQUEST_SECONDS.labels(route, approach, index).observe(time.perf_counter() - g.metric_start)
+    return response
+
+
+@bp.before_request
+async def use_pooled_session():
+    # Workaround for: https://github.com/openai/openai-python/issues/371
+    # openai keeps its session in a context variable, so it has to be set for every request.
+    openai.aiosession.set(current_app.config[CONFIG_OPENAI_SESSION])
 
 
 @bp.before_request
 async def ensure_openai_token():
-    openai_token = current_app.config[CONFIG_OPENAI_TOKEN]
-    if openai_token.expires_on < time.time() + 60:
-        openai_token = await current_app.config[CONFIG_CREDENTIAL].get_token("https://cognitiveservices.azure.com/.default")
-        current_app.config[CONFIG_OPENAI_TOKEN] = openai_token
-        openai.api_key = openai_token.token
+    # Returns the cached token; only waits (on a single shared refresh) if background refreshes kept failing
+    openai_token = await current_app.config[CONFIG_TOKEN_MANAGER].get_token(COGNITIVE_SERVICES_SCOPE)
+    openai.api_key = openai_token.token
 
 @bp.before_app_serving
 async def setup_clients():
     # Fetch environment variables or use default values.
     AZURE_STORAGE_ACCOUNT = os.getenv("AZURE_STORAGE_ACCOUNT")
-    AZURE_STORAGE_CONTAINER = ["natural-capital", "energy", "climate-financing", "green-minerals", "sust-agric", "adaptation", "infrastructure"]
     AZURE_SEARCH_SERVICE = os.getenv("AZURE_SEARCH_SERVICE")
-    AZURE_SEARCH_INDICES = ["natural-capital", "energy", "climate-financing", "green-minerals", "sust-agric", "adaptation", "infrastructure"]
     AZURE_OPENAI_SERVICE = os.getenv("AZURE_OPENAI_SERVICE")
     AZURE_OPENAI_CHATGPT_DEPLOYMENT = os.getenv("AZURE_OPENAI_CHATGPT_DEPLOYMENT")
     AZURE_OPENAI_CHATGPT_MODEL = os.getenv("AZURE_OPENAI_CHATGPT_MODEL")
@@ -210,84 +571,296 @@ async def setup_clients():
     KB_FIELDS_CONTENT = os.getenv("KB_FIELDS_CONTENT", "content")
     KB_FIELDS_SOURCEPAGE = os.getenv("KB_FIELDS_SOURCEPAGE", "sourcepage")
 
+    # The indices, their containers and defaults come from a JSON registry, see core/indexregistry.py
+    INDEX_REGISTRY = os.getenv("INDEX_REGISTRY")
+    INDEX_REGISTRY_FILE = os.getenv("INDEX_REGISTRY_FILE") or os.path.join(os.path.dirname(__file__), "indices.json")
+    INDEX_REGISTRY_RELOAD_INTERVAL = float(os.getenv("INDEX_REGISTRY_RELOAD_INTERVAL", "30"))
+
+    WARMUP_APPROACHES = os.getenv("WARMUP_APPROACHES", "")
+
+    CONTENT_CACHE_DIR = os.getenv("CONTENT_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "content-cache")
+    CONTENT_CACHE_MAX_BYTES = int(os.getenv("CONTENT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+    INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "2"))
+    INGESTION_MAX_QUEUED = int(os.getenv("INGESTION_MAX_QUEUED", "100"))
+    # Job status and index versions live in SQLite, so every worker can report on a job and drop answers an upload made stale
+    INGESTION_STORE_PATH = os.getenv("INGESTION_STORE_PATH") or os.path.join(tempfile.gettempdir(), "ingestion.sqlite3")
+    INGESTION_WATCH_INTERVAL = float(os.getenv("INGESTION_WATCH_INTERVAL", "5"))
+
+    # In-flight calls per worker to each upstream, and how long a call may wait for a slot before a 429; 0 means no limit
+    ADMISSION_CHAT_LIMIT = int(os.getenv("ADMISSION_CHAT_LIMIT", "32"))
+    ADMISSION_EMBEDDINGS_LIMIT = int(os.getenv("ADMISSION_EMBEDDINGS_LIMIT", "64"))
+    ADMISSION_SEARCH_LIMIT = int(os.getenv("ADMISSION_SEARCH_LIMIT", "64"))
+    ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "5"))
+    ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "2"))
+
+    # Questions of one /ask/batch request run this many at a time
+    ASK_BATCH_CONCURRENCY = int(os.getenv("ASK_BATCH_CONCURRENCY", "8"))
+    ASK_BATCH_MAX_ITEMS = int(os.getenv("ASK_BATCH_MAX_ITEMS", "500"))
+    # "memory" caches answers per worker, "sqlite" shares them between the workers of an instance, "none" disables
+    ANSWER_CACHE_BACKEND = os.getenv("ANSWER_CACHE_BACKEND", "memory")
+    ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH") or os.path.join(tempfile.gettempdir(), "answer-cache.sqlite3")
+    ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+    ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "10000"))
+    # Paraphrased questions are answered from recent answers by embedding similarity; 0 entries disables it
+    SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", str(DEFAULT_THRESHOLD)))
+    SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "512"))
+    SEMANTIC_CACHE_MAX_PARTITIONS = int(os.getenv("SEMANTIC_CACHE_MAX_PARTITIONS", "16"))
+    SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+    # Query embeddings are reused across approaches; EMBEDDING_CACHE_PATH adds a SQLite tier that outlives workers
+    EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "4096"))
+    EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH")
+    EMBEDDING_CACHE_MAX_STORED = int(os.getenv("EMBEDDING_CACHE_MAX_STORED", "100000"))
+    # Indices saved by LocalSearchClient in LOCAL_SEARCH_DIR/<index name> are searched in process instead of on Azure
+    LOCAL_SEARCH_DIR = os.getenv("LOCAL_SEARCH_DIR")
+    LOCAL_SEARCH_NPROBE = int(os.getenv("LOCAL_SEARCH_NPROBE", "8"))
+
+    HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+    HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "0"))
+    HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "120"))
+
     # Set up Azure authentication.
     azure_credential = DefaultAzureCredential(exclude_shared_token_cache_credential=True)
 
+    # Keep one pool of keep-alive connections per worker, so requests don't pay for new TCP and TLS handshakes.
+    # OpenAI and the Azure SDK clients use separate sessions on the same connector, because the Azure SDK
+    # decompresses responses itself and expects aiohttp not to do it.
+    connector = aiohttp.TCPConnector(limit=HTTP_POOL_LIMIT, limit_per_host=HTTP_POOL_LIMIT_PER_HOST, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT)
+    openai_session = aiohttp.ClientSession(connector=connector)
+    azure_session = aiohttp.ClientSession(connector=connector, connector_owner=False, trust_env=True, cookie_jar=aiohttp.DummyCookieJar(), auto_decompress=False)
+    azure_transport = AioHttpTransport(session=azure_session, session_owner=False)
+
     # Set up Blob Storage clients.
     blob_client = BlobServiceClient(
         account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
-        credential=azure_credential
+        credential=azure_credential,
+        transport=azure_transport,
+        # Bound the memory held per /content download; blobs are streamed to the client one chunk at a time.
+        max_single_get_size=CONTENT_CHUNK_SIZE,
+        max_chunk_get_size=CONTENT_CHUNK_SIZE
     )
 
-    blob_container_clients = {}
-    for container in AZURE_STORAGE_CONTAINER:
-        blob_container_clients[container] = blob_client.get_container_client(container)
-
-    # Set up Search clients for multiple indices.
-    search_clients = {}
-    for index_name in AZURE_SEARCH_INDICES:
-        search_clients[index_name] = SearchClient(
+    # An INDEX_REGISTRY set in the environment takes precedence over the file, but only the file is reloaded
+    if INDEX_REGISTRY:
+        index_registry = IndexRegistry(data=INDEX_REGISTRY, content_field=KB_FIELDS_CONTENT, sourcepage_field=KB_FIELDS_SOURCEPAGE)
+    else:
+        index_registry = IndexRegistry(path=INDEX_REGISTRY_FILE, content_field=KB_FIELDS_CONTENT, sourcepage_field=KB_FIELDS_SOURCEPAGE)
+
+    # Container clients, Search clients and approaches are only built the first time an index is used, so worker
+    # startup and memory scale with the indices that get traffic rather than with every configured index.
+    def create_blob_container_client(index_name: str):
+        index_config = index_registry.get(index_name)
+        return blob_client.get_container_client(index_config.container) if index_config else None
+
+    def create_search_client(index_name: str) -> Optional[Union[SearchClient, LocalSearchClient]]:
+        if index_registry.get(index_name) is None:
+            return None
+        if LOCAL_SEARCH_DIR:
+            return LocalSearchClient.load(os.path.join(LOCAL_SEARCH_DIR, index_name), content_field=KB_FIELDS_CONTENT, nprobe=LOCAL_SEARCH_NPROBE)
+        return SearchClient(
             endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
             index_name=index_name,
-            credential=azure_credential
+            credential=azure_credential,
+            transport=azure_transport
         )
 
+    blob_container_clients = LazyCache(create_blob_container_client)
+    search_clients = LazyCache(create_search_client)
+
     # Setup OpenAI
     openai.api_base = f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
     openai.api_version = "2023-05-15"
     openai.api_type = "azure_ad"
-    openai_token = await azure_credential.get_token(
-        "https://cognitiveservices.azure.com/.default"
+
+    # Tokens are refreshed in the background before they expire, so requests never wait on token acquisition
+    def set_openai_key(scopes: tuple[str, ...], token: AccessToken):
+        if scopes == (COGNITIVE_SERVICES_SCOPE,):
+            openai.api_key = token.token
+
+    token_manager = TokenManager(azure_credential, on_refresh=set_openai_key)
+    await token_manager.start(COGNITIVE_SERVICES_SCOPE)
+
+    if ANSWER_CACHE_BACKEND == "sqlite":
+        answer_cache: Optional[AnswerCache] = AnswerCache(SqliteAnswerCacheBackend(ANSWER_CACHE_PATH, ANSWER_CACHE_MAX_ENTRIES), ANSWER_CACHE_TTL)
+    elif ANSWER_CACHE_BACKEND == "memory":
+        answer_cache = AnswerCache(MemoryAnswerCacheBackend(ANSWER_CACHE_MAX_ENTRIES), ANSWER_CACHE_TTL)
+    else:
+        answer_cache = None
+    semantic_cache = SemanticCache(
+        SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_MAX_ENTRIES, SEMANTIC_CACHE_MAX_PARTITIONS, SEMANTIC_CACHE_TTL
+    ) if SEMANTIC_CACHE_MAX_ENTRIES > 0 else None
+    embedding_cache = EmbeddingCache(
+        EMBEDDING_CACHE_MAX_ENTRIES, SqliteEmbeddingStore(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_STORED) if EMBEDDING_CACHE_PATH else None
+    ) if EMBEDDING_CACHE_MAX_ENTRIES > 0 else None
+
+    # Uploads are ingested by a few background workers on their own threads, off the event loop serving chat
+    def ingest(job: IngestionJob, content: bytes):
+        add_file(job.filename, content, job.index, job.container, token_manager.sync_credential(), on_progress=job.update)
+
+    # Answers cached before an upload didn't see the new document. The worker that ingested it forgets them right
+    # away, and the others once they see the index's version change in the shared store.
+    async def on_indices_ingested(changed: set[str]):
+        for index_name in changed:
+            if answer_cache:
+                await answer_cache.invalidate(index_name)
+            if semantic_cache:
+                semantic_cache.invalidate(index_name)
+
+    async def on_ingested(job: IngestionJob):
+        await on_indices_ingested({job.index})
+
+    ingestion_queue = IngestionQueue(
+        ingest,
+        workers=INGESTION_WORKERS,
+        max_queued=INGESTION_MAX_QUEUED,
+        store=SqliteIngestionStore(INGESTION_STORE_PATH),
+        on_success=on_ingested
     )
-    openai.api_key = openai_token.token
+    await ingestion_queue.start()
 
     # Store some configuration data for use in later requests.
-    current_app.config[CONFIG_OPENAI_TOKEN] = openai_token
+    current_app.config[CONFIG_TOKEN_MANAGER] = token_manager
     current_app.config[CONFIG_CREDENTIAL] = azure_credential
+    current_app.config[CONFIG_INGESTION_QUEUE] = ingestion_queue
+    current_app.config[CONFIG_INGESTION_WATCHER] = asyncio.create_task(ingestion_queue.watch(INGESTION_WATCH_INTERVAL, on_indices_ingested))
     current_app.config[CONFIG_BLOB_CONTAINER_CLIENT] = blob_container_clients
+    current_app.config[CONFIG_OPENAI_SESSION] = openai_session
+    current_app.config[CONFIG_AZURE_SESSION] = azure_session
+    # Popular citation pages are served from local disk; set CONTENT_CACHE_MAX_BYTES=0 to disable the cache
+    current_app.config[CONFIG_CONTENT_CACHE] = ContentCache(CONTENT_CACHE_DIR, CONTENT_CACHE_MAX_BYTES) if CONTENT_CACHE_MAX_BYTES > 0 else None
+
+    admission = AdmissionController(
+        {CHAT: ADMISSION_CHAT_LIMIT, EMBEDDINGS: ADMISSION_EMBEDDINGS_LIMIT, SEARCH: ADMISSION_SEARCH_LIMIT},
+        max_wait=ADMISSION_MAX_WAIT,
+        retry_after=ADMISSION_RETRY_AFTER
+    )
+    current_app.config[CONFIG_ADMISSION] = admission
+    current_app.config[CONFIG_EVENT_LOOP_MONITOR] = asyncio.create_task(monitor_event_loop_lag())
+    current_app.config[CONFIG_ASK_BATCH_CONCURRENCY] = ASK_BATCH_CONCURRENCY
+    current_app.config[CONFIG_ASK_BATCH_MAX_ITEMS] = ASK_BATCH_MAX_ITEMS
+    current_app.config[CONFIG_ANSWER_CACHE] = answer_cache
+    current_app.config[CONFIG_SEMANTIC_CACHE] = semantic_cache
+    current_app.config[CONFIG_EMBEDDING_CACHE] = embedding_cache
+
+    # A federated key searches all its indices at once; the first index decides the fields read from the results
+    def get_search_client(index_key: IndexKey):
+        if not isinstance(index_key, tuple):
+            return search_clients.get(index_key)
+        clients = {index_name: search_clients.get(index_name) for index_name in index_key}
+        return FederatedSearchClient(clients) if None not in clients.values() else None
 
     # Update the approaches to integrate GPT with external knowledge.
-    current_app.config[CONFIG_ASK_APPROACHES] = {
-        index_name: {
-            "rtr": RetrieveThenReadApproach(
-                search_clients[index_name],
+    def create_ask_approach(key: tuple[IndexKey, str]) -> Optional[AskApproach]:
+        index_key, approach = key
+        index_config = index_registry.get(index_names(index_key)[0])
+        search_client = get_search_client(index_key)
+        if index_config is None or search_client is None:
+            return None
+        if approach == "rtr":
+            return RetrieveThenReadApproach(
+                search_client,
                 AZURE_OPENAI_CHATGPT_DEPLOYMENT,
                 AZURE_OPENAI_CHATGPT_MODEL,
                 AZURE_OPENAI_EMB_DEPLOYMENT,
-                KB_FIELDS_SOURCEPAGE,
-                KB_FIELDS_CONTENT
-            ),
-            "rrr": ReadRetrieveReadApproach(
-                search_clients[index_name],
+                index_config.sourcepage_field,
+                index_config.content_field,
+                admission,
+                semantic_cache.for_indices(index_names(index_key)) if semantic_cache else None,
+                embedding_cache
+            )
+        if approach == "rrr":
+            return ReadRetrieveReadApproach(
+                search_client,
                 AZURE_OPENAI_CHATGPT_DEPLOYMENT,
                 AZURE_OPENAI_EMB_DEPLOYMENT,
-                KB_FIELDS_SOURCEPAGE,
-                KB_FIELDS_CONTENT
-            ),
-            "rda": ReadDecomposeAsk(
-                search_clients[index_name],
+                index_config.sourcepage_field,
+                index_config.content_field,
+                admission,
+                embedding_cache
+            )
+        if approach == "rda":
+            return ReadDecomposeAsk(
+                search_client,
                 AZURE_OPENAI_CHATGPT_DEPLOYMENT,
                 AZURE_OPENAI_EMB_DEPLOYMENT,
-                KB_FIELDS_SOURCEPAGE,
-                KB_FIELDS_CONTENT
+                index_config.sourcepage_field,
+                index_config.content_field,
+                admission,
+                embedding_cache
             )
-        }
-        for index_name in AZURE_SEARCH_INDICES
-    }
-
-    current_app.config[CONFIG_CHAT_APPROACHES] = {
-        index_name: {
-            "rrr": ChatReadRetrieveReadApproach(
-                search_clients[index_name],
+        return None
+
+    def create_chat_approach(key: tuple[IndexKey, str]) -> Optional[ChatApproach]:
+        index_key, approach = key
+        index_config = index_registry.get(index_names(index_key)[0])
+        search_client = get_search_client(index_key)
+        if index_config is None or search_client is None:
+            return None
+        if approach == "rrr":
+            return ChatReadRetrieveReadApproach(
+                search_client,
                 AZURE_OPENAI_CHATGPT_DEPLOYMENT,
                 AZURE_OPENAI_CHATGPT_MODEL,
                 AZURE_OPENAI_EMB_DEPLOYMENT,
-                KB_FIELDS_SOURCEPAGE,
-                KB_FIELDS_CONTENT
+                index_config.sourcepage_field,
+                index_config.content_field,
+                admission,
+                semantic_cache.for_indices(index_names(index_key)) if semantic_cache else None,
+                embedding_cache
             )
-        }
-        for index_name in AZURE_SEARCH_INDICES
-    }
+        return None
+
+    ask_approaches = LazyCache(create_ask_approach)
+    chat_approaches = LazyCache(create_chat_approach)
+
+    # Optionally pre-create the hot index/approach pairs, e.g. WARMUP_APPROACHES="natural-capital/rrr,energy/rtr"
+    warmup = [tuple(pair.strip().split("/", 1)) for pair in WARMUP_APPROACHES.split(",") if "/" in pair]
+    ask_approaches.warm(warmup)
+    chat_approaches.warm(warmup)
+    blob_container_clients.warm(index_name for index_name, _ in warmup)
+
+    # When the registry changes, only the clients and approaches of the indices that changed are dropped; they are
+    # rebuilt on their next request, while every other index keeps serving from its warm cache entries.
+    async def on_index_registry_change(changed: set[str]):
+        ask_approaches.discard(lambda key: not changed.isdisjoint(index_names(key[0])))
+        chat_approaches.discard(lambda key: not changed.isdisjoint(index_names(key[0])))
+        blob_container_clients.discard(lambda index_name: index_name in changed)
+        for search_client in search_clients.discard(lambda index_name: index_name in changed):
+            await search_client.close()
+        for index_name in changed:
+            if answer_cache:
+                await answer_cache.invalidate(index_name)
+            if semantic_cache:
+                semantic_cache.invalidate(index_name)
+
+    current_app.config[CONFIG_INDEX_REGISTRY] = index_registry
+    current_app.config[CONFIG_SEARCH_CLIENTS] = search_clients
+    current_app.config[CONFIG_ASK_APPROACHES] = ask_approaches
+    current_app.config[CONFIG_CHAT_APPROACHES] = chat_approaches
+    current_app.config[CONFIG_INDEX_REGISTRY_WATCHER] = (
+        asyncio.create_task(index_registry.watch(INDEX_REGISTRY_RELOAD_INTERVAL, on_index_registry_change))
+        if index_registry.path and INDEX_REGISTRY_RELOAD_INTERVAL > 0 else None
+    )
+
+@bp.after_app_serving
+async def close_clients():
+    if current_app.config[CONFIG_INDEX_REGISTRY_WATCHER]:
+        current_app.config[CONFIG_INDEX_REGISTRY_WATCHER].cancel()
+    current_app.config[CONFIG_EVENT_LOOP_MONITOR].cancel()
+    current_app.config[CONFIG_INGESTION_WATCHER].cancel()
+    await current_app.config[CONFIG_INGESTION_QUEUE].stop()
+    current_app.config[CONFIG_INGESTION_QUEUE].store.close()
+    await current_app.config[CONFIG_TOKEN_MANAGER].stop()
+    if current_app.config[CONFIG_ANSWER_CACHE]:
+        current_app.config[CONFIG_ANSWER_CACHE].close()
+    if current_app.config[CONFIG_EMBEDDING_CACHE]:
+        current_app.config[CONFIG_EMBEDDING_CACHE].close()
+    for search_client in current_app.config[CONFIG_SEARCH_CLIENTS].values():
+        await search_client.close()
+    await current_app.config[CONFIG_AZURE_SESSION].close()
+    # The OpenAI session owns the shared connector, so close it last
+    await current_app.config[CONFIG_OPENAI_SESSION].close()
+
 
 def create_app():
     if os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING"):
@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import Any
+from typing import Any, AsyncGenerator
 
 
 class ChatApproach(ABC):
@@ -7,8 +7,38 @@ class ChatApproach(ABC):
     async def run(self, history: list[dict], overrides: dict[str, Any]) -> Any:
         ...
 
+    async def run_stream(self, history: list[dict], overrides: dict[str, Any]) -> AsyncGenerator[dict, None]:
+        # Approaches that can't stream tokens send their whole answer as a single event
+        yield await self.run(history, overrides)
+
 
 class AskApproach(ABC):
     @abstractmethod
     async def run(self, q: str, overrides: dict[str, Any]) -> Any:
         ...
+
+    async def run_stream(self, q: str, overrides: dict[str, Any]) -> AsyncGenerator[dict, None]:
+        # Approaches that can't stream tokens send their whole answer as a single event
+        yield await self.run(q, overrides)
+
+
+def select_fields(sourcepage_field: str, content_field: str, overrides: dict[str, Any]) -> list[str]:
+    """
+    The fields a search returns for each document: its key (federated searches tell documents apart by it), its
+    citation and its content. The embedding, most of the payload of a document, only comes back when the
+    "include_vectors" override asks for it, e.g. to rerank results locally.
+    """
+    fields = ["id", sourcepage_field, content_field]
+    if overrides.get("include_vectors"):
+        fields.append("embedding")
+    return fields
+
+
+def citation(doc: dict[str, Any], sourcepage_field: str) -> str:
+    """
+    The name a source is cited by. Results of a federated search are prefixed with the index they came from
+    ("adaptation/report-3.pdf"), so /content fetches the citation from that index's container rather than the
+    first one's.
+    """
+    index_name = doc.get("@search.index")
+    return f"{index_name}/{doc[sourcepage_field]}" if index_name else doc[sourcepage_field]
@@ -1,14 +1,31 @@
-from typing import Any
+import asyncio
+import re
+from typing import Any, AsyncGenerator, Awaitable, Optional
 
 import openai
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import QueryType
 
-from approaches.approach import ChatApproach
-from core.messagebuilder import MessageBuilder
+from approaches.approach import ChatApproach, citation, select_fields
+from core.admission import CHAT, SEARCH, AdmissionController
+from core.diversify import MMR_LAMBDA, diversified_search
+from core.embeddingcache import EmbeddingCache, embed_query
+from core.metrics import observe_cache, observe_query_rewrite
 from core.modelhelper import get_token_limit
+from core.promptpacker import PromptPacker
+from core.semanticcache import IndexSemanticCache, semantic_cache_scope
+from core.timing import StageTimer
 from text import nonewlines
 
+# Query rewrite modes, chosen with the "query_rewrite" override
+REWRITE_ALWAYS = "always"
+REWRITE_SKIP = "skip"
+REWRITE_SPECULATIVE = "speculative"
+
+# Completion sizes of the query rewrite and of the answer, reserved out of the model's token limit
+QUERY_MAX_TOKENS = 32
+ANSWER_MAX_TOKENS = 1024
+
 
 class ChatReadRetrieveReadApproach(ChatApproach):
     # Chat roles
@@ -48,7 +65,7 @@ If you cannot generate a search query, return just the number 0.
         {'role' : ASSISTANT, 'content' : 'Health plan cardio coverage' }
     ]
 
-    def __init__(self, search_client: SearchClient, chatgpt_deployment: str, chatgpt_model: str, embedding_deployment: str, sourcepage_field: str, content_field: str):
+    def __init__(self, search_client: SearchClient, chatgpt_deployment: str, chatgpt_model: str, embedding_deployment: str, sourcepage_field: str, content_field: str, admission: Optional[AdmissionController] = None, semantic_cache: Optional[IndexSemanticCache] = None, embedding_cache: Optional[EmbeddingCache] = None):
         self.search_client = search_client
         self.chatgpt_deployment = chatgpt_deployment
         self.chatgpt_model = chatgpt_model
@@ -56,77 +73,67 @@ If you cannot generate a search query, return just the number 0.
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
         self.chatgpt_token_limit = get_token_limit(chatgpt_model)
+        self.admission = admission or AdmissionController()
+        self.semantic_cache = semantic_cache
+        self.embedding_cache = embedding_cache
 
-    async def run(self, history: list[dict[str, str]], overrides: dict[str, Any]) -> Any:
+    async def run_until_final_call(self, history: list[dict[str, str]], overrides: dict[str, Any], should_stream: bool = False, timer: Optional[StageTimer] = None) -> tuple[dict[str, Any], Optional[Awaitable[Any]]]:
+        timer = timer or StageTimer()
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
-        has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
-        use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
-        top = overrides.get("top") or 3
-        exclude_category = overrides.get("exclude_category") or None
-        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
-
-        user_q = 'Generate search query for: ' + history[-1]["user"]
-
-        # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-        messages = self.get_messages_from_history(
-            self.query_prompt_template,
-            self.chatgpt_model,
-            history,
-            user_q,
-            self.query_prompt_few_shots,
-            self.chatgpt_token_limit - len(user_q)
-            )
+        question = history[-1]["user"]
 
-        chat_completion = await openai.ChatCompletion.acreate(
-            deployment_id=self.chatgpt_deployment,
-            model=self.chatgpt_model,
-            messages=messages,
-            temperature=0.0,
-            max_tokens=32,
-            n=1)
-
-        query_text = chat_completion.choices[0].message.content
-        if query_text.strip() == "0":
-            query_text = history[-1]["user"] # Use the last user input if we failed to generate a better query
+        # STEP 1: Generate an optimized keyword search query based on the chat history and the last question.
+        # "skip" searches the first question as asked, since there is no history to fold into it, and "speculative"
+        # searches the question while the rewrite runs, keeping those results if the rewrite doesn't change it
+        rewrite_mode = overrides.get("query_rewrite") or REWRITE_ALWAYS
+        speculation = None
+        if rewrite_mode == REWRITE_SKIP and len(history) == 1:
+            query_text = question
+            rewrite_outcome = "skipped"
+        else:
+            if rewrite_mode == REWRITE_SPECULATIVE:
+                speculation_timer = StageTimer()
+                speculation = asyncio.ensure_future(self.retrieve(question, overrides, speculation_timer))
+            try:
+                query_text = await self.rewrite_query(history, timer)
+            except BaseException:
+                if speculation:
+                    discard(speculation)
+                raise
+            rewrite_outcome = "rewritten"
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
-
-        # If retrieval mode includes vectors, compute an embedding for the query
-        if has_vector:
-            query_vector = (await openai.Embedding.acreate(engine=self.embedding_deployment, input=query_text))["data"][0]["embedding"]
+        results: Optional[list[str]] = None
+        if speculation and same_query(query_text, question):
+            query_vector, results = await speculation
+            timer.merge(speculation_timer)
+            rewrite_outcome = "speculation_used"
         else:
-            query_vector = None
+            if speculation:
+                discard(speculation)
+                timer.merge(speculation_timer, prefix="discarded_")
+                rewrite_outcome = "speculation_discarded"
+            query_vector = await self.compute_query_vector(query_text, overrides, timer)
+        observe_query_rewrite(rewrite_mode, rewrite_outcome)
+
+        # A paraphrase of a question answered recently gets the same answer, without searching or calling the model
+        # Only the first turn: later answers depend on the conversation, not just on the search query
+        semantic_cache_scope_key = semantic_cache_scope("chat_rrr", overrides)
+        use_semantic_cache = bool(query_vector is not None and self.semantic_cache and len(history) == 1)
+        if use_semantic_cache:
+            cached = self.semantic_cache.lookup(semantic_cache_scope_key, query_vector)
+            observe_cache("semantic", cached is not None)
+            if cached:
+                answer, similarity = cached
+                return {**answer, "semantic_cache": {"hit": True, "similarity": round(similarity, 4)}}, None
+
+        if results is None:
+            results = await self.search(query_text, query_vector, overrides, timer)
 
          # Only keep the text query if the retrieval mode uses text, otherwise drop it
         if not has_text:
             query_text = None
 
-        # Use semantic L2 reranker if requested and if retrieval mode is text or hybrid (vectors + text)
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(query_text,
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC,
-                                          query_language="en-us",
-                                          query_speller="lexicon",
-                                          semantic_configuration_name="default",
-                                          top=top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                                          vector=query_vector,
-                                          top_k=50 if query_vector else None,
-                                          vector_fields="embedding" if query_vector else None)
-        else:
-            r = await self.search_client.search(query_text,
-                                          filter=filter,
-                                          top=top,
-                                          vector=query_vector,
-                                          top_k=50 if query_vector else None,
-                                          vector_fields="embedding" if query_vector else None)
-        if use_semantic_captions:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) async for doc in r]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) async for doc in r]
-        content = "\n".join(results)
-
         follow_up_questions_prompt = self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else ""
 
         # STEP 3: Generate a contextual and content specific answer using the search results and chat history
@@ -140,46 +147,158 @@ If you cannot generate a search query, return just the number 0.
         else:
             system_message = prompt_override.format(follow_up_questions_prompt=follow_up_questions_prompt)
 
-        messages = self.get_messages_from_history(
-            system_message,
-            self.chatgpt_model,
-            history,
-            history[-1]["user"]+ "\n\nSources:\n" + content, # Model does not handle lengthy system messages well. Moving sources to latest user conversation to solve follow up questions prompt.
-            max_tokens=self.chatgpt_token_limit)
+        with timer.stage("prompt"):
+            # Model does not handle lengthy system messages well. Moving sources to latest user conversation to solve follow up questions prompt.
+            # The sources that fit the token budget come first, then as much history as is left room for
+            prompt = PromptPacker(self.chatgpt_model, ANSWER_MAX_TOKENS, self.chatgpt_token_limit).pack(system_message, history[-1]["user"], results, history)
+            messages = prompt.messages
+            results = prompt.sources
+
+        msg_to_display = '\n\n'.join([str(message) for message in messages])
 
-        chat_completion = await openai.ChatCompletion.acreate(
+        extra_info = {"data_points": results, "thoughts": f"Searched for:<br>{query_text}<br><br>Conversations:<br>" + msg_to_display.replace('\n', '<br>')}
+        chat_coroutine = openai.ChatCompletion.acreate(
             deployment_id=self.chatgpt_deployment,
             model=self.chatgpt_model,
             messages=messages,
             temperature=overrides.get("temperature") or 0.7,
-            max_tokens=1024,
-            n=1)
+            max_tokens=ANSWER_MAX_TOKENS,
+            n=1,
+            stream=should_stream)
+        if use_semantic_cache:
+            extra_info["semantic_cache"] = {"hit": False}
+            chat_coroutine = self.semantic_cache.remember(semantic_cache_scope_key, query_vector, extra_info, chat_coroutine, should_stream)
+        return extra_info, chat_coroutine
 
-        chat_content = chat_completion.choices[0].message.content
+    async def run(self, history: list[dict[str, str]], overrides: dict[str, Any]) -> Any:
+        timer = StageTimer()
+        extra_info, chat_coroutine = await self.run_until_final_call(history, overrides, should_stream=False, timer=timer)
+        if chat_coroutine is None:
+            return {**extra_info, "timings": timer.to_dict()}
+        with timer.stage("completion"):
+            async with self.admission.admit(CHAT):
+                chat_completion = await chat_coroutine
+        timer.add_usage("completion", chat_completion.get("usage"))
+        return {**extra_info, "answer": chat_completion.choices[0].message.content, "timings": timer.to_dict()}
 
-        msg_to_display = '\n\n'.join([str(message) for message in messages])
+    async def run_stream(self, history: list[dict[str, str]], overrides: dict[str, Any]) -> AsyncGenerator[dict, None]:
+        timer = StageTimer()
+        extra_info, chat_coroutine = await self.run_until_final_call(history, overrides, should_stream=True, timer=timer)
+        if chat_coroutine is None:
+            answer = extra_info.pop("answer")
+            yield extra_info
+            yield {"answer": answer}
+            yield {"timings": timer.to_dict()}
+            return
+        async with self.admission.admit(CHAT):
+            with timer.stage("completion_first_chunk"):
+                chat_completion = await chat_coroutine
+            # Sources and thoughts are known before the model starts answering, so send them first
+            yield extra_info
+            with timer.stage("completion_stream"):
+                async for chunk in chat_completion:
+                    # Azure OpenAI may send chunks without choices (e.g. prompt filter results)
+                    if chunk.choices and (content := chunk.choices[0].delta.get("content")):
+                        yield {"answer": content}
+        yield {"timings": timer.to_dict()}
+
+    async def rewrite_query(self, history: list[dict[str, str]], timer: StageTimer) -> str:
+        user_q = 'Generate search query for: ' + history[-1]["user"]
+        messages = self.get_messages_from_history(
+            self.query_prompt_template,
+            self.chatgpt_model,
+            history,
+            user_q,
+            self.query_prompt_few_shots,
+            self.chatgpt_token_limit - QUERY_MAX_TOKENS
+            )
 
-        return {"data_points": results, "answer": chat_content, "thoughts": f"Searched for:<br>{query_text}<br><br>Conversations:<br>" + msg_to_display.replace('\n', '<br>')}
+        with timer.stage("query_rewrite"):
+            async with self.admission.admit(CHAT):
+                chat_completion = await openai.ChatCompletion.acreate(
+                    deployment_id=self.chatgpt_deployment,
+                    model=self.chatgpt_model,
+                    messages=messages,
+                    temperature=0.0,
+                    max_tokens=QUERY_MAX_TOKENS,
+                    n=1)
+        timer.add_usage("query_rewrite", chat_completion.get("usage"))
 
-    def get_messages_from_history(self, system_prompt: str, model_id: str, history: list[dict[str, str]], user_conv: str, few_shots = [], max_tokens: int = 4096) -> list:
-        message_builder = MessageBuilder(system_prompt, model_id)
+        query_text = chat_completion.choices[0].message.content
+        if query_text.strip() == "0":
+            query_text = history[-1]["user"] # Use the last user input if we failed to generate a better query
+        return query_text
+
+    async def compute_query_vector(self, query_text: str, overrides: dict[str, Any], timer: StageTimer) -> Optional[list[float]]:
+        # If retrieval mode includes vectors, compute an embedding for the query
+        if overrides.get("retrieval_mode") in ["vectors", "hybrid", None]:
+            return await embed_query(query_text, self.embedding_deployment, self.admission, timer, self.embedding_cache)
+        return None
+
+    async def search(self, query_text: str, query_vector: Optional[list[float]], overrides: dict[str, Any], timer: StageTimer) -> list[str]:
+        has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
+        use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
+        top = overrides.get("top") or 3
+        exclude_category = overrides.get("exclude_category") or None
+        filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
+
+        # Only keep the text query if the retrieval mode uses text, otherwise drop it
+        search_text = query_text if has_text else None
 
+        # Diversified retrieval fuses its own text and vector searches, and picks sources that don't repeat each other
+        if overrides.get("diversify"):
+            with timer.stage("search"):
+                docs = await diversified_search(self.search_client, self.admission, search_text, query_vector, filter,
+                                                select_fields(self.sourcepage_field, self.content_field, overrides), top,
+                                                self.content_field, self.sourcepage_field, overrides.get("mmr_lambda") or MMR_LAMBDA)
+            return [citation(doc, self.sourcepage_field) + ": " + nonewlines(doc[self.content_field]) for doc in docs]
+
+        # Results are fetched lazily, so the search slot is held until they have all been read
+        async with self.admission.admit(SEARCH):
+            with timer.stage("search"):
+                # Use semantic L2 reranker if requested and if retrieval mode is text or hybrid (vectors + text)
+                if overrides.get("semantic_ranker") and has_text:
+                    r = await self.search_client.search(search_text,
+                                                  filter=filter,
+                                                  select=select_fields(self.sourcepage_field, self.content_field, overrides),
+                                                  query_type=QueryType.SEMANTIC,
+                                                  query_language="en-us",
+                                                  query_speller="lexicon",
+                                                  semantic_configuration_name="default",
+                                                  top=top,
+                                                  query_caption="extractive|highlight-false" if use_semantic_captions else None,
+                                                  vector=query_vector,
+                                                  top_k=50 if query_vector else None,
+                                                  vector_fields="embedding" if query_vector else None)
+                else:
+                    r = await self.search_client.search(search_text,
+                                                  filter=filter,
+                                                  select=select_fields(self.sourcepage_field, self.content_field, overrides),
+                                                  top=top,
+                                                  vector=query_vector,
+                                                  top_k=50 if query_vector else None,
+                                                  vector_fields="embedding" if query_vector else None)
+            with timer.stage("search_results"):
+                if use_semantic_captions:
+                    return [citation(doc, self.sourcepage_field) + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) async for doc in r]
+                return [citation(doc, self.sourcepage_field) + ": " + nonewlines(doc[self.content_field]) async for doc in r]
+
+    async def retrieve(self, query_text: str, overrides: dict[str, Any], timer: StageTimer) -> tuple[Optional[list[float]], list[str]]:
+        query_vector = await self.compute_query_vector(query_text, overrides, timer)
+        return query_vector, await self.search(query_text, query_vector, overrides, timer)
+
+    def get_messages_from_history(self, system_prompt: str, model_id: str, history: list[dict[str, str]], user_conv: str, few_shots = [], max_tokens: int = 4096) -> list:
         # Add examples to show the chat what responses we want. It will try to mimic any responses and make sure they match the rules laid out in the system message.
-        for shot in few_shots:
-            message_builder.append_message(shot.get('role'), shot.get('content'))
+        # History is added from the most recent turn back, for as long as the whole prompt stays within max_tokens
+        return PromptPacker(model_id, completion_tokens=0, token_limit=max_tokens).pack(system_prompt, user_conv, history=history, few_shots=few_shots).messages
 
-        user_content = user_conv
-        append_index = len(few_shots) + 1
 
-        message_builder.append_message(self.USER, user_content, index=append_index)
+def same_query(rewritten: str, question: str) -> bool:
+    """Whether the rewrite only changed case, punctuation or spacing, so the question's search results still apply."""
+    return re.findall(r"\w+", rewritten.lower()) == re.findall(r"\w+", question.lower())
 
-        for h in reversed(history[:-1]):
-            if bot_msg := h.get("bot"):
-                message_builder.append_message(self.ASSISTANT, bot_msg, index=append_index)
-            if user_msg := h.get("user"):
-                message_builder.append_message(self.USER, user_msg, index=append_index)
-            if message_builder.token_length > max_tokens:
-                break
 
-        messages = message_builder.messages
-        return messages
+def discard(task: asyncio.Future):
+    task.cancel()
+    # A speculative search that already failed shouldn't be logged as an unretrieved exception
+    task.add_done_callback(lambda done: done.cancelled() or done.exception())
@@ -11,20 +11,26 @@ from langchain.llms.openai import AzureOpenAI
 from langchain.prompts import BasePromptTemplate, PromptTemplate
 from langchain.tools.base import BaseTool
 
-from approaches.approach import AskApproach
-from langchainadapters import HtmlCallbackHandler
+from approaches.approach import AskApproach, citation, select_fields
+from core.admission import CHAT, SEARCH, AdmissionController
+from core.embeddingcache import EmbeddingCache, embed_query
+from core.timing import StageTimer
+from langchainadapters import HtmlCallbackHandler, TimingCallbackHandler
 from text import nonewlines
 
 
 class ReadDecomposeAsk(AskApproach):
-    def __init__(self, search_client: SearchClient, openai_deployment: str, embedding_deployment: str, sourcepage_field: str, content_field: str):
+    def __init__(self, search_client: SearchClient, openai_deployment: str, embedding_deployment: str, sourcepage_field: str, content_field: str, admission: Optional[AdmissionController] = None, embedding_cache: Optional[EmbeddingCache] = None):
         self.search_client = search_client
         self.openai_deployment = openai_deployment
         self.embedding_deployment = embedding_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.admission = admission or AdmissionController()
+        self.embedding_cache = embedding_cache
 
-    async def search(self, query_text: str, overrides: dict[str, Any]) -> tuple[list[str], str]:
+    async def search(self, query_text: str, overrides: dict[str, Any], timer: Optional[StageTimer] = None) -> tuple[list[str], str]:
+        timer = timer or StageTimer()
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
         use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
@@ -34,7 +40,7 @@ class ReadDecomposeAsk(AskApproach):
 
         # If retrieval mode includes vectors, compute an embedding for the query
         if has_vector:
-            query_vector = (await openai.Embedding.acreate(engine=self.embedding_deployment, input=query_text))["data"][0]["embedding"]
+            query_vector = await embed_query(query_text, self.embedding_deployment, self.admission, timer, self.embedding_cache)
         else:
             query_vector = None
 
@@ -42,62 +48,73 @@ class ReadDecomposeAsk(AskApproach):
         if not has_text:
             query_text = ""
 
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(query_text,
-                                          filter=filter,
+        # Results are fetched lazily, so the search slot is held until they have all been read
+        async with self.admission.admit(SEARCH):
+            with timer.stage("search"):
+                if overrides.get("semantic_ranker") and has_text:
+                    r = await self.search_client.search(query_text,
+                                                  filter=filter,
+                                                  select=select_fields(self.sourcepage_field, self.content_field, overrides),
+                                                  query_type=QueryType.SEMANTIC,
+                                                  query_language="en-us",
+                                                  query_speller="lexicon",
+                                                  semantic_configuration_name="default",
+                                                  top=top,
+                                                  query_caption="extractive|highlight-false" if use_semantic_captions else None,
+                                                  vector=query_vector,
+                                                  top_k=50 if query_vector else None,
+                                                  vector_fields="embedding" if query_vector else None)
+                else:
+                    r = await self.search_client.search(query_text,
+                                                  filter=filter,
+                                                  select=select_fields(self.sourcepage_field, self.content_field, overrides),
+                                                  top=top,
+                                                  vector=query_vector,
+                                                  top_k=50 if query_vector else None,
+                                                  vector_fields="embedding" if query_vector else None)
+            with timer.stage("search_results"):
+                if use_semantic_captions:
+                    results = [citation(doc, self.sourcepage_field) + ":" + nonewlines(" . ".join([c.text for c in doc['@search.captions'] ])) async for doc in r]
+                else:
+                    results = [citation(doc, self.sourcepage_field) + ":" + nonewlines(doc[self.content_field][:500]) async for doc in r]
+        return results, "\n".join(results)
+
+    async def lookup(self, q: str) -> Optional[str]:
+        async with self.admission.admit(SEARCH):
+            r = await self.search_client.search(q,
+                                          top = 1,
+                                          # "id" tells documents apart when a federated search fuses its indices' results
+                                          select=["id", self.content_field],
+                                          include_total_count=True,
                                           query_type=QueryType.SEMANTIC,
                                           query_language="en-us",
                                           query_speller="lexicon",
                                           semantic_configuration_name="default",
-                                          top=top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                                          vector=query_vector,
-                                          top_k=50 if query_vector else None,
-                                          vector_fields="embedding" if query_vector else None)
-        else:
-            r = await self.search_client.search(query_text,
-                                          filter=filter,
-                                          top=top,
-                                          vector=query_vector,
-                                          top_k=50 if query_vector else None,
-                                          vector_fields="embedding" if query_vector else None)
-        if use_semantic_captions:
-            results = [doc[self.sourcepage_field] + ":" + nonewlines(" . ".join([c.text for c in doc['@search.captions'] ])) async for doc in r]
-        else:
-            results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:500]) async for doc in r]
-        return results, "\n".join(results)
+                                          query_answer="extractive|count-1",
+                                          query_caption="extractive|highlight-false")
 
-    async def lookup(self, q: str) -> Optional[str]:
-        r = await self.search_client.search(q,
-                                      top = 1,
-                                      include_total_count=True,
-                                      query_type=QueryType.SEMANTIC,
-                                      query_language="en-us",
-                                      query_speller="lexicon",
-                                      semantic_configuration_name="default",
-                                      query_answer="extractive|count-1",
-                                      query_caption="extractive|highlight-false")
-
-        answers = await r.get_answers()
-        if answers and len(answers) > 0:
-            return answers[0].text
-        if await r.get_count() > 0:
-            return "\n".join([d['content'] async for d in r])
-        return None
+            answers = await r.get_answers()
+            if answers and len(answers) > 0:
+                return answers[0].text
+            if await r.get_count() > 0:
+                return "\n".join([d[self.content_field] async for d in r])
+            return None
 
     async def run(self, q: str, overrides: dict[str, Any]) -> Any:
 
+        timer = StageTimer()
         search_results = None
         async def search_and_store(q: str) -> Any:
             nonlocal search_results
-            search_results, content = await self.search(q, overrides)
+            search_results, content = await self.search(q, overrides, timer)
             return content
 
         # Use to capture thought process during iterations
         cb_handler = HtmlCallbackHandler()
         cb_manager = CallbackManager(handlers=[cb_handler])
 
-        llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key)
+        llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key,
+                          callbacks=[TimingCallbackHandler(timer)])
         tools = [
             Tool(name="Search", func=lambda _: 'Not implemented', coroutine=search_and_store, description="useful for when you need to ask with search", callbacks=cb_manager),
             Tool(name="Lookup", func=lambda _: 'Not implemented', coroutine=self.lookup, description="useful for when you need to ask with lookup", callbacks=cb_manager)
@@ -114,13 +131,16 @@ class ReadDecomposeAsk(AskApproach):
 
         agent = ReAct.from_llm_and_tools(llm, tools)
         chain = AgentExecutor.from_agent_and_tools(agent, tools, verbose=True, callback_manager=cb_manager)
-        result = await chain.arun(q)
+        # The agent calls the model several times, interleaved with its searches, so it holds a chat slot throughout
+        with timer.stage("agent"):
+            async with self.admission.admit(CHAT):
+                result = await chain.arun(q)
 
         # Replace substrings of the form <file.ext> with [file.ext] so that the frontend can render them as links, match them with a regex to avoid
         # generalizing too much and disrupt HTML snippets if present
         result = re.sub(r"<([a-zA-Z0-9_ \-\.]+)>", r"[\1]", result)
 
-        return {"data_points": search_results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log()}
+        return {"data_points": search_results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log(), "timings": timer.to_dict()}
 
 
 
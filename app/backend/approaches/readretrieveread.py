@@ -1,4 +1,4 @@
-from typing import Any
+from typing import Any, Optional
 
 import openai
 from azure.search.documents.aio import SearchClient
@@ -8,8 +8,11 @@ from langchain.callbacks.manager import CallbackManager, Callbacks
 from langchain.chains import LLMChain
 from langchain.llms.openai import AzureOpenAI
 
-from approaches.approach import AskApproach
-from langchainadapters import HtmlCallbackHandler
+from approaches.approach import AskApproach, citation, select_fields
+from core.admission import CHAT, SEARCH, AdmissionController
+from core.embeddingcache import EmbeddingCache, embed_query
+from core.timing import StageTimer
+from langchainadapters import HtmlCallbackHandler, TimingCallbackHandler
 from lookuptool import CsvLookupTool
 from text import nonewlines
 
@@ -47,14 +50,17 @@ Thought: {agent_scratchpad}"""
 
     CognitiveSearchToolDescription = "useful for searching the Microsoft employee benefits information such as healthcare plans, retirement plans, etc."
 
-    def __init__(self, search_client: SearchClient, openai_deployment: str, embedding_deployment: str, sourcepage_field: str, content_field: str):
+    def __init__(self, search_client: SearchClient, openai_deployment: str, embedding_deployment: str, sourcepage_field: str, content_field: str, admission: Optional[AdmissionController] = None, embedding_cache: Optional[EmbeddingCache] = None):
         self.search_client = search_client
         self.openai_deployment = openai_deployment
         self.embedding_deployment = embedding_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.admission = admission or AdmissionController()
+        self.embedding_cache = embedding_cache
 
-    async def retrieve(self, query_text: str, overrides: dict[str, Any]) -> Any:
+    async def retrieve(self, query_text: str, overrides: dict[str, Any], timer: Optional[StageTimer] = None) -> Any:
+        timer = timer or StageTimer()
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
         use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
@@ -64,7 +70,7 @@ Thought: {agent_scratchpad}"""
 
         # If retrieval mode includes vectors, compute an embedding for the query
         if has_vector:
-            query_vector = (await openai.Embedding.acreate(engine=self.embedding_deployment, input=query_text))["data"][0]["embedding"]
+            query_vector = await embed_query(query_text, self.embedding_deployment, self.admission, timer, self.embedding_cache)
         else:
             query_vector = None
 
@@ -72,39 +78,46 @@ Thought: {agent_scratchpad}"""
         if not has_text:
             query_text = ""
 
-        # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(query_text,
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC,
-                                          query_language="en-us",
-                                          query_speller="lexicon",
-                                          semantic_configuration_name="default",
-                                          top = top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                                          vector=query_vector,
-                                          top_k=50 if query_vector else None,
-                                          vector_fields="embedding" if query_vector else None)
-        else:
-            r = await self.search_client.search(query_text,
-                                          filter=filter,
-                                          top=top,
-                                          vector=query_vector,
-                                          top_k=50 if query_vector else None,
-                                          vector_fields="embedding" if query_vector else None)
-        if use_semantic_captions:
-            results = [doc[self.sourcepage_field] + ":" + nonewlines(" -.- ".join([c.text for c in doc['@search.captions']])) async for doc in r]
-        else:
-            results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:250]) async for doc in r]
+        # Results are fetched lazily, so the search slot is held until they have all been read
+        async with self.admission.admit(SEARCH):
+            with timer.stage("search"):
+                # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
+                if overrides.get("semantic_ranker") and has_text:
+                    r = await self.search_client.search(query_text,
+                                                  filter=filter,
+                                                  select=select_fields(self.sourcepage_field, self.content_field, overrides),
+                                                  query_type=QueryType.SEMANTIC,
+                                                  query_language="en-us",
+                                                  query_speller="lexicon",
+                                                  semantic_configuration_name="default",
+                                                  top = top,
+                                                  query_caption="extractive|highlight-false" if use_semantic_captions else None,
+                                                  vector=query_vector,
+                                                  top_k=50 if query_vector else None,
+                                                  vector_fields="embedding" if query_vector else None)
+                else:
+                    r = await self.search_client.search(query_text,
+                                                  filter=filter,
+                                                  select=select_fields(self.sourcepage_field, self.content_field, overrides),
+                                                  top=top,
+                                                  vector=query_vector,
+                                                  top_k=50 if query_vector else None,
+                                                  vector_fields="embedding" if query_vector else None)
+            with timer.stage("search_results"):
+                if use_semantic_captions:
+                    results = [citation(doc, self.sourcepage_field) + ":" + nonewlines(" -.- ".join([c.text for c in doc['@search.captions']])) async for doc in r]
+                else:
+                    results = [citation(doc, self.sourcepage_field) + ":" + nonewlines(doc[self.content_field][:250]) async for doc in r]
         content = "\n".join(results)
         return results, content
 
     async def run(self, q: str, overrides: dict[str, Any]) -> Any:
 
+        timer = StageTimer()
         retrieve_results = None
         async def retrieve_and_store(q: str) -> Any:
             nonlocal retrieve_results
-            retrieve_results, content = await self.retrieve(q, overrides)
+            retrieve_results, content = await self.retrieve(q, overrides, timer)
             return content
 
         # Use to capture thought process during iterations
@@ -124,19 +137,23 @@ Thought: {agent_scratchpad}"""
             prefix=overrides.get("prompt_template_prefix") or self.template_prefix,
             suffix=overrides.get("prompt_template_suffix") or self.template_suffix,
             input_variables = ["input", "agent_scratchpad"])
-        llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key)
+        llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key,
+                          callbacks=[TimingCallbackHandler(timer)])
         chain = LLMChain(llm = llm, prompt = prompt)
         agent_exec = AgentExecutor.from_agent_and_tools(
             agent = ZeroShotAgent(llm_chain = chain),
             tools = tools,
             verbose = True,
             callback_manager = cb_manager)
-        result = await agent_exec.arun(q)
+        # The agent calls the model several times, interleaved with its searches, so it holds a chat slot throughout
+        with timer.stage("agent"):
+            async with self.admission.admit(CHAT):
+                result = await agent_exec.arun(q)
 
         # Remove references to tool names that might be confused with a citation
         result = result.replace("[CognitiveSearch]", "").replace("[Employee]", "")
 
-        return {"data_points": retrieve_results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log()}
+        return {"data_points": retrieve_results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log(), "timings": timer.to_dict()}
 
 class EmployeeInfoTool(CsvLookupTool):
     employee_name: str = ""
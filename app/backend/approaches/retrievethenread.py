@@ -1,13 +1,22 @@
-from typing import Any
+from typing import Any, AsyncGenerator, Awaitable, Optional
 
 import openai
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import QueryType
 
-from approaches.approach import AskApproach
-from core.messagebuilder import MessageBuilder
+from approaches.approach import AskApproach, citation, select_fields
+from core.admission import CHAT, SEARCH, AdmissionController
+from core.diversify import MMR_LAMBDA, diversified_search
+from core.embeddingcache import EmbeddingCache, embed_query
+from core.metrics import observe_cache
+from core.promptpacker import PromptPacker
+from core.semanticcache import IndexSemanticCache, semantic_cache_scope
+from core.timing import StageTimer
 from text import nonewlines
 
+# Completion size of the answer, reserved out of the model's token limit
+ANSWER_MAX_TOKENS = 1024
+
 
 class RetrieveThenReadApproach(AskApproach):
     """
@@ -36,15 +45,19 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
 """
     answer = "In-network deductibles are $500 for employee and $1000 for family [info1.txt] and Overlake is in-network for the employee plan [info2.pdf][info4.pdf]."
 
-    def __init__(self, search_client: SearchClient, openai_deployment: str, chatgpt_model: str, embedding_deployment: str, sourcepage_field: str, content_field: str):
+    def __init__(self, search_client: SearchClient, openai_deployment: str, chatgpt_model: str, embedding_deployment: str, sourcepage_field: str, content_field: str, admission: Optional[AdmissionController] = None, semantic_cache: Optional[IndexSemanticCache] = None, embedding_cache: Optional[EmbeddingCache] = None):
         self.search_client = search_client
         self.openai_deployment = openai_deployment
         self.chatgpt_model = chatgpt_model
         self.embedding_deployment = embedding_deployment
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.admission = admission or AdmissionController()
+        self.semantic_cache = semantic_cache
+        self.embedding_cache = embedding_cache
 
-    async def run(self, q: str, overrides: dict[str, Any]) -> Any:
+    async def run_until_final_call(self, q: str, overrides: dict[str, Any], should_stream: bool = False, timer: Optional[StageTimer] = None) -> tuple[dict[str, Any], Optional[Awaitable[Any]]]:
+        timer = timer or StageTimer()
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
         use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
@@ -54,56 +67,113 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
 
         # If retrieval mode includes vectors, compute an embedding for the query
         if has_vector:
-            query_vector = (await openai.Embedding.acreate(engine=self.embedding_deployment, input=q))["data"][0]["embedding"]
+            query_vector = await embed_query(q, self.embedding_deployment, self.admission, timer, self.embedding_cache)
         else:
             query_vector = None
 
+        # A paraphrase of a question answered recently gets the same answer, without searching or calling the model
+        semantic_cache_scope_key = semantic_cache_scope("rtr", overrides)
+        use_semantic_cache = bool(query_vector is not None and self.semantic_cache)
+        if use_semantic_cache:
+            cached = self.semantic_cache.lookup(semantic_cache_scope_key, query_vector)
+            observe_cache("semantic", cached is not None)
+            if cached:
+                answer, similarity = cached
+                return {**answer, "semantic_cache": {"hit": True, "similarity": round(similarity, 4)}}, None
+
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         query_text = q if has_text else ""
 
-        # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(query_text,
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC,
-                                          query_language="en-us",
-                                          query_speller="lexicon",
-                                          semantic_configuration_name="default",
-                                          top=top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                                          vector=query_vector,
-                                          top_k=50 if query_vector else None,
-                                          vector_fields="embedding" if query_vector else None)
+        # Diversified retrieval fuses its own text and vector searches, and picks sources that don't repeat each other
+        if overrides.get("diversify"):
+            with timer.stage("search"):
+                docs = await diversified_search(self.search_client, self.admission, query_text, query_vector, filter,
+                                                select_fields(self.sourcepage_field, self.content_field, overrides), top,
+                                                self.content_field, self.sourcepage_field, overrides.get("mmr_lambda") or MMR_LAMBDA)
+            results = [citation(doc, self.sourcepage_field) + ": " + nonewlines(doc[self.content_field]) for doc in docs]
         else:
-            r = await self.search_client.search(query_text,
-                                          filter=filter,
-                                          top=top,
-                                          vector=query_vector,
-                                          top_k=50 if query_vector else None,
-                                          vector_fields="embedding" if query_vector else None)
-        if use_semantic_captions:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) async for doc in r]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) async for doc in r]
-        content = "\n".join(results)
-
-        message_builder = MessageBuilder(overrides.get("prompt_template") or self.system_chat_template, self.chatgpt_model)
-
-        # add user question
-        user_content = q + "\n" + f"Sources:\n {content}"
-        message_builder.append_message('user', user_content)
-
-        # Add shots/samples. This helps model to mimic response and make sure they match rules laid out in system message.
-        message_builder.append_message('assistant', self.answer)
-        message_builder.append_message('user', self.question)
-
-        messages = message_builder.messages
-        chat_completion = await openai.ChatCompletion.acreate(
+            # Results are fetched lazily, so the search slot is held until they have all been read
+            async with self.admission.admit(SEARCH):
+                with timer.stage("search"):
+                    # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
+                    if overrides.get("semantic_ranker") and has_text:
+                        r = await self.search_client.search(query_text,
+                                                      filter=filter,
+                                                      select=select_fields(self.sourcepage_field, self.content_field, overrides),
+                                                      query_type=QueryType.SEMANTIC,
+                                                      query_language="en-us",
+                                                      query_speller="lexicon",
+                                                      semantic_configuration_name="default",
+                                                      top=top,
+                                                      query_caption="extractive|highlight-false" if use_semantic_captions else None,
+                                                      vector=query_vector,
+                                                      top_k=50 if query_vector else None,
+                                                      vector_fields="embedding" if query_vector else None)
+                    else:
+                        r = await self.search_client.search(query_text,
+                                                      filter=filter,
+                                                      select=select_fields(self.sourcepage_field, self.content_field, overrides),
+                                                      top=top,
+                                                      vector=query_vector,
+                                                      top_k=50 if query_vector else None,
+                                                      vector_fields="embedding" if query_vector else None)
+                with timer.stage("search_results"):
+                    if use_semantic_captions:
+                        results = [citation(doc, self.sourcepage_field) + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) async for doc in r]
+                    else:
+                        results = [citation(doc, self.sourcepage_field) + ": " + nonewlines(doc[self.content_field]) async for doc in r]
+
+        with timer.stage("prompt"):
+            # Add shots/samples. This helps model to mimic response and make sure they match rules laid out in system message.
+            # The user question goes last, followed by as much of the sources as fits the model's token limit
+            few_shots = [{"role": "user", "content": self.question}, {"role": "assistant", "content": self.answer}]
+            prompt = PromptPacker(self.chatgpt_model, ANSWER_MAX_TOKENS).pack(
+                overrides.get("prompt_template") or self.system_chat_template, q, results, few_shots=few_shots, sources_prefix="\nSources:\n "
+            )
+            messages = prompt.messages
+            results = prompt.sources
+        extra_info = {"data_points": results, "thoughts": f"Question:<br>{query_text}<br><br>Prompt:<br>" + '\n\n'.join([str(message) for message in messages])}
+        chat_coroutine = openai.ChatCompletion.acreate(
             deployment_id=self.openai_deployment,
             model=self.chatgpt_model,
             messages=messages,
             temperature=overrides.get("temperature") or 0.3,
-            max_tokens=1024,
-            n=1)
+            max_tokens=ANSWER_MAX_TOKENS,
+            n=1,
+            stream=should_stream)
+        if use_semantic_cache:
+            extra_info["semantic_cache"] = {"hit": False}
+            chat_coroutine = self.semantic_cache.remember(semantic_cache_scope_key, query_vector, extra_info, chat_coroutine, should_stream)
+        return extra_info, chat_coroutine
 
-        return {"data_points": results, "answer": chat_completion.choices[0].message.content, "thoughts": f"Question:<br>{query_text}<br><br>Prompt:<br>" + '\n\n'.join([str(message) for message in messages])}
+    async def run(self, q: str, overrides: dict[str, Any]) -> Any:
+        timer = StageTimer()
+        extra_info, chat_coroutine = await self.run_until_final_call(q, overrides, should_stream=False, timer=timer)
+        if chat_coroutine is None:
+            return {**extra_info, "timings": timer.to_dict()}
+        with timer.stage("completion"):
+            async with self.admission.admit(CHAT):
+                chat_completion = await chat_coroutine
+        timer.add_usage("completion", chat_completion.get("usage"))
+        return {**extra_info, "answer": chat_completion.choices[0].message.content, "timings": timer.to_dict()}
+
+    async def run_stream(self, q: str, overrides: dict[str, Any]) -> AsyncGenerator[dict, None]:
+        timer = StageTimer()
+        extra_info, chat_coroutine = await self.run_until_final_call(q, overrides, should_stream=True, timer=timer)
+        if chat_coroutine is None:
+            answer = extra_info.pop("answer")
+            yield extra_info
+            yield {"answer": answer}
+            yield {"timings": timer.to_dict()}
+            return
+        async with self.admission.admit(CHAT):
+            with timer.stage("completion_first_chunk"):
+                chat_completion = await chat_coroutine
+            # Sources and thoughts are known before the model starts answering, so send them first
+            yield extra_info
+            with timer.stage("completion_stream"):
+                async for chunk in chat_completion:
+                    # Azure OpenAI may send chunks without choices (e.g. prompt filter results)
+                    if chunk.choices and (content := chunk.choices[0].delta.get("content")):
+                        yield {"answer": content}
+        yield {"timings": timer.to_dict()}
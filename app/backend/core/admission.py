@@ -0,0 +1,65 @@
+import asyncio
+import contextlib
+from collections import Counter
+from typing import AsyncIterator, Optional
+
+CHAT = "chat"
+EMBEDDINGS = "embeddings"
+SEARCH = "search"
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, upstream: str, retry_after: int):
+        super().__init__(f"Too many requests in flight to {upstream}, please retry in {retry_after} seconds")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Caps the number of calls each worker has in flight to an upstream service (chat, embeddings, search).
+    A call over the limit waits up to max_wait seconds for a slot and is then rejected with AdmissionRejected,
+    so a traffic spike is shed here instead of being turned into a wave of 429s and retries by the upstream.
+    Upstreams without a positive limit are not limited, so AdmissionController() admits everything.
+    """
+
+    def __init__(self, limits: Optional[dict[str, int]] = None, max_wait: float = 5.0, retry_after: int = 2):
+        self.semaphores = {upstream: asyncio.Semaphore(limit) for upstream, limit in (limits or {}).items() if limit > 0}
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.rejected: Counter[str] = Counter()
+
+    @contextlib.asynccontextmanager
+    async def admit(self, upstream: str) -> AsyncIterator[None]:
+        semaphore = self.semaphores.get(upstream)
+        if semaphore is None:
+            yield
+            return
+
+        await self._acquire(upstream, semaphore)
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    async def _acquire(self, upstream: str, semaphore: asyncio.Semaphore):
+        if not semaphore.locked():
+            await semaphore.acquire()
+            return
+
+        # Not wait_for: it can drop a slot that is granted just as the timeout fires
+        acquire = asyncio.ensure_future(semaphore.acquire())
+        try:
+            await asyncio.wait({acquire}, timeout=self.max_wait)
+        except asyncio.CancelledError:
+            if acquire.done() and not acquire.cancelled():
+                semaphore.release()
+            acquire.cancel()
+            raise
+        if not acquire.done():
+            acquire.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await acquire
+        if acquire.cancelled():
+            self.rejected[upstream] += 1
+            raise AdmissionRejected(upstream, self.retry_after)
@@ -0,0 +1,163 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Protocol, Sequence, Union
+
+# Overrides that select what is searched or what is reported, but not the answer itself; the index names are
+# part of the key on their own
+IGNORED_OVERRIDES = {"include_timings", "index_name", "index_names"}
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def answer_cache_key(kind: str, approach: str, index_names: Sequence[str], question: Union[str, list[dict[str, str]]], overrides: dict[str, Any]) -> str:
+    """
+    The key of an answer: the kind of request ("ask" or "chat"), the approach, the indices searched, the question
+    (or chat history) with case and whitespace normalized, and the overrides that can change the answer.
+    """
+    if isinstance(question, str):
+        normalized: Any = normalize(question)
+    else:
+        normalized = [{role: normalize(text) for role, text in turn.items() if text} for turn in question]
+    relevant_overrides = {name: value for name, value in overrides.items() if name not in IGNORED_OVERRIDES}
+    payload = json.dumps([kind, approach, list(index_names), normalized, relevant_overrides], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class AnswerCacheBackend(Protocol):
+    async def get(self, key: str) -> Optional[dict[str, Any]]:
+        ...
+
+    async def set(self, key: str, index_names: Sequence[str], value: dict[str, Any], ttl: float):
+        ...
+
+    async def invalidate(self, index_name: str) -> int:
+        ...
+
+    def close(self):
+        ...
+
+
+class MemoryAnswerCacheBackend:
+    """
+    Answers kept in this worker's memory, in least recently used order. Invalidation only reaches this worker, so
+    with several workers each one has to invalidate its own (the app does when it sees an index's version change).
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, tuple[float, frozenset[str], dict[str, Any]]] = OrderedDict()
+
+    async def get(self, key: str) -> Optional[dict[str, Any]]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[2]
+
+    async def set(self, key: str, index_names: Sequence[str], value: dict[str, Any], ttl: float):
+        self.entries[key] = (time.time() + ttl, frozenset(index_names), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def invalidate(self, index_name: str) -> int:
+        keys = [key for key, (_, index_names, _) in self.entries.items() if index_name in index_names]
+        for key in keys:
+            del self.entries[key]
+        return len(keys)
+
+    def close(self):
+        self.entries.clear()
+
+
+class SqliteAnswerCacheBackend:
+    """
+    Answers kept in a SQLite database on local disk, shared by all workers on the machine, so an answer computed
+    by one worker is served by the others and an upload invalidates the index for all of them. Queries run on a
+    thread, off the event loop.
+    """
+
+    def __init__(self, path: str, max_entries: int = 100000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, indices TEXT NOT NULL, value TEXT NOT NULL, expires REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS answers_last_used ON answers (last_used)")
+
+    async def get(self, key: str) -> Optional[dict[str, Any]]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, index_names: Sequence[str], value: dict[str, Any], ttl: float):
+        await asyncio.to_thread(self._set, key, index_names, value, ttl)
+
+    async def invalidate(self, index_name: str) -> int:
+        return await asyncio.to_thread(self._invalidate, index_name)
+
+    def close(self):
+        self.connection.close()
+
+    def _get(self, key: str) -> Optional[dict[str, Any]]:
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT value, expires FROM answers WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                self.connection.execute("DELETE FROM answers WHERE key = ?", (key,))
+                return None
+            self.connection.execute("UPDATE answers SET last_used = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def _set(self, key: str, index_names: Sequence[str], value: dict[str, Any], ttl: float):
+        now = time.time()
+        # Delimited on both sides, so invalidating "energy" can't match an index named "energy-2"
+        indices = "|" + "|".join(index_names) + "|"
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO answers (key, indices, value, expires, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, indices, json.dumps(value), now + ttl, now),
+            )
+            self.connection.execute("DELETE FROM answers WHERE expires <= ?", (now,))
+            self.connection.execute(
+                "DELETE FROM answers WHERE key IN (SELECT key FROM answers ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,)
+            )
+
+    def _invalidate(self, index_name: str) -> int:
+        with self.lock:
+            cursor = self.connection.execute("DELETE FROM answers WHERE instr(indices, ?) > 0", ("|" + index_name + "|",))
+        return cursor.rowcount
+
+
+class AnswerCache:
+    """Answers to repeated questions, expiring after ttl seconds, in a memory or SQLite backend."""
+
+    def __init__(self, backend: AnswerCacheBackend, ttl: float = 3600):
+        self.backend = backend
+        self.ttl = ttl
+
+    async def get(self, key: str) -> Optional[dict[str, Any]]:
+        return await self.backend.get(key)
+
+    async def set(self, key: str, index_names: Sequence[str], answer: dict[str, Any]):
+        # Timings and semantic cache hits describe the request that computed the answer, not the ones served from here
+        await self.backend.set(key, index_names, {name: value for name, value in answer.items() if name not in ("timings", "semantic_cache")}, self.ttl)
+
+    async def invalidate(self, index_name: str) -> int:
+        """Forget the answers that searched index_name, e.g. after documents were added to it."""
+        return await self.backend.invalidate(index_name)
+
+    def close(self):
+        self.backend.close()
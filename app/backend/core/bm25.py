@@ -0,0 +1,218 @@
+import math
+import os
+import re
+import threading
+from array import array
+from collections import Counter
+from typing import Any, Iterable, Optional
+
+import numpy as np
+
+# Okapi BM25 parameters, the defaults of Azure AI Search
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TOKEN = re.compile(r"\w+")
+FILTER_CLAUSE = re.compile(r"^\s*(\w+)\s+(eq|ne)\s+'((?:[^']|'')*)'\s*$")
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercased words, as Azure AI Search's standard analyzer splits text, without stemming or stop words."""
+    return TOKEN.findall(text.lower())
+
+
+class BM25Index:
+    """
+    A keyword index over the section documents indexer.create_sections produces, ranked with Okapi BM25, the
+    default similarity of Azure AI Search. Every term has its postings in two arrays of unsigned ints, the slots of
+    the documents that contain it and the term's frequency in each, 8 bytes a posting. Scoring a query adds up the
+    BM25 weight of its terms with NumPy over their postings only.
+
+    Documents are identified by their "id". Adding a document that exists replaces it, like upload_documents; a
+    removed document keeps its slot as a tombstone, and its postings are dropped once they are half of all postings.
+    Methods hold a lock, so the index can be searched on threads while sections are added.
+    """
+
+    def __init__(self, content_field: str = "content", k1: float = BM25_K1, b: float = BM25_B):
+        self.content_field = content_field
+        self.k1 = k1
+        self.b = b
+        self.documents: list[Optional[dict[str, Any]]] = []
+        self.slots: dict[str, int] = {}
+        self.postings: dict[str, tuple[array, array]] = {}
+        self.lengths = np.zeros(16, dtype=np.uint32)
+        self.live = np.zeros(16, dtype=bool)
+        self.total_length = 0
+        self.posting_count = 0
+        self.dead_posting_count = 0
+        self.lock = threading.RLock()
+        self._filter_masks: dict[str, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def add(self, sections: Iterable[dict[str, Any]]) -> list[int]:
+        """Index sections, replacing any with the same id, and return their slots."""
+        added = []
+        with self.lock:
+            self._filter_masks.clear()
+            for section in sections:
+                if section["id"] in self.slots:
+                    self._tombstone(self.slots.pop(section["id"]))
+                slot = len(self.documents)
+                self._reserve(slot + 1)
+                self.documents.append(section)
+                self.slots[section["id"]] = slot
+                counts = Counter(tokenize(self._content(section)))
+                for term, frequency in counts.items():
+                    slots, frequencies = self.postings.setdefault(term, (array("I"), array("I")))
+                    slots.append(slot)
+                    frequencies.append(frequency)
+                self.lengths[slot] = sum(counts.values())
+                self.live[slot] = True
+                self.total_length += int(self.lengths[slot])
+                self.posting_count += len(counts)
+                added.append(slot)
+            self._compact_if_sparse()
+        return added
+
+    def remove(self, ids: Iterable[str]) -> int:
+        """Remove the documents with these ids, and return how many there were."""
+        removed = 0
+        with self.lock:
+            self._filter_masks.clear()
+            for id in ids:
+                slot = self.slots.pop(id, None)
+                if slot is not None:
+                    self._tombstone(slot)
+                    removed += 1
+            self._compact_if_sparse()
+        return removed
+
+    def remove_sourcefile(self, filename: Optional[str]) -> int:
+        """Remove the sections of a file, or of all files when filename is None, as indexer.remove_from_index does."""
+        with self.lock:
+            sourcefile = None if filename is None else os.path.basename(filename)
+            ids = [doc["id"] for doc in self.documents if doc is not None and (sourcefile is None or doc.get("sourcefile") == sourcefile)]
+            return self.remove(ids)
+
+    def search(self, text: str, top: int = 50, allowed: Optional[np.ndarray] = None) -> list[tuple[int, float]]:
+        """The top (slot, score) matches of text, among the slots allowed when a mask is given."""
+        with self.lock:
+            count = len(self.documents)
+            if not self.slots:
+                return []
+            lengths = self.lengths[:count].astype(np.float32)
+            length_norm = self.k1 * (1 - self.b + self.b * lengths / max(self.total_length / len(self.slots), 1.0))
+            scores = np.zeros(count, dtype=np.float32)
+            for term in set(tokenize(text)):
+                if term in self.postings:
+                    self._add_term_scores(term, scores, length_norm)
+            mask = self.live[:count] if allowed is None else allowed[:count] & self.live[:count]
+            matches = np.flatnonzero((scores > 0) & mask)
+        top = min(top, len(matches))
+        if top == 0:
+            return []
+        best = matches[np.argpartition(-scores[matches], top - 1)[:top]]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return [(int(slot), float(scores[slot])) for slot in best]
+
+    def filter_mask(self, filter: Optional[str]) -> np.ndarray:
+        """
+        The slots of live documents that match an OData filter of "field eq 'value'" and "field ne 'value'"
+        clauses joined by "and", such as the category filter of the approaches.
+        """
+        with self.lock:
+            count = len(self.documents)
+            if not filter:
+                return self.live[:count].copy()
+            mask = self._filter_masks.get(filter)
+            if mask is None:
+                mask = self.live[:count].copy()
+                for clause in re.split(r"\s+and\s+", filter):
+                    match = FILTER_CLAUSE.match(clause)
+                    if not match:
+                        raise ValueError(f"Unsupported filter clause: {clause}")
+                    field, operator, value = match.group(1), match.group(2), match.group(3).replace("''", "'")
+                    equal = np.array([doc is not None and doc.get(field) == value for doc in self.documents], dtype=bool)
+                    mask &= equal if operator == "eq" else ~equal
+                self._filter_masks[filter] = mask
+            return mask
+
+    def compact(self):
+        """Drop the postings of removed documents."""
+        with self.lock:
+            for term in list(self.postings):
+                slots, frequencies = (np.frombuffer(postings, dtype=np.uintc) for postings in self.postings[term])
+                keep = self.live[slots]
+                if keep.all():
+                    continue
+                if keep.any():
+                    self.postings[term] = (array("I", slots[keep].tobytes()), array("I", frequencies[keep].tobytes()))
+                else:
+                    del self.postings[term]
+            self.posting_count -= self.dead_posting_count
+            self.dead_posting_count = 0
+
+    def save(self, path: str):
+        """Write the postings to an .npz file; the documents themselves are saved by their owner."""
+        with self.lock:
+            terms = list(self.postings)
+            offsets = np.cumsum([0] + [len(self.postings[term][0]) for term in terms])
+            np.savez(
+                path,
+                terms=np.frombuffer("\n".join(terms).encode("utf-8"), dtype=np.uint8),
+                offsets=offsets,
+                slots=np.concatenate([np.frombuffer(self.postings[term][0], dtype=np.uintc) for term in terms] or [np.zeros(0, dtype=np.uintc)]),
+                frequencies=np.concatenate([np.frombuffer(self.postings[term][1], dtype=np.uintc) for term in terms] or [np.zeros(0, dtype=np.uintc)]),
+                lengths=self.lengths[: len(self.documents)],
+                dead_posting_count=self.dead_posting_count,
+            )
+
+    @classmethod
+    def load(cls, path: str, documents: list[Optional[dict[str, Any]]], content_field: str = "content", **kwargs: Any) -> "BM25Index":
+        """Load postings written by save, for the documents they were saved with (None for removed ones)."""
+        index = cls(content_field, **kwargs)
+        with np.load(path) as saved:
+            terms = bytes(saved["terms"]).decode("utf-8").split("\n") if len(saved["terms"]) else []
+            offsets, slots, frequencies = saved["offsets"], saved["slots"].astype(np.uintc), saved["frequencies"].astype(np.uintc)
+            for term, start, end in zip(terms, offsets[:-1], offsets[1:]):
+                index.postings[term] = (array("I", slots[start:end].tobytes()), array("I", frequencies[start:end].tobytes()))
+            index._reserve(len(documents))
+            index.lengths[: len(documents)] = saved["lengths"]
+            index.posting_count = len(slots)
+            index.dead_posting_count = int(saved["dead_posting_count"])
+        index.documents = documents
+        for slot, doc in enumerate(documents):
+            if doc is not None:
+                index.slots[doc["id"]] = slot
+                index.live[slot] = True
+                index.total_length += int(index.lengths[slot])
+        return index
+
+    def _add_term_scores(self, term: str, scores: np.ndarray, length_norm: np.ndarray):
+        # The postings are viewed in place, and the views must be gone before the arrays can grow again
+        slots, frequencies = (np.frombuffer(postings, dtype=np.uintc) for postings in self.postings[term])
+        document_frequency = int(np.count_nonzero(self.live[slots]))
+        idf = math.log(1 + (len(self.slots) - document_frequency + 0.5) / (document_frequency + 0.5))
+        frequencies = frequencies.astype(np.float32)
+        scores[slots] += idf * frequencies * (self.k1 + 1) / (frequencies + length_norm[slots])
+
+    def _content(self, doc: dict[str, Any]) -> str:
+        return str(doc.get(self.content_field) or "")
+
+    def _tombstone(self, slot: int):
+        self.dead_posting_count += len(set(tokenize(self._content(self.documents[slot]))))
+        self.total_length -= int(self.lengths[slot])
+        self.documents[slot] = None
+        self.live[slot] = False
+
+    def _compact_if_sparse(self):
+        if self.dead_posting_count * 2 > self.posting_count:
+            self.compact()
+
+    def _reserve(self, count: int):
+        if count > len(self.live):
+            capacity = max(count, 2 * len(self.live))
+            self.lengths = np.concatenate([self.lengths, np.zeros(capacity - len(self.lengths), dtype=np.uint32)])
+            self.live = np.concatenate([self.live, np.zeros(capacity - len(self.live), dtype=bool)])
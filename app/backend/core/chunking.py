@@ -0,0 +1,249 @@
+from bisect import bisect_right
+from functools import lru_cache
+from typing import Iterator, Optional, Sequence
+
+import numpy as np
+import tiktoken
+
+MAX_SECTION_LENGTH = 1000
+SENTENCE_SEARCH_LIMIT = 100
+SECTION_OVERLAP = 100
+
+# Sizes of the sections split_pages_by_tokens makes, in tokens of the embedding model
+EMBEDDING_MODEL = "text-embedding-ada-002"
+MAX_SECTION_TOKENS = 500
+SENTENCE_SEARCH_TOKENS = 50
+SECTION_OVERLAP_TOKENS = 50
+
+SENTENCE_ENDINGS = [".", "!", "?"]
+WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
+
+# (page number, offset of the page in the document, page text), as get_document_text returns them
+PageMap = Sequence[tuple[int, int, str]]
+
+
+class TextBoundaries:
+    """
+    The positions of every sentence ending and word break in a text, found in one vectorized pass over its code
+    points, so the nearest boundary to an offset is a binary search instead of a walk over the characters.
+    """
+
+    def __init__(self, text: str):
+        code_points = np.frombuffer(text.encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+        self.sentence_endings = np.flatnonzero(np.isin(code_points, [ord(c) for c in SENTENCE_ENDINGS]))
+        self.word_breaks = np.flatnonzero(np.isin(code_points, [ord(c) for c in WORDS_BREAKS]))
+
+    def first_sentence_ending(self, low: int, high: int) -> Optional[int]:
+        """The first sentence ending at or after low and before high."""
+        index = np.searchsorted(self.sentence_endings, low)
+        return int(self.sentence_endings[index]) if index < len(self.sentence_endings) and self.sentence_endings[index] < high else None
+
+    def last_sentence_ending(self, low: int, high: int) -> Optional[int]:
+        """The last sentence ending after low and at or before high."""
+        index = np.searchsorted(self.sentence_endings, high, side="right") - 1
+        return int(self.sentence_endings[index]) if index >= 0 and self.sentence_endings[index] > low else None
+
+    def first_word_break(self, low: int, high: int) -> Optional[int]:
+        """The first word break after low and at or before high."""
+        index = np.searchsorted(self.word_breaks, low, side="right")
+        return int(self.word_breaks[index]) if index < len(self.word_breaks) and self.word_breaks[index] <= high else None
+
+    def last_word_break(self, low: int, high: int) -> Optional[int]:
+        """The last word break at or after low and before high."""
+        index = np.searchsorted(self.word_breaks, high) - 1
+        return int(self.word_breaks[index]) if index >= 0 and self.word_breaks[index] >= low else None
+
+
+def split_pages(page_map: PageMap, verbose: bool = False) -> Iterator[tuple[str, int]]:
+    """
+    Split the text of a document into overlapping sections of about MAX_SECTION_LENGTH characters, yielding each with
+    the page it starts on. Sections end at the end of a sentence within SENTENCE_SEARCH_LIMIT characters past the
+    maximum length, or else at a word break, and start at the start of a sentence or word; a section that ends
+    inside a table is followed by one that starts with the table.
+
+    Sentence endings and word breaks come from TextBoundaries, and the page of an offset from a binary search over
+    the page offsets, so a document is split in time linear in its length whatever its number of pages.
+    """
+    page_offsets = [offset for _, offset, _ in page_map]
+
+    def find_page(offset: int) -> int:
+        page = bisect_right(page_offsets, offset) - 1
+        return page if page >= 0 else len(page_map) - 1
+
+    all_text = "".join(page_text for _, _, page_text in page_map)
+    boundaries = TextBoundaries(all_text)
+    length = len(all_text)
+    start = 0
+    end = length
+    previous_start, previous_end = -1, 0
+    while start + SECTION_OVERLAP < length:
+        last_word = -1
+        end = start + MAX_SECTION_LENGTH
+
+        if end > length:
+            end = length
+        else:
+            # Try to find the end of the sentence
+            search_end = min(length, start + MAX_SECTION_LENGTH + SENTENCE_SEARCH_LIMIT)
+            sentence_end = boundaries.first_sentence_ending(end, search_end)
+            if sentence_end is None:
+                word_end = boundaries.last_word_break(end, search_end)
+                last_word = word_end if word_end is not None else -1
+                end = search_end
+            else:
+                end = sentence_end
+            if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
+                end = last_word  # Fall back to at least keeping a whole word
+        if end < length:
+            end += 1
+
+        # Try to find the start of the sentence or at least a whole word boundary
+        last_word = -1
+        search_start = max(0, end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT)
+        if start > search_start:
+            sentence_start = boundaries.last_sentence_ending(search_start, start)
+            stop = sentence_start if sentence_start is not None else search_start
+            word_start = boundaries.first_word_break(stop, start)
+            last_word = word_start if word_start is not None else -1
+            start = stop
+        if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
+            start = last_word
+        if start > 0:
+            start += 1
+        if start <= previous_start:
+            # Backing up to a sentence start after an unclosed table can land on the previous section's start, which
+            # would repeat that section forever; continue after it instead
+            start = previous_end
+        previous_start, previous_end = start, end
+
+        section_text = all_text[start:end]
+        yield (section_text, find_page(start))
+
+        last_table_start = section_text.rfind("<table")
+        if (last_table_start > 2 * SENTENCE_SEARCH_LIMIT and last_table_start > section_text.rfind("</table")):
+            # If the section ends with an unclosed table, we need to start the next section with the table.
+            # If table starts inside SENTENCE_SEARCH_LIMIT, we ignore it, as that will cause an infinite loop for tables longer than MAX_SECTION_LENGTH
+            # If last table starts inside SECTION_OVERLAP, keep overlapping
+            if verbose: print(f"Section ends with unclosed table, starting next section with the table at page {find_page(start)} offset {start} table start {last_table_start}")
+            start = min(end - SECTION_OVERLAP, start + last_table_start)
+        else:
+            start = end - SECTION_OVERLAP
+
+    if start + SECTION_OVERLAP < end:
+        yield (all_text[start:end], find_page(start))
+
+
+def check_section_tokens(max_tokens: int, overlap_tokens: int, sentence_search_tokens: int = SENTENCE_SEARCH_TOKENS):
+    """Raise ValueError unless split_pages_by_tokens can make progress with these sizes."""
+    if overlap_tokens < 0 or sentence_search_tokens < 0:
+        raise ValueError("overlap_tokens and sentence_search_tokens can't be negative")
+    if max_tokens <= overlap_tokens + 2 * sentence_search_tokens:
+        raise ValueError(f"max_tokens ({max_tokens}) must be more than overlap_tokens ({overlap_tokens}) plus twice sentence_search_tokens ({sentence_search_tokens})")
+
+
+@lru_cache(maxsize=None)
+def get_embedding_encoding(model: str = EMBEDDING_MODEL) -> tiktoken.Encoding:
+    """The tiktoken encoding of an embedding model, resolved once per model."""
+    return tiktoken.encoding_for_model(model)
+
+
+def token_offsets(page_map: PageMap, encoding: tiktoken.Encoding) -> np.ndarray:
+    """
+    The offset in the document of the first character of each of its tokens, then the length of the document.
+    Each page is encoded once, and a token that ends inside a character (part of an emoji, say) is counted as ending
+    after it.
+    """
+    token_lengths: dict[int, int] = {}
+    offsets = [np.zeros(1, dtype=np.int64)]
+    page_offset = 0
+    for _, _, page_text in page_map:
+        tokens = encoding.encode_ordinary(page_text)
+        byte_lengths = np.fromiter(
+            (token_lengths[token] if token in token_lengths else token_lengths.setdefault(token, len(encoding.decode_single_token_bytes(token))) for token in tokens),
+            dtype=np.int64,
+            count=len(tokens),
+        )
+        code_points = np.frombuffer(page_text.encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+        char_lengths = 1 + (code_points >= 0x80).astype(np.int64) + (code_points >= 0x800) + (code_points >= 0x10000)
+        char_byte_offsets = np.concatenate(([0], np.cumsum(char_lengths)))
+        offsets.append(page_offset + np.searchsorted(char_byte_offsets, np.cumsum(byte_lengths)))
+        page_offset += len(page_text)
+    return np.concatenate(offsets)
+
+
+def split_pages_by_tokens(
+    page_map: PageMap,
+    encoding: Optional[tiktoken.Encoding] = None,
+    max_tokens: int = MAX_SECTION_TOKENS,
+    overlap_tokens: int = SECTION_OVERLAP_TOKENS,
+    sentence_search_tokens: int = SENTENCE_SEARCH_TOKENS,
+    verbose: bool = False,
+) -> Iterator[tuple[str, int]]:
+    """
+    Split the text of a document into sections of at most max_tokens tokens of encoding (the embedding model's by
+    default), overlapping by about overlap_tokens, yielding each with the page it starts on. Sections end after the
+    last sentence ending in their final sentence_search_tokens tokens, or else after the last word break, and start
+    at the start of a sentence or word within sentence_search_tokens tokens before the overlap; a section that ends
+    inside a table is followed by one that starts with the table, as in split_pages.
+
+    The pages are encoded once and sections sized by slicing their token offsets, so no candidate section is
+    encoded again.
+    """
+    check_section_tokens(max_tokens, overlap_tokens, sentence_search_tokens)
+    encoding = encoding or get_embedding_encoding()
+    page_offsets = [offset for _, offset, _ in page_map]
+
+    def find_page(offset: int) -> int:
+        page = bisect_right(page_offsets, offset) - 1
+        return page if page >= 0 else len(page_map) - 1
+
+    all_text = "".join(page_text for _, _, page_text in page_map)
+    boundaries = TextBoundaries(all_text)
+    offsets = token_offsets(page_map, encoding)
+    num_tokens = len(offsets) - 1
+    length = len(all_text)
+
+    def token_at(offset: int) -> int:
+        return int(np.searchsorted(offsets, offset, side="right")) - 1
+
+    start = 0
+    while start < length:
+        first_token = token_at(start)
+        end_token = first_token + max_tokens
+        if end_token >= num_tokens:
+            end = length
+        else:
+            end = int(offsets[end_token])
+            # End after the last sentence, or at least the last whole word, in the final tokens of the section
+            search_start = max(start, int(offsets[end_token - sentence_search_tokens]))
+            sentence_end = boundaries.last_sentence_ending(search_start - 1, end - 1)
+            word_end = boundaries.last_word_break(search_start, end) if sentence_end is None else None
+            if sentence_end is not None:
+                end = sentence_end + 1
+            elif word_end is not None:
+                end = word_end + 1
+
+        section_text = all_text[start:end]
+        yield (section_text, find_page(start))
+        if end >= length:
+            break
+
+        # Overlap the next section by overlap_tokens, moved back to the start of a sentence or at least a whole word
+        overlap_token = token_at(end) - overlap_tokens
+        next_start = int(offsets[overlap_token])
+        search_start = int(offsets[max(0, overlap_token - sentence_search_tokens)])
+        sentence_start = boundaries.last_sentence_ending(search_start - 1, next_start - 1)
+        word_start = boundaries.first_word_break(search_start - 1, next_start - 1) if sentence_start is None else None
+        if sentence_start is not None:
+            next_start = sentence_start + 1
+        elif word_start is not None:
+            next_start = word_start + 1
+
+        last_table_start = section_text.rfind("<table")
+        table_search_limit = int(offsets[min(num_tokens, first_token + 2 * sentence_search_tokens)]) - start
+        if last_table_start > table_search_limit and last_table_start > section_text.rfind("</table"):
+            # As in split_pages, tables starting in the first 2 * sentence_search_tokens tokens are ignored so tables
+            # longer than a section can't loop forever, and a table starting inside the overlap keeps overlapping
+            if verbose: print(f"Section ends with unclosed table, starting next section with the table at page {find_page(start)} offset {start} table start {last_table_start}")
+            next_start = min(next_start, start + last_table_start)
+        start = next_start
@@ -0,0 +1,101 @@
+import hashlib
+import os
+import tempfile
+from typing import AsyncGenerator, AsyncIterator, Optional
+
+import aiofiles
+
+TEMP_SUFFIX = ".tmp"
+
+
+class ContentCache:
+    """
+    A size-bounded cache of blob content on local disk, keyed by index name, blob path and ETag.
+    Since the ETag is part of the key, a blob that changes in storage is simply a different entry and stale
+    versions age out. Recency is tracked with file modification times, so every worker process sharing the
+    directory evicts in the same least-recently-used order.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_entry_bytes: Optional[int] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_bytes // 4 if max_entry_bytes is None else max_entry_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def entry_path(self, index_name: str, path: str, etag: str) -> str:
+        key = hashlib.sha256(f"{index_name}\0{path}\0{etag}".encode()).hexdigest()
+        return os.path.join(self.directory, key)
+
+    async def read(self, index_name: str, path: str, etag: str, offset: int, length: int, chunk_size: int) -> Optional[AsyncGenerator[bytes, None]]:
+        """
+        Open the cached file, mark it as recently used and return its bytes from offset to offset + length in chunks,
+        or None on a miss. The file is opened before returning, so it stays readable even if another request evicts
+        it before it's sent.
+        """
+        entry_path = self.entry_path(index_name, path, etag)
+        try:
+            os.utime(entry_path)
+            f = await aiofiles.open(entry_path, "rb")
+        except FileNotFoundError:
+            return None
+        return read_chunks(f, offset, length, chunk_size)
+
+    def accepts(self, size: int) -> bool:
+        return 0 < size <= self.max_entry_bytes
+
+    async def store(self, index_name: str, path: str, etag: str, chunks: AsyncIterator[bytes]) -> AsyncGenerator[bytes, None]:
+        """
+        Pass chunks through unchanged while writing them to the cache. The entry is published with an atomic
+        rename once the whole blob has been written, so readers never see a partial file, and it's discarded
+        if the stream is abandoned (e.g. the client disconnects).
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=TEMP_SUFFIX)
+        try:
+            async with aiofiles.open(fd, "wb") as f:
+                async for chunk in chunks:
+                    await f.write(chunk)
+                    yield chunk
+            os.replace(temp_path, self.entry_path(index_name, path, etag))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(TEMP_SUFFIX):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue  # Evicted concurrently by another worker
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        if total <= self.max_bytes:
+            return
+        for _, size, entry_path in sorted(entries):
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+
+async def read_chunks(f, offset: int, length: int, chunk_size: int) -> AsyncGenerator[bytes, None]:
+    try:
+        await f.seek(offset)
+        while length > 0:
+            chunk = await f.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        await f.close()
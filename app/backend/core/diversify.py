@@ -0,0 +1,154 @@
+import asyncio
+import re
+from typing import Any, Optional, Sequence
+
+import numpy as np
+
+from core.admission import SEARCH, AdmissionController
+from core.fusion import reciprocal_rank_scores
+
+# Candidates fetched by each of the text and vector searches, per source the prompt gets
+CANDIDATES_PER_SOURCE = 4
+MIN_CANDIDATES = 20
+# Weight of relevance against novelty when picking sources; 1 ranks by relevance alone
+MMR_LAMBDA = 0.7
+# Adjacent sections that share fewer characters than this are joined as they are, in case the match is a coincidence
+MIN_OVERLAP_CHARS = 20
+
+# Sections are numbered in file order by indexer.create_sections, with ids like "<file id>-page-<number>"
+SECTION_ID = re.compile(r"^(.*)-page-(\d+)$")
+
+
+async def diversified_search(
+    search_client: Any,
+    admission: AdmissionController,
+    search_text: Optional[str],
+    query_vector: Optional[list[float]],
+    filter: Optional[str],
+    select: list[str],
+    top: int,
+    content_field: str,
+    sourcepage_field: str,
+    mmr_lambda: float = MMR_LAMBDA,
+) -> list[dict[str, Any]]:
+    """
+    Retrieve top sources that say different things. The text and vector searches each fetch a pool of candidates,
+    with their embeddings, and run concurrently; their rankings are fused with reciprocal rank fusion, and
+    diversify picks the sources from the fused pool. This replaces the service's hybrid ranking, and the semantic
+    ranker, whose captions the sources then don't have.
+    """
+    candidates = max(top * CANDIDATES_PER_SOURCE, MIN_CANDIDATES)
+    select = select if "embedding" in select else [*select, "embedding"]
+
+    async def ranked(**kwargs: Any) -> list[dict[str, Any]]:
+        # Results are fetched lazily, so the search slot is held until they have all been read
+        async with admission.admit(SEARCH):
+            return [doc async for doc in await search_client.search(filter=filter, select=select, top=candidates, **kwargs)]
+
+    searches = []
+    if search_text:
+        searches.append(ranked(search_text=search_text))
+    if query_vector is not None:
+        searches.append(ranked(search_text=None, vector=query_vector, top_k=candidates, vector_fields="embedding"))
+    return diversify(await asyncio.gather(*searches), top, content_field, sourcepage_field, mmr_lambda)
+
+
+def diversify(
+    ranked_lists: Sequence[Sequence[dict[str, Any]]], top: int, content_field: str, sourcepage_field: str, mmr_lambda: float = MMR_LAMBDA
+) -> list[dict[str, Any]]:
+    """
+    Pick top sources out of ranked lists of candidates: candidates are fused with reciprocal rank fusion, ordered by
+    maximal marginal relevance over their embeddings, and taken in that order, merging adjacent sections of a page
+    into one source, until there are top sources.
+    """
+    scores, docs = reciprocal_rank_scores(ranked_lists, key=lambda doc: (doc.get("@search.index"), doc["id"]))
+    keys = sorted(docs, key=lambda doc_key: scores[doc_key], reverse=True)
+    if not keys:
+        return []
+    candidates = [docs[doc_key] for doc_key in keys]
+    relevance = np.array([scores[doc_key] for doc_key in keys])
+    order = maximal_marginal_relevance(relevance / relevance.max(), embedding_matrix(candidates), len(candidates), mmr_lambda)
+    for count in range(min(top, len(order)), len(order) + 1):
+        sources = merge_adjacent([candidates[index] for index in order[:count]], content_field, sourcepage_field)
+        if len(sources) >= top:
+            break
+    return sources
+
+
+def maximal_marginal_relevance(relevance: np.ndarray, vectors: np.ndarray, count: int, mmr_lambda: float = MMR_LAMBDA) -> list[int]:
+    """
+    The indices of count rows of vectors, picked one at a time for the highest mmr_lambda * relevance minus
+    (1 - mmr_lambda) * the greatest cosine similarity to a row already picked.
+    """
+    similarity = vectors @ vectors.T
+    redundancy = np.zeros(len(vectors))
+    picked = np.zeros(len(vectors), dtype=bool)
+    order = []
+    for _ in range(min(count, len(vectors))):
+        scores = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+        scores[picked] = -np.inf
+        index = int(np.argmax(scores))
+        order.append(index)
+        picked[index] = True
+        redundancy = np.maximum(redundancy, similarity[index])
+    return order
+
+
+def embedding_matrix(docs: Sequence[dict[str, Any]]) -> np.ndarray:
+    # Documents without an embedding get a zero row, similar to nothing
+    dimensions = next((len(doc["embedding"]) for doc in docs if doc.get("embedding")), 1)
+    vectors = np.zeros((len(docs), dimensions), dtype=np.float32)
+    for row, doc in enumerate(docs):
+        if doc.get("embedding"):
+            vectors[row] = doc["embedding"]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def merge_adjacent(docs: Sequence[dict[str, Any]], content_field: str, sourcepage_field: str) -> list[dict[str, Any]]:
+    """
+    Merge sections that follow each other in a file and cite the same page into a single source, in the rank of the
+    best of them, without repeating the text consecutive sections overlap by.
+    """
+    groups: list[Optional[list[tuple[int, dict[str, Any]]]]] = []
+    group_of: dict[tuple[Any, ...], int] = {}
+    for doc in docs:
+        match = SECTION_ID.match(str(doc.get("id", "")))
+        if not match:
+            groups.append([(0, doc)])
+            continue
+        file_key = (doc.get("@search.index"), match.group(1), doc.get(sourcepage_field))
+        number = int(match.group(2))
+        neighbours = sorted({group_of[(*file_key, n)] for n in (number - 1, number + 1) if (*file_key, n) in group_of})
+        target = neighbours[0] if neighbours else len(groups)
+        if not neighbours:
+            groups.append([])
+        # A section between two groups joins them
+        for other in neighbours[1:]:
+            for member_number, _ in groups[other]:
+                group_of[(*file_key, member_number)] = target
+            groups[target].extend(groups[other])
+            groups[other] = None
+        groups[target].append((number, doc))
+        group_of[(*file_key, number)] = target
+
+    merged = []
+    for group in groups:
+        if group is None:
+            continue
+        best = group[0][1]
+        if len(group) > 1:
+            contents = [str(doc.get(content_field) or "") for _, doc in sorted(group, key=lambda member: member[0])]
+            content = contents[0]
+            for following in contents[1:]:
+                content = join_overlapping(content, following)
+            best = {**best, content_field: content}
+        merged.append(best)
+    return merged
+
+
+def join_overlapping(first: str, second: str) -> str:
+    for size in range(min(len(first), len(second)), MIN_OVERLAP_CHARS - 1, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return first + " " + second
@@ -0,0 +1,117 @@
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+import numpy as np
+import openai
+
+from core.admission import EMBEDDINGS, AdmissionController
+from core.metrics import observe_cache
+from core.timing import StageTimer
+
+
+class SqliteEmbeddingStore:
+    """
+    Embeddings kept in a SQLite database on local disk as raw float32 bytes, so they survive worker restarts and
+    are shared by all workers on the machine. Embeddings never go stale for a given deployment, so rows are only
+    removed when the store outgrows max_entries, oldest first. Queries run on a thread, off the event loop.
+    """
+
+    def __init__(self, path: str, max_entries: int = 100000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (deployment TEXT NOT NULL, text TEXT NOT NULL, vector BLOB NOT NULL, PRIMARY KEY (deployment, text))"
+        )
+
+    async def get(self, deployment: str, text: str) -> Optional[np.ndarray]:
+        return await asyncio.to_thread(self._get, deployment, text)
+
+    async def set(self, deployment: str, text: str, vector: np.ndarray):
+        await asyncio.to_thread(self._set, deployment, text, vector)
+
+    def close(self):
+        self.connection.close()
+
+    def _get(self, deployment: str, text: str) -> Optional[np.ndarray]:
+        with self.lock:
+            row = self.connection.execute("SELECT vector FROM embeddings WHERE deployment = ? AND text = ?", (deployment, text)).fetchone()
+        return np.frombuffer(row[0], dtype=np.float32) if row else None
+
+    def _set(self, deployment: str, text: str, vector: np.ndarray):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO embeddings (deployment, text, vector) VALUES (?, ?, ?)", (deployment, text, vector.tobytes()))
+            self.connection.execute(
+                "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY rowid DESC LIMIT -1 OFFSET ?)", (self.max_entries,)
+            )
+
+
+class EmbeddingCache:
+    """
+    Query embeddings by deployment and text, shared by all approaches, so a question or agent search term that
+    comes back seconds later isn't embedded again. Vectors are kept as float32 arrays (6 KB for ada-002, a quarter
+    of a list of Python floats), the max_entries most recently used in memory, and optionally all of them in a
+    SqliteEmbeddingStore behind it. Concurrent requests for the same embedding share a single call.
+    """
+
+    def __init__(self, max_entries: int = 4096, store: Optional[SqliteEmbeddingStore] = None):
+        self.max_entries = max_entries
+        self.store = store
+        self.vectors: OrderedDict[tuple[str, str], np.ndarray] = OrderedDict()
+        self.pending: dict[tuple[str, str], asyncio.Future] = {}
+
+    async def get_or_create(self, deployment: str, text: str, create: Callable[[], Awaitable[list[float]]]) -> list[float]:
+        key = (deployment, text)
+        vector = self.vectors.get(key)
+        if vector is not None:
+            self.vectors.move_to_end(key)
+            observe_cache("embedding", True)
+            return vector.tolist()
+
+        # The embedding is computed in a task of its own, so a requester that goes away doesn't cancel it for the others
+        task = self.pending.get(key)
+        if task is None:
+            task = self.pending[key] = asyncio.ensure_future(self._load(key, create))
+            task.add_done_callback(lambda done: self._forget_pending(key, done))
+        else:
+            observe_cache("embedding", True)
+        return (await asyncio.shield(task)).tolist()
+
+    async def _load(self, key: tuple[str, str], create: Callable[[], Awaitable[list[float]]]) -> np.ndarray:
+        vector = await self.store.get(*key) if self.store else None
+        observe_cache("embedding", vector is not None)
+        if vector is None:
+            vector = np.asarray(await create(), dtype=np.float32)
+            if self.store:
+                await self.store.set(*key, vector)
+        self.vectors[key] = vector
+        while len(self.vectors) > self.max_entries:
+            self.vectors.popitem(last=False)
+        return vector
+
+    def _forget_pending(self, key: tuple[str, str], task: asyncio.Future):
+        del self.pending[key]
+        # Every requester may have gone away, and an exception nobody retrieves would be logged as an error
+        if not task.cancelled():
+            task.exception()
+
+    def close(self):
+        if self.store:
+            self.store.close()
+
+
+async def embed_query(text: str, deployment: str, admission: AdmissionController, timer: StageTimer, cache: Optional[EmbeddingCache] = None) -> list[float]:
+    """The embedding of a search query, from the cache when there is one, timed as the "embedding" stage."""
+
+    async def create() -> list[float]:
+        async with admission.admit(EMBEDDINGS):
+            embedding = await openai.Embedding.acreate(engine=deployment, input=text)
+        timer.add_usage("embedding", embedding.get("usage"))
+        return embedding["data"][0]["embedding"]
+
+    with timer.stage("embedding"):
+        return await cache.get_or_create(deployment, text, create) if cache else await create()
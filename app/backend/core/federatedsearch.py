@@ -0,0 +1,50 @@
+import asyncio
+from typing import Any, AsyncIterator, Optional
+
+from azure.search.documents.aio import SearchClient
+
+from core.fusion import reciprocal_rank_fusion
+
+
+class FederatedSearchResults:
+    """The fused results of a federated search, iterated like the results of SearchClient.search."""
+
+    def __init__(self, docs: list[dict[str, Any]]):
+        self.docs = docs
+
+    async def get_count(self) -> int:
+        return len(self.docs)
+
+    async def get_answers(self) -> Optional[list]:
+        # Semantic answers are ranked per index and can't be fused meaningfully
+        return None
+
+    async def __aiter__(self) -> AsyncIterator[dict[str, Any]]:
+        for doc in self.docs:
+            yield doc
+
+
+class FederatedSearchClient:
+    """
+    Runs the same query against several indices at once and merges their results with reciprocal rank fusion,
+    so it can stand in for a SearchClient in the approaches. The searches run concurrently, so a query takes as
+    long as the slowest index. Each index is asked for the full top, and the fused list is cut back to top.
+    Every document is tagged with the index it came from in "@search.index".
+    """
+
+    def __init__(self, search_clients: dict[str, SearchClient]):
+        self.search_clients = search_clients
+
+    async def search(self, search_text: Optional[str] = None, top: Optional[int] = None, **kwargs: Any) -> FederatedSearchResults:
+        ranked_lists = await asyncio.gather(
+            *[self._search_index(index_name, search_client, search_text, top, **kwargs) for index_name, search_client in self.search_clients.items()]
+        )
+        return FederatedSearchResults(reciprocal_rank_fusion(ranked_lists, key=lambda doc: (doc["@search.index"], doc["id"]), top=top))
+
+    async def _search_index(self, index_name: str, search_client: SearchClient, search_text: Optional[str], top: Optional[int], **kwargs: Any) -> list[dict[str, Any]]:
+        results = await search_client.search(search_text, top=top, **kwargs)
+        docs = []
+        async for doc in results:
+            doc["@search.index"] = index_name
+            docs.append(doc)
+        return docs
@@ -0,0 +1,40 @@
+from typing import Any, Callable, Hashable, Optional, Sequence
+
+# The usual RRF constant: it damps the weight of the top ranks so no single list dominates the fused order
+RRF_K = 60
+
+
+def reciprocal_rank_scores(
+    ranked_lists: Sequence[Sequence[dict[str, Any]]],
+    key: Callable[[dict[str, Any]], Hashable],
+    k: int = RRF_K,
+) -> tuple[dict[Hashable, float], dict[Hashable, dict[str, Any]]]:
+    """
+    The reciprocal rank fusion score of every document in the ranked lists, sum(1 / (k + rank)) over the lists it
+    appears in (rank starting at 1), and the document itself, both by key. A document found in several lists is
+    the one from the first list it appears in.
+    """
+    scores: dict[Hashable, float] = {}
+    docs: dict[Hashable, dict[str, Any]] = {}
+    for ranked in ranked_lists:
+        for rank, doc in enumerate(ranked, start=1):
+            doc_key = key(doc)
+            scores[doc_key] = scores.get(doc_key, 0.0) + 1.0 / (k + rank)
+            docs.setdefault(doc_key, doc)
+    return scores, docs
+
+
+def reciprocal_rank_fusion(
+    ranked_lists: Sequence[Sequence[dict[str, Any]]],
+    key: Callable[[dict[str, Any]], Hashable],
+    top: Optional[int] = None,
+    k: int = RRF_K,
+) -> list[dict[str, Any]]:
+    """
+    Merge ranked result lists with reciprocal rank fusion: documents are ordered by their score from
+    reciprocal_rank_scores. Equal scores keep the higher original "@search.score" first. Documents are identified
+    across lists by key.
+    """
+    scores, docs = reciprocal_rank_scores(ranked_lists, key, k)
+    fused = sorted(docs, key=lambda doc_key: (scores[doc_key], docs[doc_key].get("@search.score") or 0.0), reverse=True)
+    return [docs[doc_key] for doc_key in fused[:top]]
@@ -0,0 +1,98 @@
+import asyncio
+import inspect
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Optional, Union
+
+
+@dataclass
+class IndexConfig:
+    name: str
+    container: str
+    content_field: str
+    sourcepage_field: str
+    # Per-index defaults for request overrides, e.g. top, retrieval_mode or semantic_ranker
+    defaults: dict[str, Any] = field(default_factory=dict)
+
+
+class IndexRegistry:
+    """
+    Maps each search index to its blob container, fields and default overrides. It's loaded from a JSON file such as:
+        {
+            "default_index": "natural-capital",
+            "indices": {
+                "natural-capital": {"container": "natural-capital"},
+                "energy": {"content_field": "content", "sourcepage_field": "sourcepage", "defaults": {"top": 5, "semantic_ranker": true}}
+            }
+        }
+    or from the same JSON in a string. A file can be reloaded while the app is running: the new configuration is
+    parsed completely before it replaces the current one, so readers see either the old or the new registry.
+    """
+
+    def __init__(self, path: Optional[str] = None, data: Optional[str] = None, content_field: str = "content", sourcepage_field: str = "sourcepage"):
+        self.path = path
+        self.content_field = content_field
+        self.sourcepage_field = sourcepage_field
+        self.default_index: Optional[str] = None
+        self.indices: dict[str, IndexConfig] = {}
+        self._mtime: Optional[float] = None
+        if path:
+            self.reload()
+        elif data:
+            self._apply(json.loads(data))
+
+    def get(self, name: str) -> Optional[IndexConfig]:
+        return self.indices.get(name)
+
+    def names(self) -> list[str]:
+        return list(self.indices)
+
+    def reload(self) -> set[str]:
+        """Load the file again and return the names of the indices that were added, removed or changed."""
+        mtime = os.path.getmtime(self.path)
+        with open(self.path) as f:
+            data = json.load(f)
+        changed = self._apply(data)
+        self._mtime = mtime
+        return changed
+
+    def reload_if_modified(self) -> set[str]:
+        if not self.path or os.path.getmtime(self.path) == self._mtime:
+            return set()
+        return self.reload()
+
+    async def watch(self, interval: float, on_change: Callable[[set[str]], Union[None, Awaitable[None]]]):
+        """Poll the file for changes every interval seconds, calling on_change with the names of changed indices."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                changed = self.reload_if_modified()
+            except Exception:
+                logging.exception("Failed to reload index registry from %s, keeping the current one", self.path)
+                continue
+            if changed:
+                logging.info("Index registry reloaded, changed indices: %s", ", ".join(sorted(changed)))
+                result = on_change(changed)
+                if inspect.isawaitable(result):
+                    await result
+
+    def _apply(self, data: dict[str, Any]) -> set[str]:
+        indices = {
+            name: IndexConfig(
+                name=name,
+                container=entry.get("container") or name,
+                content_field=entry.get("content_field") or self.content_field,
+                sourcepage_field=entry.get("sourcepage_field") or self.sourcepage_field,
+                defaults=entry.get("defaults") or {},
+            )
+            for name, entry in data["indices"].items()
+        }
+        default_index = data.get("default_index") or next(iter(indices), None)
+        if default_index is not None and default_index not in indices:
+            raise ValueError(f"default_index '{default_index}' is not one of the configured indices")
+
+        changed = {name for name in indices.keys() | self.indices.keys() if indices.get(name) != self.indices.get(name)}
+        self.indices, self.default_index = indices, default_index
+        return changed
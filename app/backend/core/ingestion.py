@@ -0,0 +1,270 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Optional, Protocol
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+# The error of jobs that were waiting or running when their worker process stopped
+WORKER_STOPPED = "worker stopped before the document was indexed"
+
+
+class IngestionJob:
+    def __init__(self, filename: str, index: str, container: str, store: Optional["IngestionStore"] = None):
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.index = index
+        self.container = container
+        self.store = store
+        self.status = QUEUED
+        self.stage: Optional[str] = None
+        self.sections = 0
+        self.error: Optional[str] = None
+        self.created = time.time()
+        self.updated = self.created
+
+    def update(self, stage: str, sections: Optional[int] = None):
+        """Record progress. Called from the ingestion worker thread, so the job is saved to the store right here."""
+        self.stage = stage
+        if sections is not None:
+            self.sections = sections
+        self.updated = time.time()
+        if self.store:
+            self.store.save(self)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "filename": self.filename,
+            "index_name": self.index,
+            "status": self.status,
+            "stage": self.stage,
+            "sections": self.sections,
+            "error": self.error,
+            "created": self.created,
+            "updated": self.updated,
+        }
+
+
+class IngestionStore(Protocol):
+    """
+    Where job status and the version of each index's content are kept, so any worker can report on a job and notice
+    that an index changed. Methods block, so the queue calls them on a thread.
+    """
+
+    def save(self, job: IngestionJob):
+        ...
+
+    def load(self, job_id: str) -> Optional[dict[str, Any]]:
+        ...
+
+    def bump_version(self, index_name: str) -> int:
+        ...
+
+    def versions(self) -> dict[str, int]:
+        ...
+
+    def close(self):
+        ...
+
+
+class MemoryIngestionStore:
+    """Jobs kept in this worker's memory, only visible to it; for a single worker. Finished jobs past max_jobs are forgotten."""
+
+    def __init__(self, max_jobs: int = 1000):
+        self.max_jobs = max_jobs
+        self.jobs: OrderedDict[str, dict[str, Any]] = OrderedDict()
+        self.index_versions: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def save(self, job: IngestionJob):
+        with self.lock:
+            self.jobs[job.id] = job.to_dict()
+            for job_id in list(self.jobs):
+                if len(self.jobs) <= self.max_jobs:
+                    break
+                if self.jobs[job_id]["status"] in (SUCCEEDED, FAILED):
+                    del self.jobs[job_id]
+
+    def load(self, job_id: str) -> Optional[dict[str, Any]]:
+        return self.jobs.get(job_id)
+
+    def bump_version(self, index_name: str) -> int:
+        with self.lock:
+            self.index_versions[index_name] = self.index_versions.get(index_name, 0) + 1
+            return self.index_versions[index_name]
+
+    def versions(self) -> dict[str, int]:
+        return dict(self.index_versions)
+
+    def close(self):
+        self.jobs.clear()
+
+
+class SqliteIngestionStore:
+    """
+    Jobs and index versions kept in a SQLite database on local disk, shared by all workers on the machine, so a
+    job's status can be polled from whichever worker the request lands on. Finished jobs past max_jobs are forgotten,
+    oldest first.
+    """
+
+    def __init__(self, path: str, max_jobs: int = 1000):
+        self.max_jobs = max_jobs
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, value TEXT NOT NULL, finished INTEGER NOT NULL, created REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS index_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+
+    def save(self, job: IngestionJob):
+        with self.lock:
+            # Read under the lock, so the last write always holds the job's latest state
+            value = job.to_dict()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO jobs (id, value, finished, created) VALUES (?, ?, ?, ?)",
+                (job.id, json.dumps(value), value["status"] in (SUCCEEDED, FAILED), job.created),
+            )
+            self.connection.execute(
+                "DELETE FROM jobs WHERE finished AND id IN (SELECT id FROM jobs ORDER BY created DESC LIMIT -1 OFFSET ?)", (self.max_jobs,)
+            )
+
+    def load(self, job_id: str) -> Optional[dict[str, Any]]:
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def bump_version(self, index_name: str) -> int:
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO index_versions (name, version) VALUES (?, 1) ON CONFLICT (name) DO UPDATE SET version = version + 1", (index_name,)
+            )
+            return self.connection.execute("SELECT version FROM index_versions WHERE name = ?", (index_name,)).fetchone()[0]
+
+    def versions(self) -> dict[str, int]:
+        with self.lock:
+            return dict(self.connection.execute("SELECT name, version FROM index_versions").fetchall())
+
+    def close(self):
+        self.connection.close()
+
+
+IngestionProcessor = Callable[[IngestionJob, bytes], None]
+IngestionCallback = Callable[[IngestionJob], Awaitable[None]]
+
+
+class IngestionQueue:
+    """
+    Runs uploaded documents through the indexer in the background. Jobs wait in a bounded queue and a fixed
+    number of workers hand them to a thread pool, because the indexer uses blocking Azure and OpenAI clients
+    that would otherwise stall the event loop serving chat requests. Job status is kept in store, so with a shared
+    store it can be looked up from any worker. on_success runs on the event loop after a document is indexed, before
+    its job is reported as succeeded; other workers learn about the new document from watch().
+    """
+
+    def __init__(
+        self,
+        process: IngestionProcessor,
+        workers: int = 2,
+        max_queued: int = 100,
+        store: Optional[IngestionStore] = None,
+        on_success: Optional[IngestionCallback] = None,
+    ):
+        self.process = process
+        self.on_success = on_success
+        self.workers = workers
+        self.store: IngestionStore = store or MemoryIngestionStore()
+        self.queue: asyncio.Queue[tuple[IngestionJob, bytes]] = asyncio.Queue(maxsize=max_queued)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._tasks: list[asyncio.Task] = []
+
+    async def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ingestion")
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Nothing will pick up the jobs still waiting, so report them as failed rather than queued forever
+        while not self.queue.empty():
+            job, _ = self.queue.get_nowait()
+            job.status = FAILED
+            job.error = WORKER_STOPPED
+            await self._save_final(job)
+            self.queue.task_done()
+        if self._executor:
+            # Jobs already running in threads are left to finish, but nothing new is picked up
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def submit(self, filename: str, index: str, container: str, content: bytes) -> IngestionJob:
+        """Queue a document for ingestion. Raises asyncio.QueueFull when the backlog is at capacity."""
+        job = IngestionJob(filename, index, container, self.store)
+        self.queue.put_nowait((job, content))
+        await asyncio.to_thread(self.store.save, job)
+        return job
+
+    async def get(self, job_id: str) -> Optional[dict[str, Any]]:
+        """The status of a job, as IngestionJob.to_dict() reports it."""
+        return await asyncio.to_thread(self.store.load, job_id)
+
+    async def watch(self, interval: float, on_change: Callable[[set[str]], Awaitable[None]]):
+        """Poll the store every interval seconds, calling on_change with the indices that got new documents."""
+        seen = await asyncio.to_thread(self.store.versions)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                versions = await asyncio.to_thread(self.store.versions)
+            except Exception:
+                logging.exception("Failed to read index versions from the ingestion store")
+                continue
+            changed = {index_name for index_name, version in versions.items() if seen.get(index_name) != version}
+            seen = versions
+            if changed:
+                await on_change(changed)
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job, content = await self.queue.get()
+            job.status = RUNNING
+            job.stage = "starting"
+            job.updated = time.time()
+            try:
+                await asyncio.to_thread(self.store.save, job)
+                await loop.run_in_executor(self._executor, self.process, job, content)
+                await asyncio.to_thread(self.store.bump_version, job.index)
+                if self.on_success:
+                    await self.on_success(job)
+                job.status = SUCCEEDED
+            except asyncio.CancelledError:
+                # The thread may still finish indexing, but nothing is left to record it
+                logging.warning("Ingestion of '%s' into '%s' was interrupted by the worker stopping", job.filename, job.index)
+                job.status = FAILED
+                job.error = WORKER_STOPPED
+                raise
+            except Exception as e:
+                logging.exception("Ingestion of '%s' into '%s' failed", job.filename, job.index)
+                job.status = FAILED
+                job.error = str(e)
+            finally:
+                await self._save_final(job)
+                self.queue.task_done()
+
+    async def _save_final(self, job: IngestionJob):
+        job.updated = time.time()
+        try:
+            await asyncio.to_thread(self.store.save, job)
+        except Exception:
+            logging.exception("Failed to save the status of ingestion job %s", job.id)
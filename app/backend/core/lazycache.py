@@ -0,0 +1,44 @@
+from typing import Callable, Generic, Hashable, Iterable, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LazyCache(Generic[K, V]):
+    """
+    A mapping whose values are built by a factory the first time their key is used, and reused afterwards.
+    The factory returns None for keys it doesn't know, and those are never cached, so requests for unknown
+    names can't grow the cache.
+    """
+
+    def __init__(self, factory: Callable[[K], Optional[V]]):
+        self.factory = factory
+        self.items: dict[K, V] = {}
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        value = self.items.get(key)
+        if value is None:
+            value = self.factory(key)
+            if value is None:
+                return default
+            self.items[key] = value
+        return value
+
+    def warm(self, keys: Iterable[K]):
+        """Build the values for keys known to be hot ahead of the first request."""
+        for key in keys:
+            self.get(key)
+
+    def discard(self, predicate: Callable[[K], bool]) -> list[V]:
+        """Drop the cached values whose key matches, returning them so the caller can release their resources."""
+        keys = [key for key in self.items if predicate(key)]
+        return [self.items.pop(key) for key in keys]
+
+    def values(self) -> list[V]:
+        return list(self.items.values())
+
+    def __contains__(self, key: K) -> bool:
+        return key in self.items
+
+    def __len__(self) -> int:
+        return len(self.items)
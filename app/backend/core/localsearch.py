@@ -0,0 +1,281 @@
+import asyncio
+import json
+import os
+from collections import namedtuple
+from typing import Any, AsyncIterator, Optional, Sequence
+
+import numpy as np
+
+from core.bm25 import BM25Index
+from core.fusion import reciprocal_rank_fusion
+
+# Stand in for the captions of a semantic search and the results of an upload, read through the same attributes
+Caption = namedtuple("Caption", ["text"])
+IndexingResult = namedtuple("IndexingResult", ["key", "succeeded"])
+
+CAPTION_CHARS = 500
+# Text matches ranked for a hybrid query, before they are fused with the vector matches
+TEXT_CANDIDATES = 50
+DOCUMENTS_FILE = "documents.jsonl"
+VECTORS_FILE = "vectors.npy"
+TEXT_INDEX_FILE = "bm25.npz"
+IVF_FILE = "ivf.npz"
+
+
+class LocalSearchResults:
+    """The results of a local search, iterated like the results of SearchClient.search."""
+
+    def __init__(self, docs: list[dict[str, Any]]):
+        self.docs = docs
+
+    async def get_count(self) -> int:
+        return len(self.docs)
+
+    async def get_answers(self) -> Optional[list]:
+        # There is no semantic ranker to extract answers
+        return None
+
+    async def __aiter__(self) -> AsyncIterator[dict[str, Any]]:
+        for doc in self.docs:
+            yield doc
+
+
+class LocalSearchClient:
+    """
+    An in-process search index the approaches can use in place of a SearchClient, for offline development,
+    benchmarks, tests and air-gapped deployments. It takes the same search() arguments they pass today.
+
+    Embeddings are kept as one contiguous float32 matrix of unit vectors, optionally memory-mapped from disk
+    (see save and load), so cosine similarity is a matrix-vector product, computed in batches of batch_size rows
+    to bound memory. Vector search is exact by default; build_ivf adds an inverted file index that only scores
+    the documents of the nprobe clusters closest to the query, for corpora of millions of chunks. Text queries
+    are ranked with BM25 by a BM25Index, and hybrid queries fuse the text and vector rankings with reciprocal
+    rank fusion, as Azure AI Search does. Filters support "field eq 'value'" and "field ne 'value'" clauses
+    joined by "and"; the semantic ranker and its answers are not available.
+
+    Documents are added and removed with upload_documents and delete_documents, as on a SearchClient. A removed
+    document leaves its row in the matrix, masked out of searches, until the index is rebuilt.
+    """
+
+    def __init__(
+        self,
+        documents: list[Optional[dict[str, Any]]],
+        vectors: Optional[np.ndarray] = None,
+        content_field: str = "content",
+        nprobe: int = 8,
+        batch_size: int = 65536,
+        text_index: Optional[BM25Index] = None,
+    ):
+        if text_index is None:
+            text_index = BM25Index(content_field)
+            text_index.add(documents)
+        self.text_index = text_index
+        self.vectors = vectors
+        self.content_field = content_field
+        self.nprobe = nprobe
+        self.batch_size = batch_size
+        self.centroids: Optional[np.ndarray] = None
+        self.assignments: Optional[np.ndarray] = None
+        self.list_offsets: Optional[np.ndarray] = None
+        self.list_ids: Optional[np.ndarray] = None
+
+    @property
+    def documents(self) -> list[Optional[dict[str, Any]]]:
+        # Shared with the text index: removed documents are None, so positions line up with rows of the vectors
+        return self.text_index.documents
+
+    @classmethod
+    def from_documents(cls, documents: Sequence[dict[str, Any]], vector_field: str = "embedding", **kwargs: Any) -> "LocalSearchClient":
+        """Index documents shaped like the ones prepdocs uploads, their embedding in vector_field."""
+        fields = [{name: value for name, value in doc.items() if name != vector_field} for doc in documents]
+        vectors = None
+        if documents and vector_field in documents[0]:
+            vectors = normalize(np.asarray([doc[vector_field] for doc in documents], dtype=np.float32))
+        return cls(fields, vectors, **kwargs)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True, **kwargs: Any) -> "LocalSearchClient":
+        """Load an index written by save; with mmap the vectors are paged in from disk as they are used."""
+        with open(os.path.join(directory, DOCUMENTS_FILE), encoding="utf-8") as f:
+            documents = [json.loads(line) for line in f]
+        vectors_path = os.path.join(directory, VECTORS_FILE)
+        vectors = np.load(vectors_path, mmap_mode="r" if mmap else None) if os.path.exists(vectors_path) else None
+        text_index_path = os.path.join(directory, TEXT_INDEX_FILE)
+        if os.path.exists(text_index_path):
+            kwargs["text_index"] = BM25Index.load(text_index_path, documents, kwargs.get("content_field", "content"))
+        client = cls(documents, vectors, **kwargs)
+        ivf_path = os.path.join(directory, IVF_FILE)
+        if os.path.exists(ivf_path):
+            with np.load(ivf_path) as ivf:
+                client.centroids = ivf["centroids"]
+                client._assign(ivf["assignments"])
+        return client
+
+    def save(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, DOCUMENTS_FILE), "w", encoding="utf-8") as f:
+            for doc in self.documents:
+                f.write(json.dumps(doc, ensure_ascii=False) + "\n")
+        self.text_index.save(os.path.join(directory, TEXT_INDEX_FILE))
+        if self.vectors is not None:
+            np.save(os.path.join(directory, VECTORS_FILE), np.ascontiguousarray(self.vectors, dtype=np.float32))
+        if self.centroids is not None:
+            np.savez(os.path.join(directory, IVF_FILE), centroids=self.centroids, assignments=self.assignments)
+
+    def build_ivf(self, n_lists: Optional[int] = None, iterations: int = 10, seed: int = 0):
+        """
+        Cluster the vectors with spherical k-means into n_lists lists (by default the square root of the number
+        of documents), after which vector searches only score the documents of the nprobe closest lists.
+        """
+        if self.vectors is None or len(self.vectors) == 0:
+            raise ValueError("The index has no vectors to cluster")
+        count, dimensions = self.vectors.shape
+        n_lists = min(n_lists or max(1, int(np.sqrt(count))), count)
+        rng = np.random.default_rng(seed)
+        centroids = np.array(self.vectors[np.sort(rng.choice(count, n_lists, replace=False))], dtype=np.float32)
+        for _ in range(iterations):
+            assignments = self._nearest_centroids(self.vectors, centroids)
+            sums = np.zeros((n_lists, dimensions), dtype=np.float32)
+            for start in range(0, count, self.batch_size):
+                block_assignments = assignments[start : start + self.batch_size]
+                order = np.argsort(block_assignments, kind="stable")
+                lists, first = np.unique(block_assignments[order], return_index=True)
+                sums[lists] += np.add.reduceat(self.vectors[start : start + self.batch_size][order], first, axis=0)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # A list that lost all its members keeps its old centroid
+            centroids = np.where(norms > 0, sums / np.where(norms > 0, norms, 1), centroids)
+        assignments = self._nearest_centroids(self.vectors, centroids)
+        with self.text_index.lock:
+            self.centroids = centroids
+            self._assign(assignments)
+
+    async def upload_documents(self, documents: Sequence[dict[str, Any]], vector_field: str = "embedding") -> list[IndexingResult]:
+        """Add documents, replacing those with the same id, as SearchClient.upload_documents does."""
+        return await asyncio.to_thread(self._upload, documents, vector_field)
+
+    async def delete_documents(self, documents: Sequence[dict[str, Any]]) -> list[IndexingResult]:
+        """Remove the documents with the ids of these, as SearchClient.delete_documents does."""
+        self.text_index.remove(doc["id"] for doc in documents)
+        return [IndexingResult(doc["id"], True) for doc in documents]
+
+    async def search(
+        self,
+        search_text: Optional[str] = None,
+        *,
+        filter: Optional[str] = None,
+        top: Optional[int] = None,
+        vector: Optional[Sequence[float]] = None,
+        top_k: Optional[int] = None,
+        vector_fields: Optional[str] = None,
+        select: Optional[Sequence[str]] = None,
+        query_caption: Optional[str] = None,
+        **kwargs: Any,
+    ) -> LocalSearchResults:
+        # Scoring a large corpus takes a while, so it runs on a thread rather than on the event loop
+        docs = await asyncio.to_thread(self._search, search_text, filter, top or 50, vector, top_k, select, query_caption)
+        return LocalSearchResults(docs)
+
+    async def close(self):
+        pass
+
+    def _upload(self, documents: Sequence[dict[str, Any]], vector_field: str) -> list[IndexingResult]:
+        fields = [{name: value for name, value in doc.items() if name != vector_field} for doc in documents]
+        # Rows are appended under the text index's lock, so searches never see documents without their vectors
+        with self.text_index.lock:
+            if self.vectors is None and any(doc.get(vector_field) is not None for doc in documents):
+                dimensions = len(next(doc[vector_field] for doc in documents if doc.get(vector_field) is not None))
+                self.vectors = np.zeros((len(self.documents), dimensions), dtype=np.float32)
+            if self.vectors is not None:
+                dimensions = self.vectors.shape[1]
+                added = np.zeros((len(documents), dimensions), dtype=np.float32)
+                for row, doc in enumerate(documents):
+                    if doc.get(vector_field) is not None:
+                        added[row] = doc[vector_field]
+                # Rows of removed documents are never reused, so the slots of the new ones follow the existing rows
+                self.vectors = np.concatenate([self.vectors[: len(self.documents)], normalize(added)])
+                if self.centroids is not None:
+                    self._assign(np.concatenate([self.assignments, self._nearest_centroids(added, self.centroids)]))
+            self.text_index.add(fields)
+        return [IndexingResult(doc["id"], True) for doc in documents]
+
+    def _search(
+        self,
+        search_text: Optional[str],
+        filter: Optional[str],
+        top: int,
+        vector: Optional[Sequence[float]],
+        top_k: Optional[int],
+        select: Optional[Sequence[str]],
+        query_caption: Optional[str],
+    ) -> list[dict[str, Any]]:
+        # Uploads replace the arrays rather than changing them, so a consistent snapshot can be scored without the lock
+        with self.text_index.lock:
+            allowed = self.text_index.filter_mask(filter)
+            vectors, centroids, list_ids, list_offsets = self.vectors, self.centroids, self.list_ids, self.list_offsets
+        ranked_lists = []
+        if vector is not None and vectors is not None:
+            query = np.asarray(vector, dtype=np.float32)
+            if centroids is not None:
+                closest = np.argsort(centroids @ query)[::-1][: self.nprobe]
+                candidates = np.sort(np.concatenate([list_ids[list_offsets[c] : list_offsets[c + 1]] for c in closest]))
+            else:
+                candidates = None
+            ranked_lists.append(self._vector_search(vectors, query, top_k or top, allowed, candidates))
+        if search_text and search_text != "*":
+            ranked_lists.append(self.text_index.search(search_text, max(top, TEXT_CANDIDATES) if ranked_lists else top, allowed))
+        if not ranked_lists:
+            ranked_lists.append([(int(index), 1.0) for index in np.flatnonzero(allowed)[:top]])
+
+        if len(ranked_lists) == 1:
+            ranked = ranked_lists[0][:top]
+        else:
+            as_docs = [[{"index": index, "@search.score": score} for index, score in ranked] for ranked in ranked_lists]
+            ranked = [(doc["index"], doc["@search.score"]) for doc in reciprocal_rank_fusion(as_docs, key=lambda doc: doc["index"], top=top)]
+        results = [self._result(index, score, vectors, select, query_caption) for index, score in ranked]
+        # A document removed since the snapshot is left out
+        return [result for result in results if result is not None]
+
+    def _vector_search(self, vectors: np.ndarray, query: np.ndarray, k: int, allowed: np.ndarray, candidates: Optional[np.ndarray]) -> list[tuple[int, float]]:
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return []
+        query = query / norm
+        if candidates is not None:
+            scores = vectors[candidates] @ query
+            scores[~allowed[candidates]] = -np.inf
+        else:
+            scores = np.concatenate([vectors[start : start + self.batch_size] @ query for start in range(0, len(allowed), self.batch_size)])
+            scores[~allowed] = -np.inf
+        k = min(k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k] if k else np.array([], dtype=np.int64)
+        best = best[np.argsort(-scores[best])]
+        ids = best if candidates is None else candidates[best]
+        return [(int(index), float(score)) for index, score in zip(ids, scores[best]) if score > -np.inf]
+
+    def _nearest_centroids(self, vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        return np.concatenate(
+            [np.argmax(vectors[start : start + self.batch_size] @ centroids.T, axis=1) for start in range(0, len(vectors), self.batch_size)]
+        )
+
+    def _assign(self, assignments: np.ndarray):
+        # The members of each list are contiguous in list_ids, list c from list_offsets[c] to list_offsets[c + 1]
+        self.assignments = assignments
+        self.list_ids = np.argsort(assignments, kind="stable")
+        self.list_offsets = np.searchsorted(assignments[self.list_ids], np.arange(len(self.centroids) + 1))
+
+    def _result(self, index: int, score: float, vectors: Optional[np.ndarray], select: Optional[Sequence[str]], query_caption: Optional[str]) -> Optional[dict[str, Any]]:
+        doc = self.documents[index]
+        if doc is None:
+            return None
+        result = {name: doc.get(name) for name in select} if select else dict(doc)
+        if select and "embedding" in select and vectors is not None:
+            result["embedding"] = vectors[index].tolist()
+        result["@search.score"] = score
+        if query_caption:
+            result["@search.captions"] = [Caption(str(doc.get(self.content_field, ""))[:CAPTION_CHARS])]
+        return result
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
@@ -0,0 +1,89 @@
+"""
+Prometheus metrics for the app. Under gunicorn every worker is a separate process, so gunicorn.conf.py sets
+PROMETHEUS_MULTIPROC_DIR: prometheus_client then keeps the values in files there, and render_metrics() adds up
+the files of all workers, so a scrape of any one worker reports the whole instance.
+"""
+import asyncio
+import os
+from typing import Any, Optional
+
+import openai
+from azure.core.exceptions import HttpResponseError
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+from core.admission import AdmissionRejected
+
+# Stages range from a few ms (result iteration) to tens of seconds (long completions)
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+APPROACH_STAGE_SECONDS = Histogram(
+    "approach_stage_seconds", "Time spent in each stage of an approach", ["approach", "index", "stage"], buckets=STAGE_BUCKETS
+)
+APPROACH_SECONDS = Histogram("approach_seconds", "Total time to answer with an approach", ["approach", "index"], buckets=STAGE_BUCKETS)
+APPROACH_TOKENS = Counter("approach_tokens", "Tokens used by the model calls of an approach", ["approach", "index", "stage", "kind"])
+
+REQUESTS = Counter("http_requests", "HTTP requests handled", ["route", "method", "status"])
+REQUEST_SECONDS = Histogram(
+    "http_request_seconds", "Time to produce the response, before any streamed body", ["route", "approach", "index"], buckets=STAGE_BUCKETS
+)
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests being handled", ["route"], multiprocess_mode="livesum")
+UPSTREAM_ERRORS = Counter("upstream_errors", "Failed or shed calls to OpenAI and Azure services", ["upstream", "status"])
+CACHE_REQUESTS = Counter("cache_requests", "Cache lookups by cache and result (hit or miss)", ["cache", "result"])
+QUERY_REWRITES = Counter("chat_query_rewrites", "Chat query rewrites by mode and outcome", ["mode", "outcome"])
+EVENT_LOOP_LAG_SECONDS = Histogram("event_loop_lag_seconds", "How late the event loop runs a scheduled callback", buckets=LAG_BUCKETS)
+
+
+def observe_timings(approach: str, index: str, timings: dict[str, Any]):
+    """Record the timings returned by an approach (see core/timing.py) as metrics."""
+    for stage, ms in timings["stages_ms"].items():
+        APPROACH_STAGE_SECONDS.labels(approach, index, stage).observe(ms / 1000)
+    APPROACH_SECONDS.labels(approach, index).observe(timings["total_ms"] / 1000)
+    for stage, counts in timings["tokens"].items():
+        for kind, count in counts.items():
+            APPROACH_TOKENS.labels(approach, index, stage, kind).inc(count)
+
+
+def observe_cache(cache: str, hit: bool):
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def observe_query_rewrite(mode: str, outcome: str):
+    """outcome is "rewritten", "skipped", "speculation_used" or "speculation_discarded"."""
+    QUERY_REWRITES.labels(mode, outcome).inc()
+
+
+def observe_upstream_error(error: Exception):
+    if isinstance(error, AdmissionRejected):
+        UPSTREAM_ERRORS.labels(error.upstream, "shed").inc()
+    elif isinstance(error, openai.error.OpenAIError):
+        UPSTREAM_ERRORS.labels("openai", str(error.http_status or "error")).inc()
+    elif isinstance(error, HttpResponseError):
+        UPSTREAM_ERRORS.labels("azure", str(error.status_code or "error")).inc()
+
+
+async def monitor_event_loop_lag(interval: float = 0.5):
+    """Measure how much later than scheduled the loop wakes up; sustained lag means something is blocking it."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - expected))
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """The metrics of this process, or of all worker processes in multiprocess mode, in the text format."""
+    registry: Optional[CollectorRegistry] = None
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry or REGISTRY), CONTENT_TYPE_LATEST
@@ -1,5 +1,9 @@
 from __future__ import annotations
 
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+
 import tiktoken
 
 MODELS_2_TOKEN_LIMITS = {
@@ -16,6 +20,10 @@ AOAI_2_OAI = {
     "gpt-35-turbo-16k": "gpt-3.5-turbo-16k"
 }
 
+# Token counts of recently seen texts by (encoding, content hash); chat histories resend the same turns every request
+TOKEN_COUNT_CACHE_SIZE = 4096
+_token_counts: OrderedDict[tuple[str, bytes], int] = OrderedDict()
+
 
 def get_token_limit(model_id: str) -> int:
     if model_id not in MODELS_2_TOKEN_LIMITS:
@@ -37,13 +45,32 @@ def num_tokens_from_messages(message: dict[str, str], model: str) -> int:
         num_tokens_from_messages(message, model)
         output: 11
     """
-    encoding = tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
     num_tokens = 2  # For "role" and "content" keys
     for key, value in message.items():
-        num_tokens += len(encoding.encode(value))
+        num_tokens += count_tokens(value, model)
     return num_tokens
 
 
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """The tiktoken encoding of a model, resolved once per model."""
+    return tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+
+
+def count_tokens(text: str, model: str) -> int:
+    """The number of tokens in text, memoized by content hash for the last TOKEN_COUNT_CACHE_SIZE texts."""
+    encoding = get_encoding(model)
+    key = (encoding.name, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest())
+    count = _token_counts.get(key)
+    if count is not None:
+        _token_counts.move_to_end(key)
+        return count
+    count = _token_counts[key] = len(encoding.encode(text))
+    if len(_token_counts) > TOKEN_COUNT_CACHE_SIZE:
+        _token_counts.popitem(last=False)
+    return count
+
+
 def get_oai_chatmodel_tiktok(aoaimodel: str) -> str:
     message = "Expected Azure OpenAI ChatGPT model name"
     if aoaimodel == "" or aoaimodel is None:
@@ -0,0 +1,104 @@
+from dataclasses import dataclass
+from typing import Optional, Sequence
+
+from .messagebuilder import MessageBuilder
+from .modelhelper import (
+    count_tokens,
+    get_encoding,
+    get_token_limit,
+    num_tokens_from_messages,
+)
+
+# A source cut shorter than this is mostly its file name, and not worth its place in the prompt
+MIN_SOURCE_TOKENS = 32
+
+
+@dataclass
+class PackedPrompt:
+    messages: list[dict[str, str]]
+    sources: list[str]
+    history_turns: int
+    token_length: int
+
+
+class PromptPacker:
+    """
+    Fits a prompt into a model's context window, leaving completion_tokens for the answer. The system prompt, the
+    few-shot examples and the question always go in. The retrieved sources come next, in rank order: whole while
+    they fit, then the first one that doesn't is cut to the tokens left. History fills the rest, most recent turn
+    first, in whole turns, and stops at the first turn that doesn't fit so the conversation has no gaps.
+    """
+
+    def __init__(self, model: str, completion_tokens: int = 1024, token_limit: Optional[int] = None):
+        self.model = model
+        self.budget = (token_limit or get_token_limit(model)) - completion_tokens
+
+    def pack(
+        self,
+        system_prompt: str,
+        question: str,
+        sources: Sequence[str] = (),
+        history: Sequence[dict[str, str]] = (),
+        few_shots: Sequence[dict[str, str]] = (),
+        sources_prefix: str = "\n\nSources:\n",
+    ) -> PackedPrompt:
+        """
+        Build the messages: system prompt, few shots, the turns of history (all but its last, which is the
+        question being asked), then the question with the sources appended after sources_prefix.
+        """
+        fixed = [{"role": "system", "content": system_prompt}, *few_shots, {"role": "user", "content": question + (sources_prefix if sources else "")}]
+        available = self.budget - sum(num_tokens_from_messages(message, self.model) for message in fixed)
+
+        packed_sources = []
+        for source in sources:
+            # Sources are joined with newlines, one token each
+            cost = count_tokens(source, self.model) + (1 if packed_sources else 0)
+            if cost <= available:
+                packed_sources.append(source)
+                available -= cost
+                continue
+            if available - 1 >= MIN_SOURCE_TOKENS:
+                packed_sources.append(self.truncate(source, available - 1))
+            break
+
+        turns = []
+        for turn in reversed(history[:-1]):
+            messages = turn_messages(turn)
+            cost = sum(num_tokens_from_messages(message, self.model) for message in messages)
+            if cost > available:
+                break
+            turns.insert(0, messages)
+            available -= cost
+
+        # Token counts of concatenated texts can differ slightly from the sum of their parts, so check the result
+        while True:
+            prompt = self.build(fixed, packed_sources, turns, sources_prefix)
+            if prompt.token_length <= self.budget or not (turns or packed_sources):
+                return prompt
+            if turns:
+                turns.pop(0)
+            else:
+                packed_sources.pop()
+
+    def build(self, fixed: list[dict[str, str]], sources: list[str], turns: list[list[dict[str, str]]], sources_prefix: str) -> PackedPrompt:
+        system, *few_shots, question = fixed
+        if not sources and question["content"].endswith(sources_prefix):
+            question = {"role": "user", "content": question["content"][: -len(sources_prefix)]}
+        message_builder = MessageBuilder(system["content"], self.model)
+        for message in [*few_shots, *[message for messages in turns for message in messages]]:
+            message_builder.append_message(message["role"], message["content"], index=len(message_builder.messages))
+        message_builder.append_message("user", question["content"] + "\n".join(sources), index=len(message_builder.messages))
+        return PackedPrompt(message_builder.messages, sources, len(turns), message_builder.token_length)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        encoding = get_encoding(self.model)
+        return encoding.decode(encoding.encode(text)[:max_tokens])
+
+
+def turn_messages(turn: dict[str, str]) -> list[dict[str, str]]:
+    messages = []
+    if user_msg := turn.get("user"):
+        messages.append({"role": "user", "content": user_msg})
+    if bot_msg := turn.get("bot"):
+        messages.append({"role": "assistant", "content": bot_msg})
+    return messages
@@ -0,0 +1,155 @@
+import json
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Optional, Sequence
+
+import numpy as np
+
+from core.answercache import IGNORED_OVERRIDES
+
+# ada-002 embeddings of unrelated texts are still ~0.7 similar; paraphrases of one question are ~0.95 and above
+DEFAULT_THRESHOLD = 0.95
+
+
+def semantic_cache_scope(approach: str, overrides: dict[str, Any]) -> str:
+    """Questions are only compared with questions asked of the same approach with the same overrides."""
+    return json.dumps([approach, {name: value for name, value in overrides.items() if name not in IGNORED_OVERRIDES}], sort_keys=True, default=str)
+
+
+class SemanticCachePartition:
+    """
+    The recent questions of one scope as rows of a float32 matrix of unit vectors, so finding the most similar one
+    is a single matrix-vector product. The matrix grows by doubling up to max_entries rows; after that a new
+    question replaces an expired row, or else the least recently used one.
+    """
+
+    def __init__(self, dimensions: int, max_entries: int):
+        self.max_entries = max_entries
+        self.size = 0
+        self.vectors = np.zeros((min(16, max_entries), dimensions), dtype=np.float32)
+        self.last_used = np.zeros(self.vectors.shape[0])
+        self.expires = np.zeros(self.vectors.shape[0])
+        self.answers: list[Optional[dict[str, Any]]] = [None] * self.vectors.shape[0]
+
+    def lookup(self, vector: np.ndarray, threshold: float, now: float) -> Optional[tuple[dict[str, Any], float]]:
+        if self.size == 0:
+            return None
+        similarities = self.vectors[: self.size] @ vector
+        similarities[self.expires[: self.size] <= now] = -np.inf
+        row = int(np.argmax(similarities))
+        if similarities[row] < threshold:
+            return None
+        self.last_used[row] = now
+        return self.answers[row], float(similarities[row])
+
+    def add(self, vector: np.ndarray, answer: dict[str, Any], ttl: float, now: float):
+        if self.size < self.max_entries:
+            if self.size == self.vectors.shape[0]:
+                self._grow(min(self.size * 2, self.max_entries))
+            row = self.size
+            self.size += 1
+        else:
+            row = int(np.argmin(np.where(self.expires <= now, -np.inf, self.last_used)))
+        self.vectors[row] = vector
+        self.last_used[row] = now
+        self.expires[row] = now + ttl
+        self.answers[row] = answer
+
+    def _grow(self, rows: int):
+        extra = rows - self.vectors.shape[0]
+        self.vectors = np.vstack([self.vectors, np.zeros((extra, self.vectors.shape[1]), dtype=np.float32)])
+        self.last_used = np.concatenate([self.last_used, np.zeros(extra)])
+        self.expires = np.concatenate([self.expires, np.zeros(extra)])
+        self.answers.extend([None] * extra)
+
+
+class SemanticCache:
+    """
+    Answers to recent questions, found again for paraphrases of the question through the cosine similarity of
+    their embeddings. Questions are partitioned by the indices searched and by scope (see semantic_cache_scope);
+    at most max_partitions partitions of max_entries questions each are kept, the least recently used partition
+    being dropped first, so memory stays under max_partitions * max_entries * dimensions * 4 bytes.
+    """
+
+    def __init__(self, threshold: float = DEFAULT_THRESHOLD, max_entries: int = 512, max_partitions: int = 16, ttl: float = 3600):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_partitions = max_partitions
+        self.ttl = ttl
+        self.partitions: OrderedDict[tuple[tuple[str, ...], str], SemanticCachePartition] = OrderedDict()
+
+    def for_indices(self, index_names: Sequence[str]) -> "IndexSemanticCache":
+        return IndexSemanticCache(self, tuple(index_names))
+
+    def lookup(self, index_names: tuple[str, ...], scope: str, vector: Sequence[float]) -> Optional[tuple[dict[str, Any], float]]:
+        """The cached answer of the most similar question and its similarity, if it reaches the threshold."""
+        partition = self.partitions.get((index_names, scope))
+        unit = normalize(vector)
+        if partition is None or unit is None or partition.vectors.shape[1] != unit.shape[0]:
+            return None
+        self.partitions.move_to_end((index_names, scope))
+        return partition.lookup(unit, self.threshold, time.time())
+
+    def add(self, index_names: tuple[str, ...], scope: str, vector: Sequence[float], answer: dict[str, Any]):
+        unit = normalize(vector)
+        if unit is None:
+            return
+        key = (index_names, scope)
+        partition = self.partitions.get(key)
+        # A new embedding model means new dimensions, and the old vectors can't be compared with the new ones
+        if partition is None or partition.vectors.shape[1] != unit.shape[0]:
+            partition = self.partitions[key] = SemanticCachePartition(unit.shape[0], self.max_entries)
+        self.partitions.move_to_end(key)
+        while len(self.partitions) > self.max_partitions:
+            self.partitions.popitem(last=False)
+        partition.add(unit, answer, self.ttl, time.time())
+
+    def invalidate(self, index_name: str) -> int:
+        """Forget the questions whose answers searched index_name."""
+        keys = [key for key in self.partitions if index_name in key[0]]
+        for key in keys:
+            del self.partitions[key]
+        return len(keys)
+
+
+class IndexSemanticCache:
+    """The semantic cache as seen by an approach, which searches a fixed set of indices."""
+
+    def __init__(self, cache: SemanticCache, index_names: tuple[str, ...]):
+        self.cache = cache
+        self.index_names = index_names
+
+    def lookup(self, scope: str, vector: Sequence[float]) -> Optional[tuple[dict[str, Any], float]]:
+        return self.cache.lookup(self.index_names, scope, vector)
+
+    def remember(self, scope: str, vector: Sequence[float], extra_info: dict[str, Any], chat_coroutine: Awaitable[Any], should_stream: bool) -> Awaitable[Any]:
+        """
+        Wrap the final chat completion so that once it has completed, its answer is cached along with the data
+        points and thoughts in extra_info. A streamed answer is only cached if the stream is read to the end.
+        """
+
+        async def completion():
+            chat_completion = await chat_coroutine
+            if should_stream:
+                return self._remember_stream(scope, vector, extra_info, chat_completion)
+            self._add(scope, vector, extra_info, chat_completion.choices[0].message.content)
+            return chat_completion
+
+        return completion()
+
+    async def _remember_stream(self, scope: str, vector: Sequence[float], extra_info: dict[str, Any], chunks: AsyncIterator[Any]) -> AsyncIterator[Any]:
+        answer = []
+        async for chunk in chunks:
+            if chunk.choices and (content := chunk.choices[0].delta.get("content")):
+                answer.append(content)
+            yield chunk
+        self._add(scope, vector, extra_info, "".join(answer))
+
+    def _add(self, scope: str, vector: Sequence[float], extra_info: dict[str, Any], answer: str):
+        self.cache.add(self.index_names, scope, vector, {"data_points": extra_info["data_points"], "answer": answer, "thoughts": extra_info["thoughts"]})
+
+
+def normalize(vector: Sequence[float]) -> Optional[np.ndarray]:
+    array = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(array)
+    return array / norm if norm > 0 else None
@@ -0,0 +1,50 @@
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+
+class StageTimer:
+    """
+    Measures how long each stage of an approach takes, and how many tokens its model calls used. A stage that
+    runs several times, like the searches of an agent, accumulates its time across runs.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: dict[str, float] = {}
+        self.tokens: dict[str, dict[str, int]] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name: str, seconds: float):
+        """Add time measured outside stage(), e.g. by callbacks that see a call start and end separately."""
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def add_usage(self, name: str, usage: Optional[dict[str, Any]]):
+        """Add the "usage" reported by an OpenAI response; streamed completions don't report it."""
+        if not usage:
+            return
+        counts = self.tokens.setdefault(name, {})
+        for kind in ("prompt_tokens", "completion_tokens", "total_tokens"):
+            if kind in usage:
+                counts[kind] = counts.get(kind, 0) + usage[kind]
+
+    def merge(self, other: "StageTimer", prefix: str = ""):
+        """Add the stages and token counts of another timer, e.g. of work that ran concurrently with this one."""
+        for name, seconds in other.stages.items():
+            self.stages[prefix + name] = self.stages.get(prefix + name, 0.0) + seconds
+        for name, counts in other.tokens.items():
+            self.add_usage(prefix + name, counts)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "stages_ms": {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()},
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "tokens": self.tokens,
+        }
@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from azure.core.credentials import AccessToken
+
+COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+
+TokenCallback = Callable[[tuple[str, ...], AccessToken], None]
+
+
+class TokenManager:
+    """
+    Keeps the access tokens of one worker fresh, on top of an async Azure credential.
+    Tokens are refreshed by a background task well before they expire (refresh_margin), so callers get the cached
+    token without waiting. If a caller does find a token about to expire (min_validity), concurrent callers share a
+    single in-flight refresh instead of each calling the credential (single flight).
+    Sync code running on worker threads, like the indexer, can use sync_credential() with the synchronous SDK clients.
+    """
+
+    def __init__(self, credential: Any, refresh_margin: float = 300, min_validity: float = 60, retry_interval: float = 10, on_refresh: Optional[TokenCallback] = None):
+        self.credential = credential
+        self.refresh_margin = refresh_margin
+        self.min_validity = min_validity
+        self.retry_interval = retry_interval
+        self.on_refresh = on_refresh
+        self.tokens: dict[tuple[str, ...], AccessToken] = {}
+        self._inflight: dict[tuple[str, ...], asyncio.Future] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, *scopes: str):
+        """Acquire the initial token and start refreshing in the background."""
+        self._loop = asyncio.get_running_loop()
+        await self.get_token(*(scopes or (COGNITIVE_SERVICES_SCOPE,)))
+        self._task = asyncio.create_task(self._refresh_periodically())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def get_token(self, *scopes: str) -> AccessToken:
+        scopes = scopes or (COGNITIVE_SERVICES_SCOPE,)
+        token = self.tokens.get(scopes)
+        if token and token.expires_on > time.time() + self.min_validity:
+            return token
+        return await self.refresh(*scopes)
+
+    async def refresh(self, *scopes: str) -> AccessToken:
+        future = self._inflight.get(scopes)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(scopes))
+            self._inflight[scopes] = future
+            future.add_done_callback(lambda _: self._inflight.pop(scopes, None))
+        # Shield the shared fetch, so one cancelled caller doesn't cancel it for everyone else
+        return await asyncio.shield(future)
+
+    async def _fetch(self, scopes: tuple[str, ...]) -> AccessToken:
+        token = await self.credential.get_token(*scopes)
+        self.tokens[scopes] = token
+        if self.on_refresh:
+            self.on_refresh(scopes, token)
+        return token
+
+    async def _refresh_periodically(self):
+        while True:
+            next_refresh = min(token.expires_on for token in self.tokens.values()) - self.refresh_margin
+            await asyncio.sleep(max(next_refresh - time.time(), self.retry_interval))
+            for scopes, token in list(self.tokens.items()):
+                if token.expires_on - self.refresh_margin <= time.time():
+                    try:
+                        await self.refresh(*scopes)
+                    except Exception:
+                        logging.exception("Failed to refresh access token, retrying in %s seconds", self.retry_interval)
+
+    def get_token_threadsafe(self, *scopes: str) -> AccessToken:
+        """
+        Get a token from a thread other than the one running the manager's event loop. A token that has to be fetched
+        is fetched on that loop, so calling this from the loop itself would block it forever and raises instead.
+        """
+        scopes = scopes or (COGNITIVE_SERVICES_SCOPE,)
+        token = self.tokens.get(scopes)
+        if token and token.expires_on > time.time() + self.min_validity:
+            return token
+        if self._loop is None:
+            raise RuntimeError("TokenManager has not been started")
+        if on_loop(self._loop):
+            raise RuntimeError("get_token_threadsafe can't fetch a token on the event loop's own thread, await get_token instead")
+        return asyncio.run_coroutine_threadsafe(self.get_token(*scopes), self._loop).result()
+
+    def sync_credential(self) -> "ManagedCredential":
+        return ManagedCredential(self.get_token_threadsafe)
+
+
+def on_loop(loop: asyncio.AbstractEventLoop) -> bool:
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
+class SyncTokenManager:
+    """
+    TokenManager counterpart for synchronous programs (e.g. scripts/prepdocs.py) using a sync Azure credential.
+    A daemon thread refreshes tokens before they expire and a lock gives single-flight refreshes.
+    """
+
+    def __init__(self, credential: Any, refresh_margin: float = 300, min_validity: float = 60, retry_interval: float = 10, on_refresh: Optional[TokenCallback] = None):
+        self.credential = credential
+        self.refresh_margin = refresh_margin
+        self.min_validity = min_validity
+        self.retry_interval = retry_interval
+        self.on_refresh = on_refresh
+        self.tokens: dict[tuple[str, ...], AccessToken] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, *scopes: str):
+        """Acquire the initial token and start refreshing in the background."""
+        self.get_token(*(scopes or (COGNITIVE_SERVICES_SCOPE,)))
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._refresh_periodically, name="token-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def get_token(self, *scopes: str) -> AccessToken:
+        scopes = scopes or (COGNITIVE_SERVICES_SCOPE,)
+        token = self.tokens.get(scopes)
+        if token and token.expires_on > time.time() + self.min_validity:
+            return token
+        with self._lock:
+            # Another thread may have refreshed the token while this one waited for the lock
+            token = self.tokens.get(scopes)
+            if token and token.expires_on > time.time() + self.min_validity:
+                return token
+            return self._fetch(scopes)
+
+    def refresh(self, *scopes: str) -> AccessToken:
+        with self._lock:
+            return self._fetch(scopes or (COGNITIVE_SERVICES_SCOPE,))
+
+    def _fetch(self, scopes: tuple[str, ...]) -> AccessToken:
+        token = self.credential.get_token(*scopes)
+        self.tokens[scopes] = token
+        if self.on_refresh:
+            self.on_refresh(scopes, token)
+        return token
+
+    def _refresh_periodically(self):
+        while not self._stopped.is_set():
+            next_refresh = min(token.expires_on for token in self.tokens.values()) - self.refresh_margin
+            if self._stopped.wait(max(next_refresh - time.time(), self.retry_interval)):
+                return
+            for scopes, token in list(self.tokens.items()):
+                if token.expires_on - self.refresh_margin <= time.time():
+                    try:
+                        self.refresh(*scopes)
+                    except Exception:
+                        logging.exception("Failed to refresh access token, retrying in %s seconds", self.retry_interval)
+
+    def sync_credential(self) -> "ManagedCredential":
+        return ManagedCredential(self.get_token)
+
+
+class ManagedCredential:
+    """A synchronous TokenCredential serving the cached tokens of a token manager, for the Azure SDK sync clients."""
+
+    def __init__(self, get_token: Callable[..., AccessToken]):
+        self._get_token = get_token
+
+    def get_token(self, *scopes: str, **kwargs: Any) -> AccessToken:
+        return self._get_token(*scopes)
@@ -1,4 +1,7 @@
 import multiprocessing
+import os
+import shutil
+import tempfile
 
 max_requests = 1000
 max_requests_jitter = 50
@@ -11,3 +14,18 @@ timeout = 230
 num_cpus = multiprocessing.cpu_count()
 workers = (num_cpus * 2) + 1
 worker_class = "uvicorn.workers.UvicornWorker"
+
+
+def on_starting(server):
+    # Workers write their metrics to files in this directory so /metrics can add them up across processes.
+    # It's set before the workers are forked and emptied, so counters don't carry over from a previous run.
+    directory = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "prometheus-multiproc"))
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+
+def child_exit(server, worker):
+    # Workers are recycled after max_requests; drop their live gauges (counters and histograms are kept)
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
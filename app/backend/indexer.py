@@ -6,6 +6,7 @@ import io
 import os
 import re
 import time
+from typing import Callable, Optional
 
 import openai
 from azure.ai.formrecognizer import DocumentAnalysisClient
@@ -27,29 +28,34 @@ from azure.search.documents.indexes.models import (
     VectorSearch,
     VectorSearchAlgorithmConfiguration,
 )
-from azure.identity.aio import DefaultAzureCredential
 from azure.storage.blob import BlobServiceClient
 from pypdf import PdfReader, PdfWriter
 from tenacity import retry, stop_after_attempt, wait_random_exponential
 
-MAX_SECTION_LENGTH = 1000
-SENTENCE_SEARCH_LIMIT = 100
-SECTION_OVERLAP = 100
+from core.chunking import (
+    SECTION_OVERLAP_TOKENS,
+    check_section_tokens,
+    split_pages,
+    split_pages_by_tokens,
+)
+from core.tokenmanager import COGNITIVE_SERVICES_SCOPE, ManagedCredential
 
-open_ai_token_cache = {}
-CACHE_KEY_TOKEN_CRED = 'openai_token_cred'
-CACHE_KEY_CREATED_TIME = 'created_time'
-CACHE_KEY_TOKEN_TYPE = 'token_type'
+# Credential backed by the app's token manager, set by add_file
+azure_credential: Optional[ManagedCredential] = None
 
 AZURE_STORAGE_ACCOUNT = os.getenv("AZURE_STORAGE_ACCOUNT")
-AZURE_STORAGE_CONTAINER = ["natural-capital", "energy", "climate-financing", "green-minerals", "sust-agric", "adaptation", "infrastructure"]
 AZURE_SEARCH_SERVICE = os.getenv("AZURE_SEARCH_SERVICE")
-AZURE_SEARCH_INDICES = ["natural-capital", "energy", "climate-financing", "green-minerals", "sust-agric", "adaptation", "infrastructure"]
 AZURE_OPENAI_SERVICE = os.getenv("AZURE_OPENAI_SERVICE")
 AZURE_OPENAI_CHATGPT_DEPLOYMENT = os.getenv("AZURE_OPENAI_CHATGPT_DEPLOYMENT")
 AZURE_OPENAI_CHATGPT_MODEL = os.getenv("AZURE_OPENAI_CHATGPT_MODEL")
 AZURE_OPENAI_EMB_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMB_DEPLOYMENT")
 AZURE_TENANT_ID=os.getenv("AZURE_TENANT_ID")
+# Split documents into sections of this many embedding model tokens, or of MAX_SECTION_LENGTH characters when 0.
+# Checked here, so a bad setting stops the app from starting rather than failing every upload.
+SPLIT_SECTION_TOKENS = int(os.getenv("SECTION_TOKENS", "0"))
+SPLIT_OVERLAP_TOKENS = int(os.getenv("SECTION_OVERLAP_TOKENS", str(SECTION_OVERLAP_TOKENS)))
+if SPLIT_SECTION_TOKENS:
+    check_section_tokens(SPLIT_SECTION_TOKENS, SPLIT_OVERLAP_TOKENS)
 
 
 
@@ -60,7 +66,7 @@ def blob_name_from_file_page(filename, page = 0):
         return os.path.basename(filename)
 
 
-def upload_blobs(uploaded_file, container_name, storage_creds, verbose=True):
+def upload_blobs(file_name, file_content, container_name, storage_creds, verbose=True):
     blob_service = BlobServiceClient(account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", credential=storage_creds)
     blob_container = blob_service.get_container_client(container_name)
     
@@ -68,8 +74,6 @@ def upload_blobs(uploaded_file, container_name, storage_creds, verbose=True):
     if not blob_container.exists():
         blob_container.create_container()
 
-    file_content = uploaded_file.read()
-    file_name = uploaded_file.filename
     file_extension = os.path.splitext(file_name)[1].lower()
 
     if file_extension == ".pdf":
@@ -133,12 +137,10 @@ def table_to_html(table):
     return table_html
 
 
-def get_document_text(uploaded_file):
+def get_document_text(file_content):
     offset = 0
     page_map = []
-    file_content = uploaded_file.read()  # read the content once
-    file_name = uploaded_file.filename
-    
+
     #check if localpdfparser
     reader = PdfReader(io.BytesIO(file_content))
     pages = reader.pages
@@ -188,66 +190,12 @@ def get_document_text(uploaded_file):
     return page_map
 
 
-def split_text(page_map, uploaded_file, verbose=True):
-    filename=uploaded_file.filename
-    SENTENCE_ENDINGS = [".", "!", "?"]
-    WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
+def split_text(page_map, filename, verbose=True):
     if verbose: print(f"Splitting '{filename}' into sections")
-
-    def find_page(offset):
-        num_pages = len(page_map)
-        for i in range(num_pages - 1):
-            if offset >= page_map[i][1] and offset < page_map[i + 1][1]:
-                return i
-        return num_pages - 1
-
-    all_text = "".join(p[2] for p in page_map)
-    length = len(all_text)
-    start = 0
-    end = length
-    while start + SECTION_OVERLAP < length:
-        last_word = -1
-        end = start + MAX_SECTION_LENGTH
-
-        if end > length:
-            end = length
-        else:
-            # Try to find the end of the sentence
-            while end < length and (end - start - MAX_SECTION_LENGTH) < SENTENCE_SEARCH_LIMIT and all_text[end] not in SENTENCE_ENDINGS:
-                if all_text[end] in WORDS_BREAKS:
-                    last_word = end
-                end += 1
-            if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
-                end = last_word # Fall back to at least keeping a whole word
-        if end < length:
-            end += 1
-
-        # Try to find the start of the sentence or at least a whole word boundary
-        last_word = -1
-        while start > 0 and start > end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT and all_text[start] not in SENTENCE_ENDINGS:
-            if all_text[start] in WORDS_BREAKS:
-                last_word = start
-            start -= 1
-        if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
-            start = last_word
-        if start > 0:
-            start += 1
-
-        section_text = all_text[start:end]
-        yield (section_text, find_page(start))
-
-        last_table_start = section_text.rfind("<table")
-        if (last_table_start > 2 * SENTENCE_SEARCH_LIMIT and last_table_start > section_text.rfind("</table")):
-            # If the section ends with an unclosed table, we need to start the next section with the table.
-            # If table starts inside SENTENCE_SEARCH_LIMIT, we ignore it, as that will cause an infinite loop for tables longer than MAX_SECTION_LENGTH
-            # If last table starts inside SECTION_OVERLAP, keep overlapping
-            if verbose: print(f"Section ends with unclosed table, starting next section with the table at page {find_page(start)} offset {start} table start {last_table_start}")
-            start = min(end - SECTION_OVERLAP, start + last_table_start)
-        else:
-            start = end - SECTION_OVERLAP
-
-    if start + SECTION_OVERLAP < end:
-        yield (all_text[start:end], find_page(start))
+    if SPLIT_SECTION_TOKENS:
+        yield from split_pages_by_tokens(page_map, max_tokens=SPLIT_SECTION_TOKENS, overlap_tokens=SPLIT_OVERLAP_TOKENS, verbose=verbose)
+    else:
+        yield from split_pages(page_map, verbose=verbose)
 
 def filename_to_id(filename):
     filename_ascii = re.sub("[^0-9a-zA-Z_-]", "_", filename)
@@ -255,10 +203,9 @@ def filename_to_id(filename):
     return f"file-{filename_ascii}-{filename_hash}"
 
 
-def create_sections(uploaded_file, page_map, use_vectors):
-    file_name = uploaded_file.filename
+def create_sections(file_name, page_map, use_vectors):
     file_id = filename_to_id(file_name)
-    for i, (content, pagenum) in enumerate(split_text(page_map)):
+    for i, (content, pagenum) in enumerate(split_text(page_map, file_name)):
         section = {
             "id": f"{file_id}-page-{i}",
             "content": content,
@@ -327,8 +274,7 @@ def compute_embedding(text):
 #                 print(f"Search index {index_name} already exists")
 
 
-async def index_sections(uploaded_file, sections, search_creds, searchService, index_name, verbose=True):
-    filename = uploaded_file.filename
+def index_sections(filename, sections, search_creds, searchService, index_name, on_progress=None, verbose=True):
     if verbose: print(f"Indexing sections from '{filename}' into search index '{index_name}'")
     search_client = SearchClient(endpoint=f"https://{searchService}.search.windows.net/",
                                     index_name=index_name,
@@ -343,11 +289,15 @@ async def index_sections(uploaded_file, sections, search_creds, searchService, i
             succeeded = sum([1 for r in results if r.succeeded])
             if verbose: print(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
             batch = []
+        if on_progress:
+            on_progress("indexing", i)
 
     if len(batch) > 0:
         results = search_client.upload_documents(documents=batch)
         succeeded = sum([1 for r in results if r.succeeded])
         if verbose: print(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
+    search_client.close()
+    return i
 
 
 def remove_from_index(filename, searchservice, search_creds, index_name=None, verbose=True):
@@ -372,39 +322,33 @@ def remove_from_index(filename, searchservice, search_creds, index_name=None, ve
         time.sleep(2)
 
 
-# refresh open ai token every 5 minutes
+# the token manager refreshes the open ai token in the background, this just picks up the current one
 def refresh_openai_token():
-    if open_ai_token_cache[CACHE_KEY_TOKEN_TYPE] == 'azure_ad' and open_ai_token_cache[CACHE_KEY_CREATED_TIME] + 300 < time.time():
-        token_cred = open_ai_token_cache[CACHE_KEY_TOKEN_CRED]
-        openai.api_key = token_cred.get_token("https://cognitiveservices.azure.com/.default").token
-        open_ai_token_cache[CACHE_KEY_CREATED_TIME] = time.time()
+    if azure_credential is not None:
+        openai.api_key = azure_credential.get_token(COGNITIVE_SERVICES_SCOPE).token
 
 
-async def add_file(uploaded_file: any, index: str) -> bool:
-    AZURE_STORAGE_ACCOUNT = os.getenv("AZURE_STORAGE_ACCOUNT")
-    AZURE_OPENAI_SERVICE = os.getenv("AZURE_OPENAI_SERVICE")
+def add_file(file_name: str, file_content: bytes, index: str, container: str, credential: ManagedCredential, on_progress: Optional[Callable[[str, Optional[int]], None]] = None) -> int:
+    """
+    Upload a document's pages to blob storage and index its sections, returning the number of sections indexed.
+    This blocks on the sync Azure and OpenAI clients, so the app runs it on a worker thread (see core/ingestion.py).
+    """
+    global azure_credential
 
-    # KB_FIELDS_CONTENT = os.getenv("KB_FIELDS_CONTENT", "content")
-    # KB_FIELDS_SOURCEPAGE = os.getenv("KB_FIELDS_SOURCEPAGE", "sourcepage")
+    # Use the worker's token manager rather than a new credential per upload. The OpenAI endpoint and API
+    # version are already configured by the app, so they are not overridden here.
+    azure_credential = credential
+    progress = on_progress or (lambda stage, sections=None: None)
 
-    # Set up Azure authentication.
-    azure_credential = DefaultAzureCredential(exclude_shared_token_cache_credential=True)
+    progress("uploading")
+    upload_blobs(file_name=file_name, file_content=file_content, container_name=container, storage_creds=azure_credential, verbose=True)
 
-    openai.api_key = azure_credential.get_token("https://cognitiveservices.azure.com/.default").token
-    openai.api_type = "azure_ad"
-    open_ai_token_cache[CACHE_KEY_CREATED_TIME] = time.time()
-    open_ai_token_cache[CACHE_KEY_TOKEN_CRED] = azure_credential
-    open_ai_token_cache[CACHE_KEY_TOKEN_TYPE] = "azure_ad"
-
-    openai.api_base = f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
-    openai.api_version = "2022-12-01"
-    
-    await upload_blobs(uploaded_file=uploaded_file, container_name=index, storage_creds=azure_credential, storageaccount=AZURE_STORAGE_ACCOUNT, verbose=True)
+    progress("extracting")
+    page_map = get_document_text(file_content=file_content)
 
-    page_map = get_document_text(uploaded_file=uploaded_file)
-    sections = create_sections(uploaded_file=uploaded_file, page_map=page_map, use_vectors=True)
-    await index_sections(uploaded_file=uploaded_file, search_creds=azure_credential, sections=sections, index_name=index, verbose=True)
-    return True
+    # Sections are embedded lazily as they are indexed, so progress is reported per indexed section
+    sections = create_sections(file_name=file_name, page_map=page_map, use_vectors=True)
+    return index_sections(filename=file_name, sections=sections, search_creds=azure_credential, searchService=AZURE_SEARCH_SERVICE, index_name=index, on_progress=progress, verbose=True)
 
 
 
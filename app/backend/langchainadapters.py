@@ -1,8 +1,12 @@
+import time
 from typing import Any, Dict, List, Optional, Union
+from uuid import UUID
 
-from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.base import AsyncCallbackHandler, BaseCallbackHandler
 from langchain.schema import AgentAction, AgentFinish, LLMResult
 
+from core.timing import StageTimer
+
 
 def ch(text: Union[str, object]) -> str:
     s = text if isinstance(text, str) else str(text)
@@ -88,3 +92,30 @@ class HtmlCallbackHandler (BaseCallbackHandler):
     ) -> None:
         """Run on agent end."""
         self.html += f"<span style='color:{color}'>{ch(finish.log)}</span><br>"
+
+
+class TimingCallbackHandler(AsyncCallbackHandler):
+    """
+    Records every model call of a LangChain agent in a StageTimer, as the time spent in stage and the tokens the
+    call used, so agents report their model calls the way the other approaches do.
+    """
+
+    def __init__(self, timer: StageTimer, stage: str = "llm"):
+        self.timer = timer
+        self.stage = stage
+        self.started: Dict[UUID, float] = {}
+
+    async def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any) -> None:
+        self.started[run_id] = time.perf_counter()
+
+    async def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        self._finish(run_id)
+        self.timer.add_usage(self.stage, (response.llm_output or {}).get("token_usage"))
+
+    async def on_llm_error(self, error: Union[Exception, KeyboardInterrupt], *, run_id: UUID, **kwargs: Any) -> None:
+        self._finish(run_id)
+
+    def _finish(self, run_id: UUID):
+        start = self.started.pop(run_id, None)
+        if start is not None:
+            self.timer.add_time(self.stage, time.perf_counter() - start)
@@ -88,8 +88,9 @@ export async function uploadFileApi(file: File, indexName?: string): Promise<any
 
 let indexName: string = "natural-capital";
 
+// Citations from a federated search name the index they came from ("adaptation/report-3.pdf")
 export function getCitationFilePath(citation: string): string {
-    return `/content/${indexName}/${citation}`;
+    return citation.includes("/") ? `/content/${citation}` : `/content/${indexName}/${citation}`;
 }
 
 export function changeCitationIndexName(newIndexName: string): void {
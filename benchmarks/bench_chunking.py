@@ -0,0 +1,115 @@
+"""
+Throughput of splitting a synthetic document into sections, the way prepdocs and the upload indexer do for every
+file: with the character-by-character splitter and linear page lookup split_text used before, and with
+core.chunking.split_pages. Checks that both produce the same sections. Run from the repository root:
+
+    python benchmarks/bench_chunking.py
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app", "backend"))
+
+from core.chunking import (  # noqa: E402
+    MAX_SECTION_LENGTH,
+    SECTION_OVERLAP,
+    SENTENCE_ENDINGS,
+    SENTENCE_SEARCH_LIMIT,
+    WORDS_BREAKS,
+    split_pages,
+)
+
+PAGE_COUNTS = [50, 500, 2000]
+WORDS_PER_PAGE = 400
+REPEAT = 3
+
+WORDS = ["Northwind", "Health", "Plus", "covers", "preventive", "care,", "emergency", "services;", "deductible:", "in-network", "(see", "above)", "the", "plan", "employee"]
+
+
+def synthetic_page_map(pages: int, seed: int = 0) -> list[tuple[int, int, str]]:
+    rng = random.Random(seed)
+    page_map, offset = [], 0
+    for page in range(pages):
+        parts = []
+        for _ in range(WORDS_PER_PAGE):
+            parts.append(rng.choice(WORDS) + ("." if rng.random() < 0.08 else ""))
+            if rng.random() < 0.002:
+                parts.append("<table><tr><td>Plan</td><td>Deductible</td></tr><tr><td>Plus</td><td>$1,500</td></tr></table>")
+        text = " ".join(parts) + "\n"
+        page_map.append((page, offset, text))
+        offset += len(text)
+    return page_map
+
+
+def linear_split_pages(page_map):
+    def find_page(offset):
+        num_pages = len(page_map)
+        for i in range(num_pages - 1):
+            if offset >= page_map[i][1] and offset < page_map[i + 1][1]:
+                return i
+        return num_pages - 1
+
+    all_text = "".join(p[2] for p in page_map)
+    length = len(all_text)
+    start = 0
+    end = length
+    while start + SECTION_OVERLAP < length:
+        last_word = -1
+        end = start + MAX_SECTION_LENGTH
+        if end > length:
+            end = length
+        else:
+            while end < length and (end - start - MAX_SECTION_LENGTH) < SENTENCE_SEARCH_LIMIT and all_text[end] not in SENTENCE_ENDINGS:
+                if all_text[end] in WORDS_BREAKS:
+                    last_word = end
+                end += 1
+            if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
+                end = last_word
+        if end < length:
+            end += 1
+        last_word = -1
+        while start > 0 and start > end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT and all_text[start] not in SENTENCE_ENDINGS:
+            if all_text[start] in WORDS_BREAKS:
+                last_word = start
+            start -= 1
+        if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
+            start = last_word
+        if start > 0:
+            start += 1
+        section_text = all_text[start:end]
+        yield (section_text, find_page(start))
+        last_table_start = section_text.rfind("<table")
+        if (last_table_start > 2 * SENTENCE_SEARCH_LIMIT and last_table_start > section_text.rfind("</table")):
+            start = min(end - SECTION_OVERLAP, start + last_table_start)
+        else:
+            start = end - SECTION_OVERLAP
+    if start + SECTION_OVERLAP < end:
+        yield (all_text[start:end], find_page(start))
+
+
+def best_of(split, page_map) -> tuple[float, list[tuple[str, int]]]:
+    best = float("inf")
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        sections = list(split(page_map))
+        best = min(best, time.perf_counter() - started)
+    return best, sections
+
+
+def main():
+    print(f"{WORDS_PER_PAGE} words per page, best of {REPEAT}")
+    for pages in PAGE_COUNTS:
+        page_map = synthetic_page_map(pages)
+        megabytes = sum(len(text) for _, _, text in page_map) / 1e6
+        linear_seconds, linear_sections = best_of(linear_split_pages, page_map)
+        seconds, sections = best_of(split_pages, page_map)
+        assert sections == linear_sections, "split_pages does not match the linear splitter"
+        print(f"  {pages:5d} pages, {len(sections):6d} sections")
+        print(f"    linear:      {linear_seconds * 1000:9.1f} ms  {megabytes / linear_seconds:7.2f} MB/s")
+        print(f"    split_pages: {seconds * 1000:9.1f} ms  {megabytes / seconds:7.2f} MB/s  ({linear_seconds / seconds:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
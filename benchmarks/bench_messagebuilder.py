@@ -0,0 +1,59 @@
+"""
+Microbenchmark of building the chat prompt for a 20-turn conversation, the way ChatReadRetrieveReadApproach does
+on every request: with cold token counts (every turn tokenized again, as before counts were memoized) and with
+warm ones (only the new turn tokenized). Run from the repository root:
+
+    python benchmarks/bench_messagebuilder.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app", "backend"))
+
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach  # noqa: E402
+from core import modelhelper  # noqa: E402
+
+TURNS = 20
+REPEAT = 50
+MODEL = "gpt-35-turbo"
+
+ANSWER = (
+    "Northwind Health Plus covers preventive care, emergency services, mental health and substance abuse treatment, "
+    "prescription drugs and vision care [Benefit_Options-2.pdf]. In-network deductibles are $1,500 per person and "
+    "$3,000 per family, and the out-of-pocket maximum is $6,000 per person [Northwind_Health_Plus_Benefits_Details-3.pdf]. "
+) * 4
+
+
+def history(turns: int) -> list[dict[str, str]]:
+    return [{"user": f"Question {turn} about my health plan and what it covers?", "bot": f"{turn}. {ANSWER}"} for turn in range(turns - 1)] + [
+        {"user": "And what about dental?"}
+    ]
+
+
+def build(approach: ChatReadRetrieveReadApproach, conversation: list[dict[str, str]]):
+    approach.get_messages_from_history(approach.system_message_chat_conversation, MODEL, conversation, conversation[-1]["user"], max_tokens=approach.chatgpt_token_limit)
+
+
+def main():
+    approach = ChatReadRetrieveReadApproach(None, "chat", MODEL, "ada", "sourcepage", "content")
+    conversation = history(TURNS)
+
+    def cold():
+        modelhelper._token_counts.clear()
+        modelhelper.get_encoding.cache_clear()
+        build(approach, conversation)
+
+    def warm():
+        build(approach, conversation)
+
+    build(approach, conversation)  # loads the BPE ranks, which tiktoken caches for the process either way
+    cold_seconds = min(timeit.repeat(cold, number=1, repeat=REPEAT))
+    warm_seconds = min(timeit.repeat(warm, number=1, repeat=REPEAT))
+    print(f"{TURNS}-turn history, best of {REPEAT}")
+    print(f"  cold token counts: {cold_seconds * 1000:8.3f} ms")
+    print(f"  warm token counts: {warm_seconds * 1000:8.3f} ms  ({cold_seconds / warm_seconds:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ import html
 import io
 import os
 import re
+import sys
 import time
 
 import openai
@@ -31,14 +32,17 @@ from azure.storage.blob import BlobServiceClient
 from pypdf import PdfReader, PdfWriter
 from tenacity import retry, stop_after_attempt, wait_random_exponential
 
-MAX_SECTION_LENGTH = 1000
-SENTENCE_SEARCH_LIMIT = 100
-SECTION_OVERLAP = 100
+# Share helpers with the backend, which also runs the indexing pipeline for uploads
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+from core.chunking import (  # noqa: E402
+    SECTION_OVERLAP_TOKENS,
+    check_section_tokens,
+    split_pages,
+    split_pages_by_tokens,
+)
+from core.tokenmanager import SyncTokenManager  # noqa: E402
 
-open_ai_token_cache = {}
-CACHE_KEY_TOKEN_CRED = 'openai_token_cred'
-CACHE_KEY_CREATED_TIME = 'created_time'
-CACHE_KEY_TOKEN_TYPE = 'token_type'
+openai_token_manager = None
 
 def blob_name_from_file_page(filename, page = 0):
     if os.path.splitext(filename)[1].lower() == ".pdf":
@@ -201,64 +205,11 @@ def get_document_text(filename):
 
 def split_text(page_map, uploaded_file=None):
     filename=uploaded_file.filename if uploaded_file else ""
-    SENTENCE_ENDINGS = [".", "!", "?"]
-    WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
     if args.verbose: print(f"Splitting '{filename}' into sections")
-
-    def find_page(offset):
-        num_pages = len(page_map)
-        for i in range(num_pages - 1):
-            if offset >= page_map[i][1] and offset < page_map[i + 1][1]:
-                return i
-        return num_pages - 1
-
-    all_text = "".join(p[2] for p in page_map)
-    length = len(all_text)
-    start = 0
-    end = length
-    while start + SECTION_OVERLAP < length:
-        last_word = -1
-        end = start + MAX_SECTION_LENGTH
-
-        if end > length:
-            end = length
-        else:
-            # Try to find the end of the sentence
-            while end < length and (end - start - MAX_SECTION_LENGTH) < SENTENCE_SEARCH_LIMIT and all_text[end] not in SENTENCE_ENDINGS:
-                if all_text[end] in WORDS_BREAKS:
-                    last_word = end
-                end += 1
-            if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
-                end = last_word # Fall back to at least keeping a whole word
-        if end < length:
-            end += 1
-
-        # Try to find the start of the sentence or at least a whole word boundary
-        last_word = -1
-        while start > 0 and start > end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT and all_text[start] not in SENTENCE_ENDINGS:
-            if all_text[start] in WORDS_BREAKS:
-                last_word = start
-            start -= 1
-        if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
-            start = last_word
-        if start > 0:
-            start += 1
-
-        section_text = all_text[start:end]
-        yield (section_text, find_page(start))
-
-        last_table_start = section_text.rfind("<table")
-        if (last_table_start > 2 * SENTENCE_SEARCH_LIMIT and last_table_start > section_text.rfind("</table")):
-            # If the section ends with an unclosed table, we need to start the next section with the table.
-            # If table starts inside SENTENCE_SEARCH_LIMIT, we ignore it, as that will cause an infinite loop for tables longer than MAX_SECTION_LENGTH
-            # If last table starts inside SECTION_OVERLAP, keep overlapping
-            if args.verbose: print(f"Section ends with unclosed table, starting next section with the table at page {find_page(start)} offset {start} table start {last_table_start}")
-            start = min(end - SECTION_OVERLAP, start + last_table_start)
-        else:
-            start = end - SECTION_OVERLAP
-
-    if start + SECTION_OVERLAP < end:
-        yield (all_text[start:end], find_page(start))
+    if args.sectiontokens:
+        yield from split_pages_by_tokens(page_map, max_tokens=args.sectiontokens, overlap_tokens=args.sectionoverlaptokens, verbose=args.verbose)
+    else:
+        yield from split_pages(page_map, verbose=args.verbose)
 
 def filename_to_id(filename):
     filename_ascii = re.sub("[^0-9a-zA-Z_-]", "_", filename)
@@ -432,12 +383,10 @@ def remove_from_index(filename, index_name=None):
 #         # It can take a few seconds for search results to reflect changes, so wait a bit
 #         time.sleep(2)
 
-# refresh open ai token every 5 minutes
+# the token manager refreshes the open ai token in the background, this just picks up the current one
 def refresh_openai_token():
-    if open_ai_token_cache[CACHE_KEY_TOKEN_TYPE] == 'azure_ad' and open_ai_token_cache[CACHE_KEY_CREATED_TIME] + 300 < time.time():
-        token_cred = open_ai_token_cache[CACHE_KEY_TOKEN_CRED]
-        openai.api_key = token_cred.get_token("https://cognitiveservices.azure.com/.default").token
-        open_ai_token_cache[CACHE_KEY_CREATED_TIME] = time.time()
+    if openai_token_manager is not None:
+        openai.api_key = openai_token_manager.get_token().token
 
 if __name__ == "__main__":
 
@@ -464,8 +413,15 @@ if __name__ == "__main__":
     parser.add_argument("--localpdfparser", action="store_true", help="Use PyPdf local PDF parser (supports only digital PDFs) instead of Azure Form Recognizer service to extract text, tables and layout from the documents")
     parser.add_argument("--formrecognizerservice", required=False, help="Optional. Name of the Azure Form Recognizer service which will be used to extract text, tables and layout from the documents (must exist already)")
     parser.add_argument("--formrecognizerkey", required=False, help="Optional. Use this Azure Form Recognizer account key instead of the current user identity to login (use az login to set current user for Azure)")
+    parser.add_argument("--sectiontokens", type=int, required=False, help="Optional. Split documents into sections of at most this many tokens of the embedding model instead of about 1000 characters")
+    parser.add_argument("--sectionoverlaptokens", type=int, default=SECTION_OVERLAP_TOKENS, help="Tokens each section overlaps the previous one by when --sectiontokens is set")
     parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
     args = parser.parse_args()
+    if args.sectiontokens:
+        try:
+            check_section_tokens(args.sectiontokens, args.sectionoverlaptokens)
+        except ValueError as e:
+            parser.error(str(e))
 
     # Use the current user identity to connect to Azure services unless a key is explicitly set for any of them
     azd_credential = AzureDeveloperCliCredential() if args.tenantid is None else AzureDeveloperCliCredential(tenant_id=args.tenantid, process_timeout=60)
@@ -484,11 +440,10 @@ if __name__ == "__main__":
 
     if use_vectors:
         if args.openaikey is None:
-            openai.api_key = azd_credential.get_token("https://cognitiveservices.azure.com/.default").token
+            openai_token_manager = SyncTokenManager(azd_credential)
+            openai_token_manager.start()
+            openai.api_key = openai_token_manager.get_token().token
             openai.api_type = "azure_ad"
-            open_ai_token_cache[CACHE_KEY_CREATED_TIME] = time.time()
-            open_ai_token_cache[CACHE_KEY_TOKEN_CRED] = azd_credential
-            open_ai_token_cache[CACHE_KEY_TOKEN_TYPE] = "azure_ad"
         else:
             openai.api_type = "azure"
             openai.api_key = args.openaikey
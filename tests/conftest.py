@@ -1,7 +1,10 @@
 from collections import namedtuple
+from datetime import datetime, timezone
+from types import SimpleNamespace
 from unittest import mock
 
 import pytest_asyncio
+from azure.core.exceptions import ResourceNotFoundError
 
 import app
 from approaches.approach import AskApproach
@@ -13,6 +16,12 @@ class MockedAskApproach(AskApproach):
         assert question == "What is the capital of France?"
         return {"answer": "Paris"}
 
+    async def run_stream(self, question, overrides):
+        assert question == "What is the capital of France?"
+        yield {"data_points": [], "thoughts": ""}
+        yield {"answer": "Par"}
+        yield {"answer": "is"}
+
 
 class MockedChatApproach(ChatReadRetrieveReadApproach):
     def __init__(self):
@@ -25,6 +34,11 @@ class MockedChatApproach(ChatReadRetrieveReadApproach):
         assert messages[1]["role"] == "user"
         return {"answer": "Paris", "data_points": [], "thoughts": ""}
 
+    async def run_stream(self, history, overrides):
+        yield {"data_points": [], "thoughts": ""}
+        yield {"answer": "Par"}
+        yield {"answer": "is"}
+
 
 MockToken = namedtuple("MockToken", ["token", "expires_on"])
 
@@ -34,8 +48,46 @@ class MockAzureCredential:
         return MockToken("mock_token", 9999999999)
 
 
+class MockBlobDownloader:
+    def __init__(self, data):
+        self.data = data
+
+    async def chunks(self):
+        for i in range(0, len(self.data), 4):
+            yield self.data[i : i + 4]
+
+
+class MockBlobClient:
+    def __init__(self, container, data):
+        self.container = container
+        self.data = data
+
+    async def get_blob_properties(self):
+        if self.data is None:
+            raise ResourceNotFoundError("The specified blob does not exist.")
+        return SimpleNamespace(
+            etag='"0x8DB9A1B2C3D4E5F"',
+            last_modified=datetime(2023, 8, 1, 12, 0, 0, tzinfo=timezone.utc),
+            size=len(self.data),
+            content_settings=SimpleNamespace(content_type="application/octet-stream"),
+        )
+
+    async def download_blob(self, offset=None, length=None, **kwargs):
+        self.container.downloads += 1
+        return MockBlobDownloader(self.data[offset : offset + length])
+
+
+class MockBlobContainerClient:
+    def __init__(self, blobs):
+        self.blobs = blobs
+        self.downloads = 0
+
+    def get_blob_client(self, path):
+        return MockBlobClient(self, self.blobs.get(path))
+
+
 @pytest_asyncio.fixture
-async def client(monkeypatch):
+async def client(monkeypatch, tmp_path):
     monkeypatch.setenv("AZURE_STORAGE_ACCOUNT", "test-storage-account")
     monkeypatch.setenv("AZURE_STORAGE_CONTAINER", "test-storage-container")
     monkeypatch.setenv("AZURE_SEARCH_INDEX", "test-search-index")
@@ -44,6 +96,10 @@ async def client(monkeypatch):
     monkeypatch.setenv("AZURE_OPENAI_CHATGPT_DEPLOYMENT", "test-chatgpt")
     monkeypatch.setenv("AZURE_OPENAI_CHATGPT_MODEL", "gpt-35-turbo")
     monkeypatch.setenv("AZURE_OPENAI_EMB_DEPLOYMENT", "test-ada")
+    monkeypatch.setenv("CONTENT_CACHE_DIR", str(tmp_path / "content-cache"))
+    monkeypatch.setenv("INGESTION_STORE_PATH", str(tmp_path / "ingestion.sqlite3"))
+    # Most tests ask the same question repeatedly and expect the approach to answer it each time
+    monkeypatch.setenv("ANSWER_CACHE_BACKEND", "none")
 
     with mock.patch("app.DefaultAzureCredential") as mock_default_azure_credential:
         mock_default_azure_credential.return_value = MockAzureCredential()
@@ -53,8 +109,9 @@ async def client(monkeypatch):
             quart_app.config.update(
                 {
                     "TESTING": True,
-                    app.CONFIG_ASK_APPROACHES: {"mock": MockedAskApproach()},
-                    app.CONFIG_CHAT_APPROACHES: {"mock": MockedChatApproach()},
+                    app.CONFIG_ASK_APPROACHES: {("natural-capital", "mock"): MockedAskApproach()},
+                    app.CONFIG_CHAT_APPROACHES: {("natural-capital", "mock"): MockedChatApproach()},
+                    app.CONFIG_BLOB_CONTAINER_CLIENT: {"natural-capital": MockBlobContainerClient({"employee_handbook-3.pdf": b"%PDF-1.4 handbook page"})},
                 }
             )
 
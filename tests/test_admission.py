@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from core.admission import CHAT, SEARCH, AdmissionController, AdmissionRejected
+
+
+@pytest.mark.asyncio
+async def test_limits_calls_in_flight():
+    admission = AdmissionController({CHAT: 2}, max_wait=1)
+    in_flight = 0
+    peak = 0
+
+    async def call():
+        nonlocal in_flight, peak
+        async with admission.admit(CHAT):
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+
+    await asyncio.gather(*[call() for _ in range(10)])
+    assert peak == 2
+    assert not admission.rejected
+
+
+@pytest.mark.asyncio
+async def test_rejects_after_max_wait():
+    admission = AdmissionController({SEARCH: 1}, max_wait=0.01, retry_after=7)
+    async with admission.admit(SEARCH):
+        with pytest.raises(AdmissionRejected) as exc_info:
+            async with admission.admit(SEARCH):
+                pass
+    assert exc_info.value.retry_after == 7
+    assert admission.rejected[SEARCH] == 1
+
+    # The slot is released and the rejected waiter didn't take one
+    async with admission.admit(SEARCH):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_does_not_leak_a_slot():
+    admission = AdmissionController({CHAT: 1}, max_wait=5)
+    async with admission.admit(CHAT):
+        waiter = asyncio.create_task(admission.admit(CHAT).__aenter__())
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+    assert not admission.semaphores[CHAT].locked()
+
+
+@pytest.mark.asyncio
+async def test_unlimited_upstreams_are_admitted():
+    admission = AdmissionController({CHAT: 0})
+    async with admission.admit(CHAT), admission.admit(SEARCH):
+        pass
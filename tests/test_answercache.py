@@ -0,0 +1,76 @@
+import time
+
+import pytest
+
+from core.answercache import (
+    AnswerCache,
+    MemoryAnswerCacheBackend,
+    SqliteAnswerCacheBackend,
+    answer_cache_key,
+)
+
+
+def test_key_normalizes_question_and_ignores_reporting_overrides():
+    key = answer_cache_key("ask", "rtr", ["energy"], "What is  the Capital?", {"top": 3})
+    assert key == answer_cache_key("ask", "rtr", ["energy"], " what is the capital? ", {"top": 3, "include_timings": True})
+    assert key != answer_cache_key("ask", "rtr", ["energy"], "What is the capital?", {"top": 5})
+    assert key != answer_cache_key("ask", "rrr", ["energy"], "What is the capital?", {"top": 3})
+    assert key != answer_cache_key("chat", "rtr", ["energy"], "What is the capital?", {"top": 3})
+    assert key != answer_cache_key("ask", "rtr", ["climate"], "What is the capital?", {"top": 3})
+    assert answer_cache_key("chat", "rrr", ["energy"], [{"user": "Hi  There"}], {}) == answer_cache_key("chat", "rrr", ["energy"], [{"user": "hi there"}], {})
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        backend = MemoryAnswerCacheBackend(max_entries=2)
+    else:
+        backend = SqliteAnswerCacheBackend(str(tmp_path / "answers.sqlite3"), max_entries=2)
+    yield backend
+    backend.close()
+
+
+@pytest.mark.asyncio
+async def test_least_recently_used_answer_is_evicted(backend):
+    cache = AnswerCache(backend)
+    await cache.set("a", ["energy"], {"answer": "A", "timings": {}})
+    await cache.set("b", ["energy"], {"answer": "B"})
+    assert await cache.get("a") == {"answer": "A"}
+    time.sleep(0.01)
+    await cache.set("c", ["energy"], {"answer": "C"})
+    assert await cache.get("b") is None
+    assert await cache.get("a") == {"answer": "A"}
+    assert await cache.get("c") == {"answer": "C"}
+
+
+@pytest.mark.asyncio
+async def test_answers_expire(backend):
+    cache = AnswerCache(backend, ttl=0.05)
+    await cache.set("a", ["energy"], {"answer": "A"})
+    assert await cache.get("a") == {"answer": "A"}
+    time.sleep(0.06)
+    assert await cache.get("a") is None
+
+
+@pytest.mark.asyncio
+async def test_invalidate_forgets_answers_that_searched_the_index(backend):
+    cache = AnswerCache(backend)
+    await cache.set("federated", ["energy", "climate"], {"answer": "F"})
+    await cache.set("other", ["energy-2"], {"answer": "O"})
+    assert await cache.invalidate("climate") == 1
+    assert await cache.get("federated") is None
+    assert await cache.get("other") == {"answer": "O"}
+
+
+@pytest.mark.asyncio
+async def test_sqlite_answers_are_shared_between_workers(tmp_path):
+    path = str(tmp_path / "answers.sqlite3")
+    first, second = AnswerCache(SqliteAnswerCacheBackend(path)), AnswerCache(SqliteAnswerCacheBackend(path))
+    try:
+        await first.set("a", ["energy"], {"answer": "A"})
+        assert await second.get("a") == {"answer": "A"}
+        await second.invalidate("energy")
+        assert await first.get("a") is None
+    finally:
+        first.close()
+        second.close()
@@ -1,4 +1,21 @@
+import asyncio
+import io
+import json
+import os
+from unittest import mock
+
+import openai
 import pytest
+from conftest import MockAzureCredential
+from prometheus_client import REGISTRY
+from werkzeug.datastructures import FileStorage
+
+import app
+import core.metrics
+from approaches.approach import AskApproach, ChatApproach
+from core.admission import AdmissionRejected
+from core.answercache import AnswerCache, MemoryAnswerCacheBackend
+from core.federatedsearch import FederatedSearchClient
 
 
 @pytest.mark.asyncio
@@ -55,3 +72,491 @@ async def test_chat_mock_approach(client):
     assert response.status_code == 200
     result = await response.get_json()
     assert result["answer"] == "Paris"
+
+
+@pytest.mark.asyncio
+async def test_ask_stream_with_unknown_approach(client):
+    response = await client.post("/ask_stream", json={"approach": "test"})
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_ask_stream_mock_approach(client):
+    response = await client.post("/ask_stream", json={"approach": "mock", "question": "What is the capital of France?"})
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert events[0] == {"data_points": [], "thoughts": ""}
+    assert "".join(e.get("answer", "") for e in events) == "Paris"
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_mock_approach(client):
+    response = await client.post(
+        "/chat_stream",
+        json={
+            "approach": "mock",
+            "history": [{"user": "What is the capital of France?"}],
+        },
+    )
+    assert response.status_code == 200
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert events[0] == {"data_points": [], "thoughts": ""}
+    assert "".join(e.get("answer", "") for e in events) == "Paris"
+
+
+@pytest.mark.asyncio
+async def test_requests_share_pooled_openai_session(client):
+    sessions = []
+
+    class SessionRecordingApproach(AskApproach):
+        async def run(self, question, overrides):
+            sessions.append(openai.aiosession.get())
+            return {"answer": "Paris"}
+
+    client.app.config[app.CONFIG_ASK_APPROACHES][("natural-capital", "recording")] = SessionRecordingApproach()
+    for _ in range(2):
+        response = await client.post("/ask", json={"approach": "recording", "question": "What is the capital of France?"})
+        assert response.status_code == 200
+    assert sessions[0] is sessions[1] is client.app.config[app.CONFIG_OPENAI_SESSION]
+    assert not sessions[0].closed
+
+
+@pytest.mark.asyncio
+async def test_content_file(client):
+    response = await client.get("/content/natural-capital/employee_handbook-3.pdf")
+    assert response.status_code == 200
+    assert response.mimetype == "application/pdf"
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.headers["ETag"] == '"0x8DB9A1B2C3D4E5F"'
+    assert response.headers["Content-Length"] == "22"
+    assert await response.get_data() == b"%PDF-1.4 handbook page"
+
+
+@pytest.mark.asyncio
+async def test_content_file_unknown_index(client):
+    response = await client.get("/content/unknown-index/employee_handbook-3.pdf")
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_content_file_not_found(client):
+    response = await client.get("/content/natural-capital/missing.pdf")
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_content_file_range(client):
+    response = await client.get("/content/natural-capital/employee_handbook-3.pdf", headers={"Range": "bytes=9-16"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 9-16/22"
+    assert await response.get_data() == b"handbook"
+
+
+@pytest.mark.asyncio
+async def test_content_file_range_not_satisfiable(client):
+    response = await client.get("/content/natural-capital/employee_handbook-3.pdf", headers={"Range": "bytes=100-200"})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */22"
+
+
+@pytest.mark.asyncio
+async def test_content_file_stale_if_range_sends_whole_file(client):
+    response = await client.get("/content/natural-capital/employee_handbook-3.pdf", headers={"Range": "bytes=9-16", "If-Range": '"0xOLD"'})
+    assert response.status_code == 200
+    assert await response.get_data() == b"%PDF-1.4 handbook page"
+
+
+@pytest.mark.asyncio
+async def test_content_file_not_modified(client):
+    response = await client.get("/content/natural-capital/employee_handbook-3.pdf", headers={"If-None-Match": '"0x8DB9A1B2C3D4E5F"'})
+    assert response.status_code == 304
+    assert await response.get_data() == b""
+
+    response = await client.get("/content/natural-capital/employee_handbook-3.pdf", headers={"If-Modified-Since": "Tue, 01 Aug 2023 12:00:00 GMT"})
+    assert response.status_code == 304
+
+
+@pytest.mark.asyncio
+async def test_content_file_served_from_cache(client):
+    container = client.app.config[app.CONFIG_BLOB_CONTAINER_CLIENT]["natural-capital"]
+    response = await client.get("/content/natural-capital/employee_handbook-3.pdf")
+    assert await response.get_data() == b"%PDF-1.4 handbook page"
+    assert container.downloads == 1
+
+    response = await client.get("/content/natural-capital/employee_handbook-3.pdf")
+    assert response.status_code == 200
+    assert await response.get_data() == b"%PDF-1.4 handbook page"
+    response = await client.get("/content/natural-capital/employee_handbook-3.pdf", headers={"Range": "bytes=9-16"})
+    assert response.status_code == 206
+    assert await response.get_data() == b"handbook"
+    assert container.downloads == 1
+
+
+@pytest.mark.asyncio
+async def test_approaches_are_built_on_first_use(monkeypatch):
+    monkeypatch.setenv("AZURE_OPENAI_CHATGPT_MODEL", "gpt-35-turbo")
+    monkeypatch.setenv("WARMUP_APPROACHES", "energy/rtr")
+    monkeypatch.setenv("CONTENT_CACHE_MAX_BYTES", "0")
+    with mock.patch("app.DefaultAzureCredential") as mock_default_azure_credential:
+        mock_default_azure_credential.return_value = MockAzureCredential()
+        quart_app = app.create_app()
+        async with quart_app.test_app():
+            ask_approaches = quart_app.config[app.CONFIG_ASK_APPROACHES]
+            search_clients = quart_app.config[app.CONFIG_SEARCH_CLIENTS]
+            assert len(ask_approaches) == 1
+            assert len(search_clients) == 1
+
+            approach = ask_approaches.get(("adaptation", "rrr"))
+            assert approach is ask_approaches.get(("adaptation", "rrr"))
+            assert approach.search_client is search_clients.get("adaptation")
+            assert ask_approaches.get(("unknown-index", "rrr")) is None
+            assert ask_approaches.get(("adaptation", "unknown")) is None
+            assert len(ask_approaches) == 2
+            assert len(search_clients) == 2
+
+
+@pytest.mark.asyncio
+async def test_index_defaults_are_applied_under_request_overrides(client):
+    received = []
+
+    class OverridesRecordingApproach(AskApproach):
+        async def run(self, question, overrides):
+            received.append(overrides)
+            return {"answer": "Paris"}
+
+    client.app.config[app.CONFIG_INDEX_REGISTRY].get("natural-capital").defaults = {"top": 5, "semantic_ranker": True}
+    client.app.config[app.CONFIG_ASK_APPROACHES][("natural-capital", "recording")] = OverridesRecordingApproach()
+    response = await client.post("/ask", json={"approach": "recording", "question": "Q", "overrides": {"top": 2, "retrieval_mode": None}})
+    assert response.status_code == 200
+    assert received[0] == {"top": 2, "semantic_ranker": True}
+
+
+@pytest.mark.asyncio
+async def test_ask_with_unknown_index(client):
+    response = await client.post("/ask", json={"approach": "mock", "question": "Q", "overrides": {"index_name": "unknown"}})
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_index_registry_reload_swaps_only_changed_indices(monkeypatch, tmp_path):
+    registry_file = tmp_path / "indices.json"
+    registry_file.write_text(json.dumps({"indices": {"energy": {}, "adaptation": {}}}))
+    os.utime(registry_file, (1000, 1000))
+    monkeypatch.setenv("INDEX_REGISTRY_FILE", str(registry_file))
+    monkeypatch.setenv("INDEX_REGISTRY_RELOAD_INTERVAL", "0.01")
+    monkeypatch.setenv("CONTENT_CACHE_MAX_BYTES", "0")
+    with mock.patch("app.DefaultAzureCredential") as mock_default_azure_credential:
+        mock_default_azure_credential.return_value = MockAzureCredential()
+        quart_app = app.create_app()
+        async with quart_app.test_app():
+            registry = quart_app.config[app.CONFIG_INDEX_REGISTRY]
+            ask_approaches = quart_app.config[app.CONFIG_ASK_APPROACHES]
+            search_clients = quart_app.config[app.CONFIG_SEARCH_CLIENTS]
+            energy = ask_approaches.get(("energy", "rtr"))
+            adaptation = ask_approaches.get(("adaptation", "rtr"))
+            assert ask_approaches.get(("infrastructure", "rtr")) is None
+
+            registry_file.write_text(json.dumps({"indices": {"energy": {}, "adaptation": {"content_field": "text"}, "infrastructure": {}}}))
+            os.utime(registry_file, (2000, 2000))
+            for _ in range(100):
+                if registry.get("infrastructure"):
+                    break
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.01)
+
+            assert ("energy", "rtr") in ask_approaches
+            assert ("adaptation", "rtr") not in ask_approaches
+            assert "adaptation" not in search_clients
+            assert ask_approaches.get(("energy", "rtr")) is energy
+            assert ask_approaches.get(("adaptation", "rtr")) is not adaptation
+            assert ask_approaches.get(("adaptation", "rtr")).content_field == "text"
+            assert ask_approaches.get(("infrastructure", "rtr")) is not None
+
+
+@pytest.mark.asyncio
+async def test_upload_is_queued_and_reports_status(client):
+    ingested = []
+
+    def fake_add_file(file_name, file_content, index, container, credential, on_progress):
+        on_progress("indexing", 3)
+        ingested.append((file_name, file_content, index, container))
+        return 3
+
+    with mock.patch("app.add_file", fake_add_file):
+        response = await client.post(
+            "/upload?index_name=natural-capital",
+            files={"file": FileStorage(io.BytesIO(b"%PDF-1.4"), filename="report.pdf")},
+        )
+        assert response.status_code == 202
+        job = await response.get_json()
+        # Saving the job yields to the event loop, so a free ingestion worker may already have picked it up
+        assert job["status"] in ("queued", "running")
+        assert response.headers["Location"] == f"/upload/{job['job_id']}"
+
+        for _ in range(100):
+            status = await (await client.get(f"/upload/{job['job_id']}")).get_json()
+            if status["status"] == "succeeded":
+                break
+            await asyncio.sleep(0.01)
+    assert status["status"] == "succeeded"
+    assert status["sections"] == 3
+    assert ingested == [("report.pdf", b"%PDF-1.4", "natural-capital", "natural-capital")]
+
+
+@pytest.mark.asyncio
+async def test_upload_status_unknown_job(client):
+    response = await client.get("/upload/unknown")
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_upload_without_file(client):
+    response = await client.post("/upload", form={"other": "value"})
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_ask_sheds_load_with_429(client):
+    class SaturatedApproach(AskApproach):
+        async def run(self, question, overrides):
+            raise AdmissionRejected("chat", 3)
+
+    client.app.config[app.CONFIG_ASK_APPROACHES][("natural-capital", "saturated")] = SaturatedApproach()
+    response = await client.post("/ask", json={"approach": "saturated", "question": "Q"})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "3"
+
+
+@pytest.mark.asyncio
+async def test_openai_rate_limit_becomes_429(client):
+    class RateLimitedApproach(ChatApproach):
+        async def run(self, history, overrides):
+            raise openai.error.RateLimitError("Requests to the Creates a completion operation have exceeded rate limit", headers={"retry-after": "12"})
+
+    client.app.config[app.CONFIG_CHAT_APPROACHES][("natural-capital", "limited")] = RateLimitedApproach()
+    response = await client.post("/chat", json={"approach": "limited", "history": [{"user": "Q"}]})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "12"
+
+    response = await client.post("/chat_stream", json={"approach": "limited", "history": [{"user": "Q"}]})
+    assert response.status_code == 429
+
+
+@pytest.mark.asyncio
+async def test_federated_approach_is_built_for_index_names(monkeypatch):
+    monkeypatch.setenv("AZURE_OPENAI_CHATGPT_MODEL", "gpt-35-turbo")
+    monkeypatch.setenv("CONTENT_CACHE_MAX_BYTES", "0")
+    with mock.patch("app.DefaultAzureCredential") as mock_default_azure_credential:
+        mock_default_azure_credential.return_value = MockAzureCredential()
+        quart_app = app.create_app()
+        async with quart_app.test_app():
+            async with quart_app.app_context():
+                index_key, overrides = app.resolve_index({"index_names": ["energy", "climate-financing", "energy"], "top": 6})
+                assert index_key == ("energy", "climate-financing")
+                assert app.resolve_index({"index_names": ["energy", "unknown"]})[0] is None
+
+            approach = quart_app.config[app.CONFIG_ASK_APPROACHES].get((index_key, "rtr"))
+            assert isinstance(approach.search_client, FederatedSearchClient)
+            search_clients = quart_app.config[app.CONFIG_SEARCH_CLIENTS]
+            assert approach.search_client.search_clients == {"energy": search_clients.get("energy"), "climate-financing": search_clients.get("climate-financing")}
+
+
+@pytest.mark.asyncio
+async def test_ask_batch_streams_results_as_they_finish(client):
+    in_flight = 0
+    peak = 0
+
+    class SlowApproach(AskApproach):
+        async def run(self, question, overrides):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(overrides["delay"])
+            in_flight -= 1
+            if question == "busy":
+                raise AdmissionRejected("chat", 4)
+            return {"answer": question.upper()}
+
+    client.app.config[app.CONFIG_ASK_APPROACHES][("natural-capital", "slow")] = SlowApproach()
+    client.app.config[app.CONFIG_ASK_BATCH_CONCURRENCY] = 2
+    items = [
+        {"approach": "slow", "question": "first", "overrides": {"delay": 0.05}},
+        {"approach": "slow", "question": "second", "overrides": {"delay": 0.01}},
+        {"approach": "unknown", "question": "third"},
+        {"approach": "slow", "question": "busy", "overrides": {"delay": 0.01}},
+    ]
+    response = await client.post("/ask/batch", json={"items": items})
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+
+    assert [event["index"] for event in events][:2] == [2, 1]
+    by_index = {event["index"]: event for event in events}
+    assert by_index[0] == {"index": 0, "status": 200, "result": {"answer": "FIRST"}}
+    assert by_index[2]["status"] == 400
+    assert by_index[3]["status"] == 429 and by_index[3]["retry_after"] == "4"
+    assert peak == 2
+
+
+@pytest.mark.asyncio
+async def test_ask_batch_validates_items(client):
+    response = await client.post("/ask/batch", json={"items": []})
+    assert response.status_code == 400
+    response = await client.post("/ask/batch", json={"items": [{"approach": "mock", "question": "Q"}, "hi"]})
+    assert response.status_code == 400
+    response = await client.post("/ask/batch", json={"items": [{"approach": "mock", "question": "Q", "overrides": ["top"]}]})
+    assert response.status_code == 400
+    response = await client.post("/ask/batch", json=["hi"])
+    assert response.status_code == 400
+    response = await client.post("/ask/batch", json={"items": [{"approach": "mock", "question": "Q"}, {"approach": "mock"}]})
+    assert response.status_code == 400
+    response = await client.post("/ask/batch", json={"items": [{"approach": "mock", "question": ["Q"]}]})
+    assert response.status_code == 400
+
+    client.app.config[app.CONFIG_ASK_BATCH_MAX_ITEMS] = 1
+    response = await client.post("/ask/batch", json={"items": [{"approach": "mock", "question": "Q"}] * 2})
+    assert response.status_code == 413
+
+
+@pytest.mark.asyncio
+async def test_timings_are_recorded_and_only_returned_on_request(client):
+    class TimedApproach(AskApproach):
+        async def run(self, question, overrides):
+            return {"answer": "Paris", "timings": {"stages_ms": {"search": 120.0}, "total_ms": 300.0, "tokens": {"completion": {"total_tokens": 50}}}}
+
+    client.app.config[app.CONFIG_ASK_APPROACHES][("natural-capital", "timed")] = TimedApproach()
+    labels = {"approach": "timed", "index": "natural-capital", "stage": "search"}
+    before = REGISTRY.get_sample_value("approach_stage_seconds_count", labels) or 0
+
+    response = await client.post("/ask", json={"approach": "timed", "question": "Q"})
+    assert "timings" not in await response.get_json()
+    response = await client.post("/ask", json={"approach": "timed", "question": "Q", "overrides": {"include_timings": True}})
+    assert (await response.get_json())["timings"]["stages_ms"] == {"search": 120.0}
+
+    assert REGISTRY.get_sample_value("approach_stage_seconds_count", labels) == before + 2
+    assert REGISTRY.get_sample_value("approach_tokens_total", {"approach": "timed", "index": "natural-capital", "stage": "completion", "kind": "total_tokens"}) >= 100
+
+
+@pytest.mark.asyncio
+async def test_stream_timings_event_is_dropped_unless_requested(client):
+    class TimedStreamApproach(AskApproach):
+        async def run(self, question, overrides):
+            return {}
+
+        async def run_stream(self, question, overrides):
+            yield {"data_points": [], "thoughts": ""}
+            yield {"answer": "Paris"}
+            yield {"timings": {"stages_ms": {}, "total_ms": 1.0, "tokens": {}}}
+
+    client.app.config[app.CONFIG_ASK_APPROACHES][("natural-capital", "timed")] = TimedStreamApproach()
+    response = await client.post("/ask_stream", json={"approach": "timed", "question": "Q"})
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert events == [{"data_points": [], "thoughts": ""}, {"answer": "Paris"}]
+
+    response = await client.post("/ask_stream", json={"approach": "timed", "question": "Q", "overrides": {"include_timings": True}})
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert events[-1]["timings"]["total_ms"] == 1.0
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(client):
+    await client.post("/ask", json={"approach": "mock", "question": "Q"})
+    await client.get("/content/natural-capital/employee_handbook-3.pdf")
+    await client.get("/content/natural-capital/employee_handbook-3.pdf")
+
+    response = await client.get("/metrics")
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+    body = await response.get_data(as_text=True)
+    assert 'http_requests_total{method="POST",route="/ask",status="200"}' in body
+    assert 'http_request_seconds_count{approach="mock",index="natural-capital",route="/ask"}' in body
+    assert 'cache_requests_total{cache="content",result="hit"}' in body
+    assert "event_loop_lag_seconds_bucket" in body
+
+
+@pytest.mark.asyncio
+async def test_metrics_are_aggregated_across_processes(monkeypatch, tmp_path):
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    from prometheus_client import values
+    from prometheus_client.metrics import Counter
+
+    # Simulate two workers writing to the shared directory
+    monkeypatch.setattr(values, "ValueClass", values.MultiProcessValue(lambda: 101))
+    Counter("worker_test_requests", "test", registry=None).inc(2)
+    monkeypatch.setattr(values, "ValueClass", values.MultiProcessValue(lambda: 102))
+    Counter("worker_test_requests", "test", registry=None).inc(3)
+
+    body, _ = core.metrics.render_metrics()
+    assert b"worker_test_requests_total 5.0" in body
+
+
+@pytest.mark.asyncio
+async def test_repeated_questions_are_answered_from_the_cache(client):
+    questions = []
+
+    class CountingApproach(AskApproach):
+        async def run(self, question, overrides):
+            questions.append(question)
+            return {"answer": "Paris", "data_points": [], "thoughts": "", "timings": {"stages_ms": {}, "total_ms": 1.0, "tokens": {}}}
+
+    client.app.config[app.CONFIG_ANSWER_CACHE] = AnswerCache(MemoryAnswerCacheBackend())
+    client.app.config[app.CONFIG_ASK_APPROACHES][("natural-capital", "counting")] = CountingApproach()
+
+    response = await client.post("/ask", json={"approach": "counting", "question": "Capital of France?"})
+    assert (await response.get_json())["answer"] == "Paris"
+    response = await client.post("/ask", json={"approach": "counting", "question": "  capital of   FRANCE? ", "overrides": {"include_timings": True}})
+    assert await response.get_json() == {"answer": "Paris", "data_points": [], "thoughts": ""}
+    assert len(questions) == 1
+
+    # Overrides that change the answer are part of the key
+    await client.post("/ask", json={"approach": "counting", "question": "Capital of France?", "overrides": {"top": 1}})
+    assert len(questions) == 2
+
+
+@pytest.mark.asyncio
+async def test_only_first_chat_turn_is_cached(client):
+    histories = []
+
+    class CountingChatApproach(ChatApproach):
+        async def run(self, history, overrides):
+            histories.append(history)
+            return {"answer": "Paris", "data_points": [], "thoughts": ""}
+
+    client.app.config[app.CONFIG_ANSWER_CACHE] = AnswerCache(MemoryAnswerCacheBackend())
+    client.app.config[app.CONFIG_CHAT_APPROACHES][("natural-capital", "counting")] = CountingChatApproach()
+
+    first_turn = [{"user": "Capital of France?"}]
+    later_turn = [{"user": "Capital of France?", "bot": "Paris"}, {"user": "And Spain?"}]
+    for history in (first_turn, first_turn, later_turn, later_turn):
+        response = await client.post("/chat", json={"approach": "counting", "history": history})
+        assert response.status_code == 200
+    assert histories == [first_turn, later_turn, later_turn]
+
+
+@pytest.mark.asyncio
+async def test_streamed_answer_is_cached_and_replayed(client):
+    streams = []
+
+    class StreamingApproach(AskApproach):
+        async def run(self, question, overrides):
+            raise AssertionError("answered from the cache")
+
+        async def run_stream(self, question, overrides):
+            streams.append(question)
+            yield {"data_points": ["a.pdf: A"], "thoughts": "T"}
+            yield {"answer": "Par"}
+            yield {"answer": "is"}
+
+    client.app.config[app.CONFIG_ANSWER_CACHE] = AnswerCache(MemoryAnswerCacheBackend())
+    client.app.config[app.CONFIG_ASK_APPROACHES][("natural-capital", "streaming")] = StreamingApproach()
+
+    response = await client.post("/ask_stream", json={"approach": "streaming", "question": "Q"})
+    assert len((await response.get_data()).splitlines()) == 3
+    response = await client.post("/ask_stream", json={"approach": "streaming", "question": "Q"})
+    events = [json.loads(line) for line in (await response.get_data()).splitlines()]
+    assert events == [{"data_points": ["a.pdf: A"], "thoughts": "T"}, {"answer": "Paris"}]
+    assert streams == ["Q"]
+
+    response = await client.post("/ask", json={"approach": "streaming", "question": "Q"})
+    assert await response.get_json() == {"answer": "Paris", "data_points": ["a.pdf: A"], "thoughts": "T"}
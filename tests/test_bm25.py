@@ -0,0 +1,67 @@
+import math
+
+import pytest
+
+from core.bm25 import BM25Index, tokenize
+
+SECTIONS = [
+    {"id": "a-page-0", "content": "The whistleblower policy protects employees who report concerns.", "category": None, "sourcepage": "a-1.pdf", "sourcefile": "a.pdf"},
+    {"id": "a-page-1", "content": "Employees report concerns to their manager.", "category": None, "sourcepage": "a-2.pdf", "sourcefile": "a.pdf"},
+    {"id": "b-page-0", "content": "Deductibles for the employee plan. Deductibles for the family plan.", "category": "benefits", "sourcepage": "b-1.pdf", "sourcefile": "b.pdf"},
+]
+
+
+def test_tokenize_lowercases_words():
+    assert tokenize("In-network Deductibles: $500") == ["in", "network", "deductibles", "500"]
+
+
+def test_search_ranks_with_bm25():
+    index = BM25Index()
+    index.add(SECTIONS)
+    results = index.search("whistleblower concerns")
+    assert [slot for slot, _ in results] == [0, 1]
+
+    # A term in one document of three, at the average document length, scores idf * (k1 + 1) / (1 + k1)
+    average_length = sum(len(tokenize(section["content"])) for section in SECTIONS) / 3
+    index = BM25Index()
+    index.add([{"id": str(i), "content": " ".join(["word"] * int(average_length))} for i in range(2)] + [{"id": "2", "content": "rare " + " ".join(["word"] * (int(average_length) - 1))}])
+    [(slot, score)] = index.search("rare")
+    assert slot == 2
+    assert score == pytest.approx(math.log(1 + (3 - 1 + 0.5) / 1.5), rel=1e-5)
+
+
+def test_category_filter_matches_exclude_category():
+    index = BM25Index()
+    index.add(SECTIONS)
+    assert {slot for slot, _ in index.search("employees plan")} == {0, 1, 2}
+    assert {slot for slot, _ in index.search("employees plan", allowed=index.filter_mask("category ne 'benefits'"))} == {0, 1}
+    assert [slot for slot, _ in index.search("employees plan", allowed=index.filter_mask("category eq 'benefits'"))] == [2]
+    with pytest.raises(ValueError):
+        index.filter_mask("search.in(category, 'benefits')")
+
+
+def test_add_replaces_and_remove_sourcefile_deletes():
+    index = BM25Index()
+    index.add(SECTIONS)
+    index.add([{**SECTIONS[0], "content": "The travel policy."}])
+    assert len(index) == 3
+    assert [slot for slot, _ in index.search("whistleblower")] == []
+    assert [slot for slot, _ in index.search("travel")] == [3]
+
+    assert index.remove_sourcefile("/data/a.pdf") == 2
+    assert [slot for slot, _ in index.search("travel concerns employee")] == [2]
+    # The postings of removed documents are compacted away once they are the majority
+    index.remove(["b-page-0"])
+    assert len(index) == 0
+    assert index.postings == {}
+
+
+def test_save_and_load(tmp_path):
+    index = BM25Index()
+    index.add(SECTIONS)
+    index.remove(["a-page-1"])
+    index.save(tmp_path / "bm25.npz")
+    loaded = BM25Index.load(tmp_path / "bm25.npz", index.documents)
+    assert loaded.search("employees concerns plan") == index.search("employees concerns plan")
+    loaded.add([{"id": "c-page-0", "content": "Concerns about parking."}])
+    assert [slot for slot, _ in loaded.search("concerns")][0] == 3
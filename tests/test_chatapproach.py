@@ -0,0 +1,157 @@
+import openai
+import pytest
+from openai.openai_object import OpenAIObject
+
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from core.semanticcache import SemanticCache
+
+
+class MockAsyncSearchResultsIterator:
+    def __init__(self, results):
+        self.results = results
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.results:
+            raise StopAsyncIteration
+        return self.results.pop(0)
+
+
+class MockSearchClient:
+    async def search(self, *args, **kwargs):
+        return MockAsyncSearchResultsIterator([{"sourcepage": "Benefit_Options-2.pdf", "content": "There is a whistleblower policy."}])
+
+
+def completion(content):
+    return OpenAIObject.construct_from({"choices": [{"message": {"role": "assistant", "content": content}}]})
+
+
+async def mock_streaming_completion(deltas):
+    # Azure OpenAI starts the stream with a chunk that has no choices
+    yield OpenAIObject.construct_from({"choices": []})
+    yield OpenAIObject.construct_from({"choices": [{"delta": {"role": "assistant"}}]})
+    for delta in deltas:
+        yield OpenAIObject.construct_from({"choices": [{"delta": {"content": delta}}]})
+
+
+@pytest.fixture
+def chat_approach(monkeypatch):
+    async def mock_acreate(*args, **kwargs):
+        if kwargs.get("stream"):
+            return mock_streaming_completion(["The policy ", "is in ", "[Benefit_Options-2.pdf]"])
+        if kwargs["max_tokens"] == 32:
+            rewrite = completion("whistleblower policy")
+            rewrite["usage"] = {"prompt_tokens": 40, "completion_tokens": 3, "total_tokens": 43}
+            return rewrite
+        return completion("The policy is in [Benefit_Options-2.pdf]")
+
+    async def mock_embedding_acreate(*args, **kwargs):
+        return {"data": [{"embedding": [0.0] * 1536}]}
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", mock_acreate)
+    monkeypatch.setattr(openai.Embedding, "acreate", mock_embedding_acreate)
+    return ChatReadRetrieveReadApproach(MockSearchClient(), "chatgpt", "gpt-35-turbo", "ada", "sourcepage", "content")
+
+
+@pytest.mark.asyncio
+async def test_run(chat_approach):
+    result = await chat_approach.run([{"user": "What is the whistleblower policy?"}], {})
+    assert result["answer"] == "The policy is in [Benefit_Options-2.pdf]"
+    assert result["data_points"] == ["Benefit_Options-2.pdf: There is a whistleblower policy."]
+    assert result["timings"]["tokens"] == {"query_rewrite": {"prompt_tokens": 40, "completion_tokens": 3, "total_tokens": 43}}
+    assert set(result["timings"]["stages_ms"]) == {"query_rewrite", "embedding", "search", "search_results", "prompt", "completion"}
+
+
+@pytest.mark.asyncio
+async def test_run_stream(chat_approach):
+    events = [event async for event in chat_approach.run_stream([{"user": "What is the whistleblower policy?"}], {})]
+    assert events[0]["data_points"] == ["Benefit_Options-2.pdf: There is a whistleblower policy."]
+    assert "Searched for:<br>whistleblower policy" in events[0]["thoughts"]
+    assert "answer" not in events[0]
+    assert [event["answer"] for event in events[1:-1]] == ["The policy ", "is in ", "[Benefit_Options-2.pdf]"]
+    assert set(events[-1]["timings"]["stages_ms"]) == {"query_rewrite", "embedding", "search", "search_results", "prompt", "completion_first_chunk", "completion_stream"}
+
+
+@pytest.mark.asyncio
+async def test_paraphrased_first_turn_is_answered_from_semantic_cache(chat_approach, monkeypatch):
+    vectors = {"whistleblower policy": [1.0, 0.0, 0.0], "whistle-blower policy": [0.99, 0.05, 0.0], "parking": [0.0, 1.0, 0.0]}
+    rewrites = iter(vectors)
+
+    async def mock_acreate(*args, **kwargs):
+        if kwargs.get("stream"):
+            return mock_streaming_completion(["The policy ", "is in ", "[Benefit_Options-2.pdf]"])
+        if kwargs["max_tokens"] == 32:
+            return completion(next(rewrites))
+        raise AssertionError("answered from the semantic cache")
+
+    async def mock_embedding_acreate(*args, **kwargs):
+        return {"data": [{"embedding": vectors[kwargs["input"]]}]}
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", mock_acreate)
+    monkeypatch.setattr(openai.Embedding, "acreate", mock_embedding_acreate)
+    chat_approach.semantic_cache = SemanticCache(threshold=0.95).for_indices(["natural-capital"])
+
+    events = [event async for event in chat_approach.run_stream([{"user": "What is the whistleblower policy?"}], {})]
+    assert events[0]["semantic_cache"] == {"hit": False}
+
+    result = await chat_approach.run([{"user": "Tell me about the whistle-blower policy"}], {})
+    assert result["answer"] == "The policy is in [Benefit_Options-2.pdf]"
+    assert result["data_points"] == ["Benefit_Options-2.pdf: There is a whistleblower policy."]
+    assert result["semantic_cache"]["hit"] and result["semantic_cache"]["similarity"] > 0.99
+    assert "search" not in result["timings"]["stages_ms"]
+
+    events = [event async for event in chat_approach.run_stream([{"user": "Where do I park?"}], {})]
+    assert events[0]["semantic_cache"] == {"hit": False}
+
+
+class RecordingSearchClient(MockSearchClient):
+    def __init__(self):
+        self.queries = []
+        self.selects = []
+
+    async def search(self, *args, **kwargs):
+        self.queries.append(args[0])
+        self.selects.append(kwargs.get("select"))
+        return await super().search(*args, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_skip_rewrite_searches_first_question_as_asked(chat_approach):
+    chat_approach.search_client = RecordingSearchClient()
+    result = await chat_approach.run([{"user": "What is the whistleblower policy?"}], {"query_rewrite": "skip"})
+    assert chat_approach.search_client.queries == ["What is the whistleblower policy?"]
+    assert "query_rewrite" not in result["timings"]["stages_ms"]
+
+    # Later turns still need the history folded into the query
+    history = [{"user": "What is the whistleblower policy?", "bot": "It is in the handbook"}, {"user": "Who handles reports?"}]
+    result = await chat_approach.run(history, {"query_rewrite": "skip"})
+    assert chat_approach.search_client.queries[-1] == "whistleblower policy"
+    assert "query_rewrite" in result["timings"]["stages_ms"]
+
+
+@pytest.mark.asyncio
+async def test_speculative_search_is_used_when_rewrite_keeps_the_question(chat_approach):
+    chat_approach.search_client = RecordingSearchClient()
+    result = await chat_approach.run([{"user": "Whistleblower policy?"}], {"query_rewrite": "speculative"})
+    assert chat_approach.search_client.queries == ["Whistleblower policy?"]
+    assert result["data_points"] == ["Benefit_Options-2.pdf: There is a whistleblower policy."]
+    assert {"query_rewrite", "search"} <= set(result["timings"]["stages_ms"])
+
+
+@pytest.mark.asyncio
+async def test_speculative_search_is_discarded_when_rewrite_differs(chat_approach):
+    chat_approach.search_client = RecordingSearchClient()
+    result = await chat_approach.run([{"user": "What is the whistleblower policy?"}], {"query_rewrite": "speculative"})
+    assert chat_approach.search_client.queries[-1] == "whistleblower policy"
+    assert result["answer"] == "The policy is in [Benefit_Options-2.pdf]"
+    assert "search" in result["timings"]["stages_ms"]
+
+
+@pytest.mark.asyncio
+async def test_search_selects_fields_and_only_returns_vectors_on_request(chat_approach):
+    chat_approach.search_client = RecordingSearchClient()
+    await chat_approach.run([{"user": "What is the whistleblower policy?"}], {})
+    await chat_approach.run([{"user": "What is the whistleblower policy?"}], {"include_vectors": True})
+    assert chat_approach.search_client.selects == [["id", "sourcepage", "content"], ["id", "sourcepage", "content", "embedding"]]
@@ -0,0 +1,210 @@
+import importlib
+import random
+import re
+from itertools import islice
+
+import pytest
+
+from core.chunking import (
+    MAX_SECTION_LENGTH,
+    SECTION_OVERLAP,
+    SENTENCE_SEARCH_LIMIT,
+    TextBoundaries,
+    check_section_tokens,
+    split_pages,
+    split_pages_by_tokens,
+    token_offsets,
+)
+
+
+def reference_split_pages(page_map):
+    # The character-by-character splitter split_pages replaced, which its output must match exactly, with the same
+    # guard against repeating a section
+    SENTENCE_ENDINGS = [".", "!", "?"]
+    WORDS_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
+
+    def find_page(offset):
+        num_pages = len(page_map)
+        for i in range(num_pages - 1):
+            if offset >= page_map[i][1] and offset < page_map[i + 1][1]:
+                return i
+        return num_pages - 1
+
+    all_text = "".join(p[2] for p in page_map)
+    length = len(all_text)
+    start = 0
+    end = length
+    previous_start, previous_end = -1, 0
+    while start + SECTION_OVERLAP < length:
+        last_word = -1
+        end = start + MAX_SECTION_LENGTH
+        if end > length:
+            end = length
+        else:
+            while end < length and (end - start - MAX_SECTION_LENGTH) < SENTENCE_SEARCH_LIMIT and all_text[end] not in SENTENCE_ENDINGS:
+                if all_text[end] in WORDS_BREAKS:
+                    last_word = end
+                end += 1
+            if end < length and all_text[end] not in SENTENCE_ENDINGS and last_word > 0:
+                end = last_word
+        if end < length:
+            end += 1
+        last_word = -1
+        while start > 0 and start > end - MAX_SECTION_LENGTH - 2 * SENTENCE_SEARCH_LIMIT and all_text[start] not in SENTENCE_ENDINGS:
+            if all_text[start] in WORDS_BREAKS:
+                last_word = start
+            start -= 1
+        if all_text[start] not in SENTENCE_ENDINGS and last_word > 0:
+            start = last_word
+        if start > 0:
+            start += 1
+        if start <= previous_start:
+            start = previous_end
+        previous_start, previous_end = start, end
+        section_text = all_text[start:end]
+        yield (section_text, find_page(start))
+        last_table_start = section_text.rfind("<table")
+        if (last_table_start > 2 * SENTENCE_SEARCH_LIMIT and last_table_start > section_text.rfind("</table")):
+            start = min(end - SECTION_OVERLAP, start + last_table_start)
+        else:
+            start = end - SECTION_OVERLAP
+    if start + SECTION_OVERLAP < end:
+        yield (all_text[start:end], find_page(start))
+
+
+def synthetic_page_map(seed, pages, words_per_page):
+    rng = random.Random(seed)
+    words = ["policy", "deductible", "in-network", "(see", "above)", "coverage;", "plan:", "employee", "a", "Overlake", "😀", "x" * 150]
+    endings = [".", "!", "?", ",", ""]
+    page_map, offset = [], 0
+    for page in range(pages):
+        parts = []
+        for _ in range(rng.randint(0, words_per_page)):
+            parts.append(rng.choice(words) + rng.choice(endings) * (rng.random() < 0.2))
+            if rng.random() < 0.01:
+                parts.append("<table><tr><td>Plan</td><td>Deductible</td></tr>" if rng.random() < 0.7 else "</table>")
+        text = " ".join(parts) + rng.choice(["\n", " ", "\t", ""])
+        page_map.append((page, offset, text))
+        offset += len(text)
+    return page_map
+
+
+@pytest.mark.parametrize("seed,pages,words_per_page", [(0, 1, 0), (1, 1, 30), (2, 3, 400), (3, 40, 250), (4, 200, 80), (5, 25, 1200)])
+def test_split_pages_matches_reference(seed, pages, words_per_page):
+    page_map = synthetic_page_map(seed, pages, words_per_page)
+    assert list(split_pages(page_map)) == list(reference_split_pages(page_map))
+
+
+def test_split_pages_moves_past_long_unclosed_tables():
+    # Backing up to a sentence start after an unclosed table used to repeat the same section forever on this input
+    page_map = synthetic_page_map(5, 25, 1200)
+    length = sum(len(text) for _, _, text in page_map)
+    limit = 2 * length // (MAX_SECTION_LENGTH - SECTION_OVERLAP)
+    sections = list(islice(split_pages(page_map), limit + 1))
+    assert len(sections) <= limit
+    assert all(section != previous for section, previous in zip(sections[1:], sections))
+def test_split_pages_without_boundaries_or_pages():
+    assert list(split_pages([])) == []
+    page_map = [(0, 0, "x" * 2500), (1, 2500, ""), (2, 2500, "y" * 700)]
+    assert list(split_pages(page_map)) == list(reference_split_pages(page_map))
+
+
+def test_text_boundaries():
+    boundaries = TextBoundaries("One. Two, three! ")
+    assert boundaries.first_sentence_ending(4, 20) == 15
+    assert boundaries.last_sentence_ending(3, 14) is None
+    assert boundaries.first_word_break(4, 9) == 8
+    assert boundaries.last_word_break(0, 8) == 4
+
+
+class WordPieceEncoding:
+    # Stands in for a tiktoken encoding: words with their leading whitespace, cut into tokens of up to 3 UTF-8 bytes
+    def __init__(self):
+        self.vocabulary: dict[bytes, int] = {}
+        self.pieces: list[bytes] = []
+        self.encoded: list[str] = []
+
+    def encode_ordinary(self, text):
+        self.encoded.append(text)
+        tokens = []
+        for word in re.findall(r"\s*\S+|\s+", text):
+            data = word.encode("utf-8")
+            for i in range(0, len(data), 3):
+                piece = data[i : i + 3]
+                if piece not in self.vocabulary:
+                    self.vocabulary[piece] = len(self.pieces)
+                    self.pieces.append(piece)
+                tokens.append(self.vocabulary[piece])
+        return tokens
+
+    def decode_single_token_bytes(self, token):
+        return self.pieces[token]
+
+
+def test_token_offsets():
+    encoding = WordPieceEncoding()
+    page_map = [(0, 0, "One 😀 two."), (1, 10, "Three")]
+    # "One" | " 😀" cut after 3 bytes | " tw" "o." | "Thr" "ee"
+    assert token_offsets(page_map, encoding).tolist() == [0, 3, 5, 5, 8, 10, 13, 15]
+    assert encoding.encoded == ["One 😀 two.", "Three"]
+
+
+@pytest.mark.parametrize("seed,pages,words_per_page", [(2, 3, 400), (3, 40, 250), (5, 25, 1200)])
+def test_split_pages_by_tokens_fits_budget(seed, pages, words_per_page):
+    encoding = WordPieceEncoding()
+    page_map = synthetic_page_map(seed, pages, words_per_page)
+    all_text = "".join(text for _, _, text in page_map)
+    offsets = token_offsets(page_map, encoding).tolist()
+    sections = list(split_pages_by_tokens(page_map, encoding, max_tokens=120, overlap_tokens=12, sentence_search_tokens=12))
+    assert len(encoding.encoded) == 2 * pages
+
+    position = 0
+    for section, page in sections:
+        start = all_text.index(section, max(0, position - len(section)))
+        assert start <= position
+        position = start + len(section)
+        assert page_map[page][1] <= start
+        tokens = sum(1 for offset in offsets[:-1] if start <= offset < position)
+        assert tokens <= 120 + 1
+    assert position == len(all_text)
+
+
+def test_split_pages_by_tokens_sentence_boundaries():
+    text = " ".join(f"Sentence number {i} is here." for i in range(200))
+    sections = list(split_pages_by_tokens([(0, 0, text)], WordPieceEncoding(), max_tokens=60, overlap_tokens=6, sentence_search_tokens=12))
+    assert len(sections) > 5
+    assert all(section.endswith(".") for section, _ in sections)
+    assert all(section.startswith(" Sentence") for section, _ in sections[1:])
+
+
+def test_split_pages_by_tokens_table_continuation():
+    table = "<table>" + "<tr><td>cell</td></tr>" * 40 + "</table>"
+    text = "Intro words here. " * 20 + table + " Closing words."
+    sections = [section for section, _ in split_pages_by_tokens([(0, 0, text)], WordPieceEncoding(), max_tokens=100, overlap_tokens=10, sentence_search_tokens=10)]
+    continued = next(i for i, section in enumerate(sections) if "<table" in section and "</table" not in section)
+    assert sections[continued + 1].startswith("<table>")
+
+
+def test_split_pages_by_tokens_small_and_invalid():
+    assert list(split_pages_by_tokens([], WordPieceEncoding())) == []
+    assert list(split_pages_by_tokens([(0, 0, "Just one. "), (1, 10, "Two pages.")], WordPieceEncoding())) == [("Just one. Two pages.", 0)]
+    with pytest.raises(ValueError):
+        list(split_pages_by_tokens([(0, 0, "text")], WordPieceEncoding(), max_tokens=100, overlap_tokens=50, sentence_search_tokens=25))
+
+
+def test_section_token_settings_are_checked_when_the_indexer_loads(monkeypatch):
+    check_section_tokens(500, 50)
+    with pytest.raises(ValueError):
+        check_section_tokens(100, -1)
+
+    import indexer
+
+    monkeypatch.setenv("SECTION_TOKENS", "200")
+    monkeypatch.setenv("SECTION_OVERLAP_TOKENS", "200")
+    with pytest.raises(ValueError):
+        importlib.reload(indexer)
+    monkeypatch.setenv("SECTION_OVERLAP_TOKENS", "10")
+    assert importlib.reload(indexer).SPLIT_SECTION_TOKENS == 200
+    monkeypatch.delenv("SECTION_TOKENS")
+    monkeypatch.delenv("SECTION_OVERLAP_TOKENS")
+    importlib.reload(indexer)
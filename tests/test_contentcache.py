@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+from core.contentcache import ContentCache
+
+
+async def chunks(*parts):
+    for part in parts:
+        yield part
+
+
+async def drain(stream):
+    return b"".join([chunk async for chunk in stream])
+
+
+async def read(cache, index_name, path, etag, offset=0, length=100):
+    stream = await cache.read(index_name, path, etag, offset, length, chunk_size=4)
+    return None if stream is None else await drain(stream)
+
+
+@pytest.mark.asyncio
+async def test_store_and_read(tmp_path):
+    cache = ContentCache(str(tmp_path), max_bytes=1000)
+    assert await read(cache, "energy", "report-1.pdf", "0x1") is None
+
+    assert await drain(cache.store("energy", "report-1.pdf", "0x1", chunks(b"abc", b"def"))) == b"abcdef"
+    assert await read(cache, "energy", "report-1.pdf", "0x1") == b"abcdef"
+    assert await read(cache, "energy", "report-1.pdf", "0x1", offset=1, length=4) == b"bcde"
+
+    # A new ETag or another index is a different entry
+    assert await read(cache, "energy", "report-1.pdf", "0x2") is None
+    assert await read(cache, "adaptation", "report-1.pdf", "0x1") is None
+
+
+@pytest.mark.asyncio
+async def test_abandoned_store_leaves_no_entry(tmp_path):
+    cache = ContentCache(str(tmp_path), max_bytes=1000)
+    stream = cache.store("energy", "report-1.pdf", "0x1", chunks(b"abc", b"def"))
+    assert await stream.__anext__() == b"abc"
+    await stream.aclose()
+    assert await read(cache, "energy", "report-1.pdf", "0x1") is None
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.asyncio
+async def test_evicts_least_recently_used(tmp_path):
+    cache = ContentCache(str(tmp_path), max_bytes=10, max_entry_bytes=10)
+    await drain(cache.store("energy", "a.pdf", "0x1", chunks(b"aaaa")))
+    await drain(cache.store("energy", "b.pdf", "0x1", chunks(b"bbbb")))
+    os.utime(cache.entry_path("energy", "a.pdf", "0x1"), (1, 1))
+    os.utime(cache.entry_path("energy", "b.pdf", "0x1"), (2, 2))
+    # Reading a.pdf makes b.pdf the least recently used entry
+    assert await read(cache, "energy", "a.pdf", "0x1")
+
+    await drain(cache.store("energy", "c.pdf", "0x1", chunks(b"cccc")))
+    assert await read(cache, "energy", "a.pdf", "0x1")
+    assert await read(cache, "energy", "b.pdf", "0x1") is None
+    assert await read(cache, "energy", "c.pdf", "0x1")
+
+
+@pytest.mark.asyncio
+async def test_open_entry_survives_eviction(tmp_path):
+    cache = ContentCache(str(tmp_path), max_bytes=1000)
+    await drain(cache.store("energy", "report-1.pdf", "0x1", chunks(b"abcdef")))
+    stream = await cache.read("energy", "report-1.pdf", "0x1", 0, 6, chunk_size=4)
+    os.remove(cache.entry_path("energy", "report-1.pdf", "0x1"))
+    assert await drain(stream) == b"abcdef"
+    assert await read(cache, "energy", "report-1.pdf", "0x1") is None
+
+
+def test_accepts(tmp_path):
+    cache = ContentCache(str(tmp_path), max_bytes=100)
+    assert cache.accepts(25)
+    assert not cache.accepts(26)
+    assert not cache.accepts(0)
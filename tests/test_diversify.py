@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+from core.admission import AdmissionController
+from core.diversify import (
+    diversified_search,
+    diversify,
+    join_overlapping,
+    maximal_marginal_relevance,
+    merge_adjacent,
+)
+from core.localsearch import LocalSearchClient
+
+OVERLAP = "Employees can report concerns anonymously. "
+SECTIONS = [
+    {"id": "handbook-pdf-page-4", "sourcepage": "handbook-2.pdf", "content": "The whistleblower policy protects employees. " + OVERLAP, "embedding": [1.0, 0.0, 0.0]},
+    {"id": "handbook-pdf-page-5", "sourcepage": "handbook-2.pdf", "content": OVERLAP + "Reports go to the ethics hotline.", "embedding": [0.98, 0.2, 0.0]},
+    {"id": "handbook-pdf-page-9", "sourcepage": "handbook-4.pdf", "content": "The whistleblower policy applies to contractors.", "embedding": [0.97, 0.0, 0.25]},
+    {"id": "benefits-pdf-page-2", "sourcepage": "benefits-1.pdf", "content": "Whistleblower retaliation is grounds for dismissal.", "embedding": [0.3, 0.0, 0.95]},
+]
+
+
+def test_maximal_marginal_relevance_prefers_novel_rows():
+    vectors = np.array([[1.0, 0.0], [0.99, 0.14], [0.0, 1.0]], dtype=np.float32)
+    relevance = np.array([1.0, 0.95, 0.6])
+    assert maximal_marginal_relevance(relevance, vectors, 2, mmr_lambda=1.0) == [0, 1]
+    assert maximal_marginal_relevance(relevance, vectors, 2, mmr_lambda=0.5) == [0, 2]
+
+
+def test_join_overlapping_drops_repeated_text():
+    assert join_overlapping("a b " + OVERLAP, OVERLAP + "c d") == "a b " + OVERLAP + "c d"
+    # A coincidental short overlap isn't merged away
+    assert join_overlapping("the end.", ". Next") == "the end. . Next"
+
+
+def test_merge_adjacent_sections_of_a_page():
+    merged = merge_adjacent([SECTIONS[1], SECTIONS[2], SECTIONS[0]], "content", "sourcepage")
+    assert [doc["id"] for doc in merged] == ["handbook-pdf-page-5", "handbook-pdf-page-9"]
+    assert merged[0]["content"] == SECTIONS[0]["content"] + "Reports go to the ethics hotline."
+    # Sections of different pages are kept apart, so each keeps its citation
+    assert len(merge_adjacent([SECTIONS[0], {**SECTIONS[1], "sourcepage": "handbook-3.pdf"}], "content", "sourcepage")) == 2
+
+
+def test_diversify_fills_top_with_distinct_sources():
+    text = [SECTIONS[0], SECTIONS[1], SECTIONS[2], SECTIONS[3]]
+    vectors = [SECTIONS[1], SECTIONS[0], SECTIONS[2], SECTIONS[3]]
+    sources = diversify([text, vectors], 3, "content", "sourcepage")
+    assert [doc["sourcepage"] for doc in sources] == ["handbook-2.pdf", "benefits-1.pdf", "handbook-4.pdf"]
+    assert "ethics hotline" in sources[0]["content"] and "protects employees" in sources[0]["content"]
+
+
+@pytest.mark.asyncio
+async def test_diversified_search_over_local_index():
+    client = LocalSearchClient.from_documents(SECTIONS)
+    sources = await diversified_search(client, AdmissionController(), "whistleblower policy", [1.0, 0.1, 0.0], None, ["id", "sourcepage", "content"], 2, "content", "sourcepage")
+    assert len(sources) == 2
+    assert sources[0]["sourcepage"] == "handbook-2.pdf"
+    assert sources[1]["sourcepage"] != "handbook-2.pdf"
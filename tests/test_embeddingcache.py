@@ -0,0 +1,74 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from core.embeddingcache import EmbeddingCache, SqliteEmbeddingStore
+
+
+def creator(calls, vector=(0.1, 0.2, 0.3)):
+    async def create():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return list(vector)
+
+    return create
+
+
+@pytest.mark.asyncio
+async def test_vectors_are_cached_as_float32_by_deployment_and_text():
+    cache = EmbeddingCache(max_entries=2)
+    calls = []
+    first = await cache.get_or_create("ada", "parking", creator(calls))
+    assert first == pytest.approx([0.1, 0.2, 0.3])
+    assert await cache.get_or_create("ada", "parking", creator(calls)) == first
+    assert cache.vectors[("ada", "parking")].dtype == np.float32
+    await cache.get_or_create("ada-v3", "parking", creator(calls))
+    assert len(calls) == 2
+
+    await cache.get_or_create("ada", "dental", creator(calls))
+    assert ("ada", "parking") not in cache.vectors
+    assert len(cache.vectors) == 2
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_share_one_call():
+    cache = EmbeddingCache()
+    calls = []
+    results = await asyncio.gather(*[cache.get_or_create("ada", "parking", creator(calls)) for _ in range(5)])
+    assert len(calls) == 1
+    assert all(result == results[0] for result in results)
+    assert cache.pending == {}
+
+
+@pytest.mark.asyncio
+async def test_failures_are_not_cached():
+    cache = EmbeddingCache()
+
+    async def fail():
+        raise RuntimeError("throttled")
+
+    with pytest.raises(RuntimeError):
+        await cache.get_or_create("ada", "parking", fail)
+    calls = []
+    await cache.get_or_create("ada", "parking", creator(calls))
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_sqlite_store_outlives_the_memory_cache(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite3")
+    calls = []
+    first = EmbeddingCache(store=SqliteEmbeddingStore(path))
+    vector = await first.get_or_create("ada", "parking", creator(calls))
+    first.close()
+
+    # A recycled worker starts with an empty memory cache
+    second = EmbeddingCache(store=SqliteEmbeddingStore(path, max_entries=1))
+    try:
+        assert await second.get_or_create("ada", "parking", creator(calls)) == vector
+        assert len(calls) == 1
+        await second.get_or_create("ada", "dental", creator(calls))
+        assert await second.store.get("ada", "parking") is None
+    finally:
+        second.close()
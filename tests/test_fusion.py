@@ -0,0 +1,88 @@
+import asyncio
+import time
+
+import pytest
+
+from approaches.approach import citation
+from approaches.readdecomposeask import ReadDecomposeAsk
+from core.federatedsearch import FederatedSearchClient
+from core.fusion import reciprocal_rank_fusion
+
+
+def test_reciprocal_rank_fusion_rewards_agreement():
+    text = [{"id": "a"}, {"id": "b"}, {"id": "c"}]
+    vectors = [{"id": "b"}, {"id": "d"}]
+    fused = reciprocal_rank_fusion([text, vectors], key=lambda doc: doc["id"])
+    assert [doc["id"] for doc in fused] == ["b", "a", "d", "c"]
+
+
+def test_reciprocal_rank_fusion_breaks_ties_by_score_and_cuts_to_top():
+    energy = [{"id": "e1", "@search.score": 1.0}, {"id": "e2", "@search.score": 0.5}]
+    climate = [{"id": "c1", "@search.score": 2.0}, {"id": "c2", "@search.score": 0.1}]
+    fused = reciprocal_rank_fusion([energy, climate], key=lambda doc: doc["id"], top=3)
+    assert [doc["id"] for doc in fused] == ["c1", "e1", "e2"]
+
+
+class SlowSearchClient:
+    def __init__(self, docs, delay=0.1):
+        self.docs = docs
+        self.delay = delay
+        self.calls = []
+
+    async def search(self, search_text, **kwargs):
+        self.calls.append(kwargs)
+        await asyncio.sleep(self.delay)
+
+        async def results():
+            for doc in self.docs:
+                yield dict(doc)
+
+        return results()
+
+
+@pytest.mark.asyncio
+async def test_federated_search_runs_concurrently():
+    energy = SlowSearchClient([{"id": "1", "@search.score": 3.0}, {"id": "2", "@search.score": 1.0}])
+    climate = SlowSearchClient([{"id": "1", "@search.score": 2.0}])
+    client = FederatedSearchClient({"energy": energy, "climate-financing": climate})
+
+    start = time.monotonic()
+    results = await client.search("solar subsidies", top=2, filter="category ne 'x'")
+    assert time.monotonic() - start < 0.18
+    docs = [doc async for doc in results]
+
+    # The same document id in two indices is two different documents
+    assert [(doc["@search.index"], doc["id"]) for doc in docs] == [("energy", "1"), ("climate-financing", "1")]
+    assert await results.get_count() == 2
+    assert energy.calls == climate.calls == [{"top": 2, "filter": "category ne 'x'"}]
+
+
+@pytest.mark.asyncio
+async def test_federated_results_are_cited_with_their_index():
+    energy = SlowSearchClient([{"id": "1", "sourcepage": "report-3.pdf", "@search.score": 3.0}], delay=0)
+    climate = SlowSearchClient([{"id": "1", "sourcepage": "report-3.pdf", "@search.score": 2.0}], delay=0)
+    results = await FederatedSearchClient({"energy": energy, "climate-financing": climate}).search("solar", top=2)
+    # The same page name in two indices is served from each index's own container
+    assert [citation(doc, "sourcepage") async for doc in results] == ["energy/report-3.pdf", "climate-financing/report-3.pdf"]
+    assert citation({"sourcepage": "report-3.pdf"}, "sourcepage") == "report-3.pdf"
+
+
+class SelectingSearchClient(SlowSearchClient):
+    # Like the Azure SearchClient, only returns the selected fields
+    async def search(self, search_text, select=None, **kwargs):
+        results = await super().search(search_text, select=select, **kwargs)
+
+        async def selected():
+            async for doc in results:
+                yield {name: value for name, value in doc.items() if select is None or name in select or name.startswith("@search.")}
+
+        return selected()
+
+
+@pytest.mark.asyncio
+async def test_lookup_runs_against_a_federated_index():
+    energy = SelectingSearchClient([{"id": "1", "content": "Solar subsidies end in 2025.", "sourcepage": "a.pdf", "@search.score": 3.0}], delay=0)
+    climate = SelectingSearchClient([{"id": "1", "content": "Green bonds fund retrofits.", "sourcepage": "b.pdf", "@search.score": 2.0}], delay=0)
+    approach = ReadDecomposeAsk(FederatedSearchClient({"energy": energy, "climate-financing": climate}), "davinci", "ada", "sourcepage", "content")
+    assert await approach.lookup("solar subsidies") == "Solar subsidies end in 2025."
+    assert energy.calls[0]["select"] == ["id", "content"]
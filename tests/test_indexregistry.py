@@ -0,0 +1,76 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from core.indexregistry import IndexRegistry
+
+
+def write_registry(path, indices, default_index=None, mtime=None):
+    path.write_text(json.dumps({"default_index": default_index, "indices": indices}))
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def test_load_applies_field_and_container_defaults(tmp_path):
+    path = tmp_path / "indices.json"
+    write_registry(path, {"energy": {}, "adaptation": {"container": "adapt-docs", "content_field": "text", "defaults": {"top": 5}}})
+    registry = IndexRegistry(path=str(path), sourcepage_field="page")
+
+    assert registry.default_index == "energy"
+    assert registry.names() == ["energy", "adaptation"]
+    energy = registry.get("energy")
+    assert (energy.container, energy.content_field, energy.sourcepage_field, energy.defaults) == ("energy", "content", "page", {})
+    adaptation = registry.get("adaptation")
+    assert (adaptation.container, adaptation.content_field, adaptation.defaults) == ("adapt-docs", "text", {"top": 5})
+    assert registry.get("unknown") is None
+
+
+def test_load_from_string():
+    registry = IndexRegistry(data='{"default_index": "b", "indices": {"a": {}, "b": {}}}')
+    assert registry.default_index == "b"
+    assert registry.reload_if_modified() == set()
+
+
+def test_reload_reports_changed_indices(tmp_path):
+    path = tmp_path / "indices.json"
+    write_registry(path, {"a": {}, "b": {}, "c": {}}, mtime=1000)
+    registry = IndexRegistry(path=str(path))
+    assert registry.reload_if_modified() == set()
+
+    write_registry(path, {"a": {}, "b": {"defaults": {"top": 10}}, "d": {}}, mtime=2000)
+    assert registry.reload_if_modified() == {"b", "c", "d"}
+    assert registry.get("b").defaults == {"top": 10}
+    assert registry.get("c") is None
+
+
+def test_invalid_reload_keeps_current_registry(tmp_path):
+    path = tmp_path / "indices.json"
+    write_registry(path, {"a": {}}, mtime=1000)
+    registry = IndexRegistry(path=str(path))
+
+    write_registry(path, {"a": {}}, default_index="missing", mtime=2000)
+    with pytest.raises(ValueError):
+        registry.reload_if_modified()
+    assert registry.names() == ["a"]
+    assert registry.default_index == "a"
+
+
+@pytest.mark.asyncio
+async def test_watch_calls_back_with_changed_indices(tmp_path):
+    path = tmp_path / "indices.json"
+    write_registry(path, {"a": {}}, mtime=1000)
+    registry = IndexRegistry(path=str(path))
+    changes = []
+
+    watcher = asyncio.create_task(registry.watch(0.01, changes.append))
+    try:
+        write_registry(path, {"a": {}, "b": {}}, mtime=2000)
+        for _ in range(100):
+            if changes:
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        watcher.cancel()
+    assert changes == [{"b"}]
@@ -0,0 +1,169 @@
+import asyncio
+import threading
+
+import pytest
+
+from core.ingestion import (
+    FAILED,
+    SUCCEEDED,
+    WORKER_STOPPED,
+    IngestionQueue,
+    MemoryIngestionStore,
+    SqliteIngestionStore,
+)
+
+
+async def wait_for(job, *statuses):
+    for _ in range(200):
+        if job.status in statuses:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"job stayed {job.status}")
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        store = MemoryIngestionStore(max_jobs=2)
+    else:
+        store = SqliteIngestionStore(str(tmp_path / "ingestion.sqlite3"), max_jobs=2)
+    yield store
+    store.close()
+
+
+@pytest.mark.asyncio
+async def test_jobs_run_off_the_event_loop(store):
+    threads = []
+
+    def process(job, content):
+        threads.append(threading.current_thread())
+        job.update("indexing", len(content))
+
+    queue = IngestionQueue(process, workers=1, store=store)
+    await queue.start()
+    try:
+        job = await queue.submit("a.pdf", "energy", "energy-docs", b"12345")
+        assert (await queue.get(job.id))["status"] in ("queued", "running")
+        await wait_for(job, SUCCEEDED)
+        status = await queue.get(job.id)
+        assert (status["status"], status["stage"], status["sections"], status["error"]) == ("succeeded", "indexing", 5, None)
+        assert threads[0] is not threading.main_thread()
+    finally:
+        await queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_failed_job_reports_error(store):
+    def process(job, content):
+        raise RuntimeError("no embeddings today")
+
+    queue = IngestionQueue(process, workers=1, store=store)
+    await queue.start()
+    try:
+        job = await queue.submit("a.pdf", "energy", "energy", b"")
+        await wait_for(job, FAILED)
+        assert (await queue.get(job.id))["error"] == "no embeddings today"
+    finally:
+        await queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_bounded_backlog_and_job_history(store):
+    release = threading.Event()
+    queue = IngestionQueue(lambda job, content: release.wait(5), workers=1, max_queued=2, store=store)
+    await queue.start()
+    try:
+        first = await queue.submit("1.pdf", "energy", "energy", b"")
+        await asyncio.sleep(0.05)  # picked up by the worker
+        second = await queue.submit("2.pdf", "energy", "energy", b"")
+        third = await queue.submit("3.pdf", "energy", "energy", b"")
+        with pytest.raises(asyncio.QueueFull):
+            await queue.submit("4.pdf", "energy", "energy", b"")
+
+        release.set()
+        await queue.queue.join()
+        fifth = await queue.submit("5.pdf", "energy", "energy", b"")
+        # Only the newest jobs are remembered once they are finished
+        assert await queue.get(first.id) is None
+        assert await queue.get(second.id) is None
+        assert await queue.get(third.id) is not None
+        assert await queue.get(fifth.id) is not None
+    finally:
+        release.set()
+        await queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_stopping_fails_running_and_queued_jobs(store):
+    started = threading.Event()
+    release = threading.Event()
+
+    def process(job, content):
+        started.set()
+        release.wait(5)
+        job.update("indexing", 1)
+
+    queue = IngestionQueue(process, workers=1, store=store)
+    await queue.start()
+    try:
+        running = await queue.submit("1.pdf", "energy", "energy", b"")
+        queued = await queue.submit("2.pdf", "energy", "energy", b"")
+        assert await asyncio.to_thread(started.wait, 5)
+        await queue.stop()
+        for job in (running, queued):
+            status = await queue.get(job.id)
+            assert (status["status"], status["error"]) == (FAILED, WORKER_STOPPED)
+
+        # Progress from the thread that outlived its worker doesn't bring the job back to life
+        release.set()
+        await asyncio.sleep(0.05)
+        assert (await queue.get(running.id))["status"] == FAILED
+    finally:
+        release.set()
+        await queue.stop()
+@pytest.mark.asyncio
+async def test_on_success_runs_before_job_succeeds(store):
+    seen = []
+
+    async def on_success(job):
+        seen.append((job.index, job.status))
+
+    queue = IngestionQueue(lambda job, content: None, workers=1, store=store, on_success=on_success)
+    await queue.start()
+    try:
+        job = await queue.submit("a.pdf", "energy", "energy", b"")
+        await wait_for(job, SUCCEEDED)
+        assert seen == [("energy", "running")]
+    finally:
+        await queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_workers_sharing_a_store_see_jobs_and_new_documents(tmp_path):
+    path = str(tmp_path / "ingestion.sqlite3")
+    ingesting = IngestionQueue(lambda job, content: job.update("indexing", 7), workers=1, store=SqliteIngestionStore(path))
+    other = IngestionQueue(lambda job, content: None, workers=1, store=SqliteIngestionStore(path))
+    changes = []
+
+    async def on_change(changed):
+        changes.append(changed)
+
+    await ingesting.start()
+    watcher = asyncio.create_task(other.watch(0.01, on_change))
+    try:
+        await asyncio.sleep(0.02)  # the watcher has read the current versions
+        job = await ingesting.submit("a.pdf", "energy", "energy", b"")
+        await wait_for(job, SUCCEEDED)
+        status = await other.get(job.id)
+        assert (status["status"], status["sections"]) == ("succeeded", 7)
+
+        for _ in range(100):
+            if changes:
+                break
+            await asyncio.sleep(0.01)
+        assert changes == [{"energy"}]
+    finally:
+        watcher.cancel()
+        await ingesting.stop()
+        ingesting.store.close()
+        other.store.close()
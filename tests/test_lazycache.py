@@ -0,0 +1,32 @@
+from core.lazycache import LazyCache
+
+
+def test_builds_on_first_use_only():
+    built = []
+
+    def factory(key):
+        built.append(key)
+        return f"client-{key}"
+
+    cache = LazyCache(factory)
+    assert len(cache) == 0
+    assert cache.get("energy") == "client-energy"
+    assert cache.get("energy") == "client-energy"
+    assert built == ["energy"]
+    assert "energy" in cache
+
+
+def test_unknown_keys_are_not_cached():
+    cache = LazyCache(lambda key: key.upper() if key in ("energy", "adaptation") else None)
+    assert cache.get("unknown") is None
+    assert cache.get("unknown", "default") == "default"
+    assert "unknown" not in cache
+    assert len(cache) == 0
+
+
+def test_warm_and_discard():
+    cache = LazyCache(lambda key: "-".join(key))
+    cache.warm([("energy", "rtr"), ("energy", "rrr"), ("adaptation", "rrr")])
+    assert len(cache) == 3
+    assert sorted(cache.discard(lambda key: key[0] == "energy")) == ["energy-rrr", "energy-rtr"]
+    assert cache.values() == ["adaptation-rrr"]
@@ -0,0 +1,110 @@
+import numpy as np
+import openai
+import pytest
+from openai.openai_object import OpenAIObject
+
+from approaches.retrievethenread import RetrieveThenReadApproach
+from core.localsearch import LocalSearchClient
+
+DOCS = [
+    {"id": "1", "sourcepage": "Benefit_Options-2.pdf", "category": "benefits", "content": "Overlake is in-network for the employee plan.", "embedding": [1.0, 0.0, 0.0]},
+    {"id": "2", "sourcepage": "Handbook-7.pdf", "category": "handbook", "content": "Report concerns through the whistleblower policy.", "embedding": [0.0, 1.0, 0.0]},
+    {"id": "3", "sourcepage": "Benefit_Options-3.pdf", "category": "benefits", "content": "Deductibles depend on the plan.", "embedding": [0.7, 0.7, 0.1]},
+]
+
+
+async def search(client, *args, **kwargs):
+    return [doc async for doc in await client.search(*args, **kwargs)]
+
+
+@pytest.mark.asyncio
+async def test_vector_search_ranks_by_cosine_similarity():
+    client = LocalSearchClient.from_documents(DOCS)
+    results = await search(client, "", vector=[2.0, 0.1, 0.0], top_k=2, vector_fields="embedding", select=["id", "sourcepage"])
+    assert [doc["id"] for doc in results] == ["1", "3"]
+    assert set(results[0]) == {"id", "sourcepage", "@search.score"}
+    assert results[0]["@search.score"] == pytest.approx(2.0 / np.sqrt(4.01), rel=1e-5)
+
+
+@pytest.mark.asyncio
+async def test_text_search_filter_and_captions():
+    client = LocalSearchClient.from_documents(DOCS)
+    results = await search(client, "employee plan", filter="category eq 'benefits'", top=5, query_caption="extractive|highlight-false")
+    assert [doc["id"] for doc in results] == ["1", "3"]
+    assert results[0]["@search.captions"][0].text == DOCS[0]["content"]
+    assert await search(client, "employee plan", filter="category ne 'benefits'") == []
+    with pytest.raises(ValueError):
+        await search(client, "plan", filter="search.ismatch('plan')")
+
+
+@pytest.mark.asyncio
+async def test_hybrid_search_fuses_text_and_vector_rankings():
+    client = LocalSearchClient.from_documents(DOCS)
+    results = await search(client, "whistleblower", vector=[0.6, 0.6, 0.0], top_k=3, top=2)
+    # Document 3 is the closest vector and document 2 the only text match, and closest after it
+    assert [doc["id"] for doc in results] == ["2", "3"]
+
+
+@pytest.mark.asyncio
+async def test_saved_index_is_memory_mapped_with_ivf(tmp_path):
+    rng = np.random.default_rng(1)
+    vectors = rng.normal(size=(400, 16)).astype(np.float32)
+    docs = [{"id": str(i), "content": f"chunk {i}", "embedding": vector.tolist()} for i, vector in enumerate(vectors)]
+    client = LocalSearchClient.from_documents(docs, batch_size=64)
+    exact = await search(client, vector=vectors[7], top_k=5)
+
+    client.build_ivf(n_lists=8)
+    client.save(tmp_path)
+    loaded = LocalSearchClient.load(tmp_path, nprobe=8)
+    assert isinstance(loaded.vectors, np.memmap)
+    # Probing every list is exact search, probing a few still finds the query's own document
+    assert [doc["id"] for doc in await search(loaded, vector=vectors[7], top_k=5)] == [doc["id"] for doc in exact]
+    loaded.nprobe = 2
+    assert (await search(loaded, vector=vectors[7], top_k=5))[0]["id"] == "7"
+
+
+@pytest.mark.asyncio
+async def test_approach_retrieves_from_local_index(monkeypatch):
+    async def mock_embedding_acreate(*args, **kwargs):
+        return {"data": [{"embedding": [0.1, 1.0, 0.0]}]}
+
+    async def mock_acreate(*args, **kwargs):
+        return OpenAIObject.construct_from({"choices": [{"message": {"role": "assistant", "content": "Use the policy [Handbook-7.pdf]"}}]})
+
+    monkeypatch.setattr(openai.Embedding, "acreate", mock_embedding_acreate)
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", mock_acreate)
+    approach = RetrieveThenReadApproach(LocalSearchClient.from_documents(DOCS), "chatgpt", "gpt-35-turbo", "ada", "sourcepage", "content")
+    result = await approach.run("How do I report a concern?", {"top": 1})
+    assert result["data_points"] == ["Handbook-7.pdf: Report concerns through the whistleblower policy."]
+
+
+@pytest.mark.asyncio
+async def test_upload_and_delete_documents(tmp_path):
+    client = LocalSearchClient.from_documents(DOCS[:2])
+    client.build_ivf(n_lists=2)
+    results = await client.upload_documents([{**DOCS[2], "content": "Deductibles depend on the whistleblower plan."}, {**DOCS[0], "embedding": [0.0, 0.0, 1.0]}])
+    assert [result.succeeded for result in results] == [True, True]
+    assert [doc["id"] for doc in await search(client, "whistleblower deductibles", top=5)] == ["3", "2"]
+    assert [doc["id"] for doc in await search(client, vector=[0.0, 0.1, 1.0], top_k=1)] == ["1"]
+
+    await client.delete_documents([{"id": "3"}])
+    client.save(tmp_path)
+    loaded = LocalSearchClient.load(tmp_path)
+    assert [doc["id"] for doc in await search(loaded, "whistleblower deductibles", top=5)] == ["2"]
+    assert [doc["id"] async for doc in await loaded.search("", top=5)] == ["2", "1"]
+
+
+@pytest.mark.asyncio
+async def test_approach_diversifies_local_results(monkeypatch):
+    async def mock_embedding_acreate(*args, **kwargs):
+        return {"data": [{"embedding": [0.6, 0.6, 0.1]}]}
+
+    async def mock_acreate(*args, **kwargs):
+        return OpenAIObject.construct_from({"choices": [{"message": {"role": "assistant", "content": "It depends [Benefit_Options-3.pdf]"}}]})
+
+    monkeypatch.setattr(openai.Embedding, "acreate", mock_embedding_acreate)
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", mock_acreate)
+    approach = RetrieveThenReadApproach(LocalSearchClient.from_documents(DOCS), "chatgpt", "gpt-35-turbo", "ada", "sourcepage", "content")
+    result = await approach.run("What is the plan deductible?", {"top": 2, "diversify": True})
+    assert result["data_points"][0] == "Benefit_Options-3.pdf: Deductibles depend on the plan."
+    assert len(result["data_points"]) == 2
@@ -1,6 +1,9 @@
 import pytest
 
+from core import modelhelper
 from core.modelhelper import (
+    count_tokens,
+    get_encoding,
     get_oai_chatmodel_tiktok,
     get_token_limit,
     num_tokens_from_messages,
@@ -59,3 +62,22 @@ def test_get_oai_chatmodel_tiktok_error():
         get_oai_chatmodel_tiktok(None)
     with pytest.raises(ValueError, match="Expected Azure OpenAI ChatGPT model name"):
         get_oai_chatmodel_tiktok("gpt-3")
+
+
+def test_encoding_is_resolved_once_per_model():
+    assert get_encoding("gpt-35-turbo") is get_encoding("gpt-35-turbo")
+
+
+def test_token_counts_are_memoized_and_bounded(monkeypatch):
+    monkeypatch.setattr(modelhelper, "TOKEN_COUNT_CACHE_SIZE", 2)
+    monkeypatch.setattr(modelhelper, "_token_counts", modelhelper.OrderedDict())
+    encoded = []
+    encoding = get_encoding("gpt-35-turbo")
+    monkeypatch.setattr(encoding, "encode", lambda text, encode=encoding.encode: encoded.append(text) or encode(text))
+
+    assert count_tokens("Hello, how are you?", "gpt-35-turbo") == 6
+    assert count_tokens("Hello, how are you?", "gpt-35-turbo") == 6
+    count_tokens("one", "gpt-35-turbo")
+    count_tokens("two", "gpt-35-turbo")
+    count_tokens("Hello, how are you?", "gpt-35-turbo")
+    assert encoded == ["Hello, how are you?", "one", "two", "Hello, how are you?"]
@@ -0,0 +1,51 @@
+from core.modelhelper import count_tokens, num_tokens_from_messages
+from core.promptpacker import MIN_SOURCE_TOKENS, PromptPacker
+
+MODEL = "gpt-35-turbo"
+SOURCE = "info1.txt: " + " ".join(["deductible"] * 50)
+HISTORY = [
+    {"user": "What is my deductible?", "bot": "It is $500 [info1.txt]"},
+    {"user": "And for my family?", "bot": "It is $1000 [info1.txt]"},
+    {"user": "Is Overlake in network?"},
+]
+
+
+def test_everything_fits_in_a_large_budget():
+    prompt = PromptPacker(MODEL).pack("You are a bot.", "Is Overlake in network?", [SOURCE, "info2.pdf: Overlake is in-network."], HISTORY)
+    assert [message["role"] for message in prompt.messages] == ["system", "user", "assistant", "user", "assistant", "user"]
+    assert prompt.messages[-1]["content"] == "Is Overlake in network?\n\nSources:\n" + SOURCE + "\ninfo2.pdf: Overlake is in-network."
+    assert prompt.history_turns == 2
+    assert prompt.token_length == sum(num_tokens_from_messages(message, MODEL) for message in prompt.messages)
+
+
+def fixed_tokens(question="Is Overlake in network?\n\nSources:\n"):
+    return num_tokens_from_messages({"role": "system", "content": "You are a bot."}, MODEL) + num_tokens_from_messages({"role": "user", "content": question}, MODEL)
+
+
+def test_sources_are_cut_to_the_budget_before_history():
+    limit = fixed_tokens() + count_tokens(SOURCE, MODEL) + MIN_SOURCE_TOKENS + 10
+    prompt = PromptPacker(MODEL, completion_tokens=0, token_limit=limit).pack("You are a bot.", "Is Overlake in network?", [SOURCE, SOURCE], HISTORY)
+    assert prompt.history_turns == 0
+    assert prompt.sources[0] == SOURCE
+    assert prompt.token_length <= limit
+
+    limit = fixed_tokens() + MIN_SOURCE_TOKENS + 10
+    prompt = PromptPacker(MODEL, completion_tokens=0, token_limit=limit).pack("You are a bot.", "Is Overlake in network?", [SOURCE])
+    assert SOURCE.startswith(prompt.sources[0])
+    assert MIN_SOURCE_TOKENS <= count_tokens(prompt.sources[0], MODEL) < count_tokens(SOURCE, MODEL)
+    assert prompt.token_length <= limit
+
+
+def test_history_is_kept_from_the_most_recent_turn_in_whole_turns():
+    full = PromptPacker(MODEL, completion_tokens=0).pack("You are a bot.", "Is Overlake in network?", history=HISTORY)
+    assert full.history_turns == 2
+
+    prompt = PromptPacker(MODEL, completion_tokens=0, token_limit=full.token_length - 1).pack("You are a bot.", "Is Overlake in network?", history=HISTORY)
+    assert prompt.history_turns == 1
+    assert prompt.messages[1:3] == [{"role": "user", "content": "And for my family?"}, {"role": "assistant", "content": "It is $1000 [info1.txt]"}]
+
+
+def test_small_leftover_is_not_filled_with_a_source_fragment():
+    prompt = PromptPacker(MODEL, completion_tokens=0, token_limit=fixed_tokens() + MIN_SOURCE_TOKENS - 1).pack("You are a bot.", "Is Overlake in network?", [SOURCE])
+    assert prompt.sources == []
+    assert prompt.messages[-1]["content"] == "Is Overlake in network?"
@@ -0,0 +1,59 @@
+import time
+
+import numpy as np
+
+from core.semanticcache import SemanticCache, semantic_cache_scope
+
+INDICES = ("energy",)
+SCOPE = semantic_cache_scope("rtr", {"top": 3})
+
+
+def test_paraphrase_above_threshold_hits():
+    cache = SemanticCache(threshold=0.9)
+    cache.add(INDICES, SCOPE, [1.0, 0.0, 0.0], {"answer": "A"})
+    cache.add(INDICES, SCOPE, [0.0, 1.0, 0.0], {"answer": "B"})
+
+    answer, similarity = cache.lookup(INDICES, SCOPE, [2.0, 0.2, 0.0])
+    assert answer == {"answer": "A"}
+    assert np.isclose(similarity, 2.0 / np.hypot(2.0, 0.2))
+    assert cache.lookup(INDICES, SCOPE, [1.0, 1.0, 0.0]) is None
+
+
+def test_lookups_are_scoped_by_indices_and_overrides():
+    cache = SemanticCache()
+    cache.add(INDICES, SCOPE, [1.0, 0.0], {"answer": "A"})
+    assert cache.lookup(("climate",), SCOPE, [1.0, 0.0]) is None
+    assert cache.lookup(INDICES, semantic_cache_scope("rtr", {"top": 5}), [1.0, 0.0]) is None
+    assert cache.lookup(INDICES, semantic_cache_scope("rtr", {"top": 3, "include_timings": True}), [1.0, 0.0]) is not None
+
+
+def test_full_partition_replaces_least_recently_used_question():
+    cache = SemanticCache(max_entries=2)
+    cache.add(INDICES, SCOPE, [1.0, 0.0, 0.0], {"answer": "A"})
+    cache.add(INDICES, SCOPE, [0.0, 1.0, 0.0], {"answer": "B"})
+    time.sleep(0.01)
+    assert cache.lookup(INDICES, SCOPE, [1.0, 0.0, 0.0]) is not None
+    cache.add(INDICES, SCOPE, [0.0, 0.0, 1.0], {"answer": "C"})
+
+    assert cache.lookup(INDICES, SCOPE, [0.0, 1.0, 0.0]) is None
+    assert cache.lookup(INDICES, SCOPE, [1.0, 0.0, 0.0])[0] == {"answer": "A"}
+    assert cache.lookup(INDICES, SCOPE, [0.0, 0.0, 1.0])[0] == {"answer": "C"}
+    assert cache.partitions[(INDICES, SCOPE)].vectors.shape == (2, 3)
+
+
+def test_partitions_are_bounded_and_expire():
+    cache = SemanticCache(max_partitions=1, ttl=0.05)
+    cache.add(INDICES, SCOPE, [1.0, 0.0], {"answer": "A"})
+    cache.add(("climate",), SCOPE, [1.0, 0.0], {"answer": "B"})
+    assert list(cache.partitions) == [(("climate",), SCOPE)]
+    time.sleep(0.06)
+    assert cache.lookup(("climate",), SCOPE, [1.0, 0.0]) is None
+
+
+def test_invalidate_drops_partitions_that_searched_the_index():
+    cache = SemanticCache()
+    cache.add(("energy", "climate"), SCOPE, [1.0, 0.0], {"answer": "A"})
+    cache.add(INDICES, SCOPE, [1.0, 0.0], {"answer": "B"})
+    assert cache.invalidate("climate") == 1
+    assert cache.lookup(("energy", "climate"), SCOPE, [1.0, 0.0]) is None
+    assert cache.lookup(INDICES, SCOPE, [1.0, 0.0]) is not None
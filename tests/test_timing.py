@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+import pytest
+from langchain.agents import AgentExecutor, Tool, ZeroShotAgent
+from langchain.chains import LLMChain
+from langchain.llms.fake import FakeListLLM
+from langchain.schema import LLMResult
+
+from core.timing import StageTimer
+from langchainadapters import TimingCallbackHandler
+
+
+def test_stages_accumulate_and_usage_adds_up():
+    timer = StageTimer()
+    for _ in range(2):
+        with timer.stage("search"):
+            time.sleep(0.01)
+    timer.add_usage("completion", {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120})
+    timer.add_usage("completion", {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12})
+    timer.add_usage("completion", None)
+
+    timings = timer.to_dict()
+    assert timings["stages_ms"]["search"] >= 20
+    assert timings["total_ms"] >= timings["stages_ms"]["search"]
+    assert timings["tokens"] == {"completion": {"prompt_tokens": 110, "completion_tokens": 22, "total_tokens": 132}}
+
+
+def test_merge_adds_stages_and_usage_with_prefix():
+    timer, other = StageTimer(), StageTimer()
+    timer.stages["search"] = 0.1
+    other.stages["search"] = 0.2
+    other.add_usage("embedding", {"prompt_tokens": 5, "total_tokens": 5})
+
+    timer.merge(other)
+    timer.merge(other, prefix="discarded_")
+    assert timer.to_dict()["stages_ms"] == {"search": 300.0, "discarded_search": 200.0}
+    assert timer.tokens == {"embedding": {"prompt_tokens": 5, "total_tokens": 5}, "discarded_embedding": {"prompt_tokens": 5, "total_tokens": 5}}
+
+
+class UsageReportingLLM(FakeListLLM):
+    # Reports token usage the way the OpenAI LLMs do
+    async def _agenerate(self, prompts, stop=None, run_manager=None):
+        await asyncio.sleep(0.01)
+        result = await super()._agenerate(prompts, stop, run_manager)
+        return LLMResult(generations=result.generations, llm_output={"token_usage": {"prompt_tokens": 50, "completion_tokens": 5, "total_tokens": 55}})
+
+
+@pytest.mark.asyncio
+async def test_agent_model_calls_are_timed_with_their_usage():
+    timer = StageTimer()
+    llm = UsageReportingLLM(responses=["Action: Search\nAction Input: deductible", "Final Answer: $500"], callbacks=[TimingCallbackHandler(timer)])
+    tools = [Tool(name="Search", func=lambda _: "Not implemented", coroutine=lambda q: asyncio.sleep(0, "info1: $500"), description="search")]
+    prompt = ZeroShotAgent.create_prompt(tools=tools, input_variables=["input", "agent_scratchpad"])
+    agent = AgentExecutor.from_agent_and_tools(agent=ZeroShotAgent(llm_chain=LLMChain(llm=llm, prompt=prompt)), tools=tools)
+    assert await agent.arun("What is the deductible?") == "$500"
+
+    timings = timer.to_dict()
+    assert timings["stages_ms"]["llm"] >= 20
+    assert timings["tokens"] == {"llm": {"prompt_tokens": 100, "completion_tokens": 10, "total_tokens": 110}}
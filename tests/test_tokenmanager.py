@@ -0,0 +1,116 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from azure.core.credentials import AccessToken
+
+from core.tokenmanager import COGNITIVE_SERVICES_SCOPE, SyncTokenManager, TokenManager
+
+
+class MockAsyncCredential:
+    def __init__(self, lifetime=3600):
+        self.lifetime = lifetime
+        self.calls = 0
+
+    async def get_token(self, *scopes):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return AccessToken(f"token-{self.calls}", int(time.time() + self.lifetime))
+
+
+class MockSyncCredential:
+    def __init__(self, lifetime=3600):
+        self.lifetime = lifetime
+        self.calls = 0
+
+    def get_token(self, *scopes):
+        self.calls += 1
+        time.sleep(0.01)
+        return AccessToken(f"token-{self.calls}", int(time.time() + self.lifetime))
+
+
+@pytest.mark.asyncio
+async def test_concurrent_callers_share_one_refresh():
+    credential = MockAsyncCredential()
+    manager = TokenManager(credential)
+    tokens = await asyncio.gather(*[manager.get_token() for _ in range(20)])
+    assert credential.calls == 1
+    assert {token.token for token in tokens} == {"token-1"}
+
+    # A fresh token is served from the cache
+    assert (await manager.get_token(COGNITIVE_SERVICES_SCOPE)).token == "token-1"
+    assert credential.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_background_refresh_before_expiry():
+    credential = MockAsyncCredential(lifetime=2)
+    refreshed = []
+    manager = TokenManager(credential, refresh_margin=1.5, min_validity=0, retry_interval=0.1, on_refresh=lambda scopes, token: refreshed.append(token.token))
+    await manager.start()
+    try:
+        await asyncio.sleep(0.8)
+        assert credential.calls >= 2
+        assert refreshed[0] == "token-1"
+        assert (await manager.get_token()).token == refreshed[-1]
+    finally:
+        await manager.stop()
+
+
+@pytest.mark.asyncio
+async def test_sync_credential_from_worker_thread():
+    credential = MockAsyncCredential()
+    manager = TokenManager(credential)
+    await manager.start()
+    try:
+        sync_credential = manager.sync_credential()
+        # Not cached yet: fetched on the manager's event loop
+        token = await asyncio.get_running_loop().run_in_executor(None, sync_credential.get_token, "https://storage.azure.com/.default")
+        assert token.token == "token-2"
+        # Cached: served without touching the event loop
+        assert sync_credential.get_token("https://storage.azure.com/.default").token == "token-2"
+        assert sync_credential.get_token(COGNITIVE_SERVICES_SCOPE).token == "token-1"
+        assert credential.calls == 2
+    finally:
+        await manager.stop()
+
+
+@pytest.mark.asyncio
+async def test_sync_credential_fetch_on_event_loop_raises():
+    credential = MockAsyncCredential()
+    manager = TokenManager(credential)
+    await manager.start()
+    try:
+        # Waiting here for a fetch scheduled on this same loop would deadlock the worker
+        with pytest.raises(RuntimeError):
+            manager.sync_credential().get_token("https://storage.azure.com/.default")
+        assert manager.sync_credential().get_token(COGNITIVE_SERVICES_SCOPE).token == "token-1"
+        assert credential.calls == 1
+    finally:
+        await manager.stop()
+
+
+def test_sync_manager_single_flight():
+    credential = MockSyncCredential()
+    manager = SyncTokenManager(credential)
+    tokens = []
+    threads = [threading.Thread(target=lambda: tokens.append(manager.get_token())) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert credential.calls == 1
+    assert {token.token for token in tokens} == {"token-1"}
+
+
+def test_sync_manager_background_refresh():
+    credential = MockSyncCredential(lifetime=2)
+    manager = SyncTokenManager(credential, refresh_margin=1.5, min_validity=0, retry_interval=0.1)
+    manager.start()
+    try:
+        time.sleep(0.8)
+        assert credential.calls >= 2
+        assert manager.get_token().token == f"token-{credential.calls}"
+    finally:
+        manager.stop()